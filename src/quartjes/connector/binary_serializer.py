@@ -0,0 +1,675 @@
+"""
+Compact binary alternative to the XML serializer in
+:mod:`quartjes.connector.serializer`.
+
+Supports the same set of objects as the XML serializer, uses the same cache
+semantics and respects the same ``__serialize__`` class variable and value
+serializers. Only the representation on the wire differs. Like the XML
+serializer, ``__getstate__`` and ``__setstate__`` are used if present.
+
+Format
+------
+Every serialized string starts with :data:`MAGIC` so it can be told apart from
+an XML document. After that a single value follows. Each value starts with a
+one byte tag determining the type. Depending on the type the tag is followed by:
+
+* nothing: None, True and False;
+* a fixed size big endian number: int and float;
+* a 4 byte length followed by the raw bytes: str, unicode (UTF-8) and long;
+* 16 raw bytes: UUID;
+* a 4 byte length of the entire body, followed by the contents: list, tuple,
+  dict and class instances.
+
+Lists and tuples that can be packed (see
+:func:`quartjes.connector.serializer.pack_sequence`) are written as a packed
+value instead: after the length the tag of the container, the length prefixed
+types of the columns and the raw big endian doubles, one row per tuple.
+
+Because composite values are prefixed with their length, a reader is able to
+skip values without decoding them.
+
+Class instances contain the fully qualified class name and the id of the
+object, followed by the attribute names and values. If the object is already
+present in the cache, only a reference is written.
+
+Usage
+-----
+Use :func:`serialize` and :func:`deserialize`. Normally you do not need to do
+that yourself, the binary codec in :mod:`quartjes.connector.messages` does it
+for you.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import struct
+import uuid
+
+import numpy
+
+from quartjes.connector.serializer import ignored_types, value_serializers_by_klass
+from quartjes.connector.serializer import value_serializers_by_klass_name, get_class_by_name
+from quartjes.connector.serializer import get_serialization_plan, writer_caches
+from quartjes.connector.serializer import pack_sequence, unpack_sequence
+
+MAGIC = "\x00QB\x01"
+"""
+Prefix of every binary serialized string.
+"""
+
+TAG_NONE = "N"
+TAG_TRUE = "T"
+TAG_FALSE = "F"
+TAG_INT = "i"
+TAG_LONG = "L"
+TAG_FLOAT = "f"
+TAG_STR = "s"
+TAG_UNICODE = "u"
+TAG_UUID = "U"
+TAG_VALUE = "v"
+TAG_LIST = "l"
+TAG_TUPLE = "t"
+TAG_DICT = "d"
+TAG_INSTANCE = "o"
+TAG_REFERENCE = "r"
+TAG_PACKED = "p"
+
+_int_struct = struct.Struct(">q")
+_float_struct = struct.Struct(">d")
+_length_struct = struct.Struct(">I")
+
+_min_int = -(2 ** 63)
+_max_int = 2 ** 63 - 1
+
+
+def serialize(obj, cache=None):
+    """
+    Serialize an object to a binary string.
+
+    Parameters
+    ----------
+    obj
+        The object to serialize.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    string : string
+        Binary representation of the object, including the :data:`MAGIC` prefix.
+    """
+    if cache == None:
+        cache = {}
+
+    out = [MAGIC]
+    if isinstance(obj, ignored_types):
+        print("Warning: value type cannot be serialized: %s. Ignoring value." % obj.__class__)
+        out.append(TAG_NONE)
+    else:
+        write_value(obj, out, cache)
+    return "".join(out)
+
+def deserialize(string, cache=None):
+    """
+    Deserialize a binary string created by :func:`serialize`.
+
+    Parameters
+    ----------
+    string : string
+        Binary representation of the object.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    obj
+        Deserialized object.
+
+    Raises
+    ------
+    ValueError
+        The string does not contain binary serialized data.
+    """
+    if cache == None:
+        cache = {}
+
+    if not is_binary(string):
+        raise ValueError("Not a binary serialized string.")
+
+    (value, _) = read_value(string, len(MAGIC), cache)
+    return value
+
+def deserialize_envelope(string, lazy_fields, cache=None):
+    """
+    Deserialize a class instance, skipping the values of some of its
+    attributes. The skipped values can be read later using :func:`read_value`
+    with the same cache.
+    
+    The skipped values are read in order of their positions. Attributes that
+    are read directly should not refer to objects inside skipped values.
+
+    Parameters
+    ----------
+    string : string
+        Binary representation of the instance.
+    lazy_fields : dict
+        Names of the attributes to skip, by class.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    obj
+        Deserialized object. Skipped attributes keep the value set by the
+        constructor.
+    skipped : list of tuples
+        Name and position of each skipped attribute. Empty if the string does
+        not contain a class instance.
+
+    Raises
+    ------
+    ValueError
+        The string does not contain binary serialized data.
+    """
+    if cache == None:
+        cache = {}
+
+    if not is_binary(string):
+        raise ValueError("Not a binary serialized string.")
+
+    pos = len(MAGIC)
+    if string[pos] != TAG_INSTANCE:
+        (value, _) = read_value(string, pos, cache)
+        return value, []
+
+    (obj, skipped, _) = _read_instance_fields(string, pos + 1, cache, lazy_fields)
+    return obj, skipped
+
+def is_binary(string):
+    """
+    Determine whether the string contains binary serialized data.
+
+    Parameters
+    ----------
+    string : string
+        String to check.
+
+    Returns
+    -------
+    binary : boolean
+        True if the string starts with the binary prefix.
+    """
+    return string.startswith(MAGIC)
+
+
+def write_value(value, out, cache):
+    """
+    Append the binary representation of a value to the output.
+
+    Parameters
+    ----------
+    value
+        Value to write.
+    out : list of strings
+        Output buffer. The representation is appended to this list.
+    cache : dict
+        Dictionary to use as cache.
+    """
+    writer = _writers.get(value.__class__)
+    if writer is None:
+        writer = _get_writer(value)
+    writer(value, out, cache)
+
+def _get_writer(value):
+    """
+    Find the function writing values of the same class as the given value and
+    remember it for the class. Values that cannot be serialized get
+    :func:`_write_ignored`, which writes None.
+    """
+    writer = _fast_writers.get(value.__class__)
+    if writer is not None:
+        pass
+    elif isinstance(value, ignored_types):
+        writer = _write_ignored
+    elif hasattr(value, "__serialize__"):
+        writer = write_instance
+    elif isinstance(value, dict):
+        writer = write_dict
+    elif isinstance(value, (list, tuple)):
+        writer = write_list_or_tuple
+    elif value.__class__ in value_serializers_by_klass:
+        writer = _custom_value_writer(value_serializers_by_klass[value.__class__])
+    elif hasattr(value, "__dict__"):
+        writer = write_instance
+    else:
+        writer = _write_none
+
+    _writers[value.__class__] = writer
+    return writer
+
+def _custom_value_writer(ser):
+    """
+    Create a writer for values handled by a value serializer.
+    """
+    serialize_method = ser.serialize
+    type_name = _pack_string(ser.klass_name)
+    def write(value, out, cache):
+        out.append(TAG_VALUE)
+        out.append(type_name)
+        _write_string(serialize_method(value), out)
+    return write
+
+def write_list_or_tuple(values, out, cache):
+    """
+    Append the binary representation of a list or tuple to the output.
+    Values that cannot be serialized are left out, like the XML serializer does.
+    Sequences of numbers are packed if possible.
+
+    Parameters
+    ----------
+    values : list or tuple
+        Values to write.
+    out : list of strings
+        Output buffer.
+    cache : dict
+        Dictionary to use as cache.
+    """
+    if isinstance(values, tuple):
+        tag = TAG_TUPLE
+    else:
+        tag = TAG_LIST
+
+    packed = pack_sequence(values)
+    if packed is not None:
+        (kinds, array) = packed
+        body = [tag, _length_struct.pack(len(kinds)), kinds, array.astype(">f8").tostring()]
+        out.append(TAG_PACKED)
+        out.append(_length_struct.pack(sum(len(part) for part in body)))
+        out.extend(body)
+        return
+
+    body = []
+    count = 0
+    for value in values:
+        writer = _writers.get(value.__class__) or _get_writer(value)
+        if writer is _write_ignored:
+            _warn_ignored(value)
+            continue
+        writer(value, body, cache)
+        count += 1
+
+    _write_composite(tag, count, body, out)
+
+def write_dict(value, out, cache):
+    """
+    Append the binary representation of a dictionary to the output.
+
+    Parameters
+    ----------
+    value : dict
+        The dictionary to write.
+    out : list of strings
+        Output buffer.
+    cache : dict
+        Dictionary to use as cache.
+    """
+    body = []
+    count = 0
+    for (key, item) in value.items():
+        writer = _writers.get(item.__class__) or _get_writer(item)
+        if writer is _write_ignored:
+            _warn_ignored(item)
+            continue
+        write_value(key, body, cache)
+        writer(item, body, cache)
+        count += 1
+
+    _write_composite(TAG_DICT, count, body, out)
+
+def write_instance(obj, out, cache):
+    """
+    Append the binary representation of an object instance to the output.
+    If the object is already in the cache, only a reference is written.
+
+    Parameters
+    ----------
+    obj
+        The object instance to write.
+    out : list of strings
+        Output buffer.
+    cache : dict
+        Dictionary to use as cache.
+    """
+    plan = get_serialization_plan(obj.__class__)
+    class_name = _pack_string(plan.class_name)
+
+    if not hasattr(obj, "id"):
+        obj.id = uuid.uuid4()
+
+    if cache != None and obj.id in cache:
+        out.append(TAG_REFERENCE)
+        out.append(class_name)
+        out.append(obj.id.bytes)
+        return
+
+    if cache != None:
+        cache[obj.id] = obj
+
+    body = [class_name, obj.id.bytes]
+    fields = []
+    count = 0
+    for (attr_name, value) in plan.get_state(obj):
+        if attr_name == "id":
+            continue
+        writer = _writers.get(value.__class__) or _get_writer(value)
+        if writer is _write_ignored:
+            _warn_ignored(value)
+            continue
+        fields.append(_pack_string(attr_name))
+        writer(value, fields, cache)
+        count += 1
+
+    body.append(_length_struct.pack(count))
+    body.extend(fields)
+
+    out.append(TAG_INSTANCE)
+    out.append(_length_struct.pack(sum(len(part) for part in body)))
+    out.extend(body)
+
+def read_value(data, pos, cache):
+    """
+    Read a single value from the binary data.
+
+    Parameters
+    ----------
+    data : string
+        Binary data to read from.
+    pos : int
+        Position of the tag of the value.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    value
+        The value read.
+    pos : int
+        Position directly after the value.
+    """
+    tag = data[pos]
+    reader = _readers.get(tag)
+    if reader is None:
+        raise ValueError("Unknown tag %r at position %d." % (tag, pos))
+    return reader(data, pos + 1, cache)
+
+def skip_value(data, pos):
+    """
+    Skip a single value without decoding it.
+
+    Parameters
+    ----------
+    data : string
+        Binary data to read from.
+    pos : int
+        Position of the tag of the value.
+
+    Returns
+    -------
+    pos : int
+        Position directly after the value.
+    """
+    tag = data[pos]
+    pos += 1
+    if tag in (TAG_NONE, TAG_TRUE, TAG_FALSE):
+        return pos
+    if tag in (TAG_INT, TAG_FLOAT):
+        return pos + 8
+    if tag == TAG_UUID:
+        return pos + 16
+    if tag in (TAG_STR, TAG_UNICODE, TAG_LONG):
+        (_, pos) = _read_string(data, pos)
+        return pos
+    if tag == TAG_VALUE:
+        (_, pos) = _read_string(data, pos)
+        (_, pos) = _read_string(data, pos)
+        return pos
+    if tag == TAG_REFERENCE:
+        (_, pos) = _read_string(data, pos)
+        return pos + 16
+    if tag in _length_prefixed_tags:
+        (length,) = _length_struct.unpack_from(data, pos)
+        return pos + 4 + length
+    raise ValueError("Unknown tag %r at position %d." % (tag, pos - 1))
+
+
+def _warn_ignored(value):
+    """
+    Print a warning for a value that cannot be serialized.
+    """
+    print("Warning: value type cannot be serialized: %s. Ignoring value." % value.__class__)
+
+def _write_string(string, out):
+    """
+    Write a length prefixed string.
+    """
+    out.append(_length_struct.pack(len(string)))
+    out.append(string)
+
+def _pack_string(string):
+    """
+    Get a length prefixed class or attribute name, packing it only once.
+    """
+    packed = _packed_names.get(string)
+    if packed is None:
+        packed = _packed_names[string] = _length_struct.pack(len(string)) + string
+    return packed
+
+_packed_names = {}
+# Length prefixed class and attribute names.
+
+def _read_string(data, pos):
+    """
+    Read a length prefixed string.
+    """
+    (length,) = _length_struct.unpack_from(data, pos)
+    pos += 4
+    return data[pos:pos + length], pos + length
+
+def _write_composite(tag, count, body, out):
+    """
+    Write a composite value: the tag, the total length, the number of items and
+    the already written items.
+    """
+    out.append(tag)
+    out.append(_length_struct.pack(sum(len(part) for part in body) + 4))
+    out.append(_length_struct.pack(count))
+    out.extend(body)
+
+def _write_none(value, out, cache):
+    out.append(TAG_NONE)
+
+def _write_ignored(value, out, cache):
+    _warn_ignored(value)
+    out.append(TAG_NONE)
+
+def _write_bool(value, out, cache):
+    if value:
+        out.append(TAG_TRUE)
+    else:
+        out.append(TAG_FALSE)
+
+def _write_int(value, out, cache):
+    if _min_int <= value <= _max_int:
+        out.append(TAG_INT)
+        out.append(_int_struct.pack(value))
+    else:
+        out.append(TAG_LONG)
+        _write_string(str(value), out)
+
+def _write_float(value, out, cache):
+    out.append(TAG_FLOAT)
+    out.append(_float_struct.pack(value))
+
+def _write_str(value, out, cache):
+    out.append(TAG_STR)
+    _write_string(value, out)
+
+def _write_unicode(value, out, cache):
+    out.append(TAG_UNICODE)
+    _write_string(value.encode("utf-8"), out)
+
+def _write_uuid(value, out, cache):
+    out.append(TAG_UUID)
+    out.append(value.bytes)
+
+_fast_writers = {type(None): _write_none,
+                 bool: _write_bool,
+                 int: _write_int,
+                 long: _write_int,
+                 float: _write_float,
+                 str: _write_str,
+                 unicode: _write_unicode,
+                 uuid.UUID: _write_uuid}
+# Writers for builtin types that never need the generic type checks.
+
+_writers = {}
+# Writers by class of the value, filled by _get_writer on first use.
+writer_caches.append(_writers)
+
+def _read_none(data, pos, cache):
+    return None, pos
+
+def _read_true(data, pos, cache):
+    return True, pos
+
+def _read_false(data, pos, cache):
+    return False, pos
+
+def _read_int(data, pos, cache):
+    return _int_struct.unpack_from(data, pos)[0], pos + 8
+
+def _read_long(data, pos, cache):
+    (string, pos) = _read_string(data, pos)
+    return long(string), pos
+
+def _read_float(data, pos, cache):
+    return _float_struct.unpack_from(data, pos)[0], pos + 8
+
+def _read_str(data, pos, cache):
+    return _read_string(data, pos)
+
+def _read_unicode(data, pos, cache):
+    (string, pos) = _read_string(data, pos)
+    return string.decode("utf-8"), pos
+
+def _read_uuid(data, pos, cache):
+    return uuid.UUID(bytes=data[pos:pos + 16]), pos + 16
+
+def _read_custom_value(data, pos, cache):
+    (type_name, pos) = _read_string(data, pos)
+    (string, pos) = _read_string(data, pos)
+    ser = value_serializers_by_klass_name.get(type_name)
+    if ser is None:
+        return None, pos
+    return ser.deserialize(string), pos
+
+def _read_list(data, pos, cache):
+    (_, count) = struct.unpack_from(">II", data, pos)
+    pos += 8
+    values = []
+    for _ in xrange(count):
+        (value, pos) = read_value(data, pos, cache)
+        values.append(value)
+    return values, pos
+
+def _read_tuple(data, pos, cache):
+    (values, pos) = _read_list(data, pos, cache)
+    return tuple(values), pos
+
+def _read_packed(data, pos, cache):
+    (length,) = _length_struct.unpack_from(data, pos)
+    end = pos + 4 + length
+    tag = data[pos + 4]
+    (kinds, pos) = _read_string(data, pos + 5)
+    array = numpy.frombuffer(data, dtype=">f8", count=(end - pos) // 8, offset=pos).reshape(-1, len(kinds))
+    return unpack_sequence(kinds, array, tuple if tag == TAG_TUPLE else list), end
+
+def _read_dict(data, pos, cache):
+    (_, count) = struct.unpack_from(">II", data, pos)
+    pos += 8
+    values = {}
+    for _ in xrange(count):
+        (key, pos) = read_value(data, pos, cache)
+        (value, pos) = read_value(data, pos, cache)
+        values[key] = value
+    return values, pos
+
+def _read_instance(data, pos, cache):
+    (obj, _, pos) = _read_instance_fields(data, pos, cache)
+    return obj, pos
+
+def _read_instance_fields(data, pos, cache, lazy_fields=None):
+    """
+    Read an instance, skipping the attributes named in lazy_fields for its class.
+    """
+    (length,) = _length_struct.unpack_from(data, pos)
+    end = pos + 4 + length
+    (class_name, pos) = _read_string(data, pos + 4)
+    obj_id = uuid.UUID(bytes=data[pos:pos + 16])
+    pos += 16
+
+    plan = get_serialization_plan(get_class_by_name(class_name))
+    obj = plan.create(obj_id)
+
+    if cache != None:
+        cache[obj_id] = obj
+
+    lazy = lazy_fields.get(plan.klass, ()) if lazy_fields else ()
+    (count,) = _length_struct.unpack_from(data, pos)
+    pos += 4
+    state = []
+    skipped = []
+    for _ in xrange(count):
+        (attr_name, pos) = _read_string(data, pos)
+        if attr_name in lazy:
+            skipped.append((attr_name, pos))
+            pos = skip_value(data, pos)
+            continue
+        (value, pos) = read_value(data, pos, cache)
+        state.append((attr_name, value))
+    plan.set_state(obj, state)
+
+    assert pos == end, "Instance length does not match contents."
+    return obj, skipped, pos
+
+def _read_reference(data, pos, cache):
+    (class_name, pos) = _read_string(data, pos)
+    obj_id = uuid.UUID(bytes=data[pos:pos + 16])
+    pos += 16
+
+    assert cache != None, "When stubs are present, cache is required."
+    obj = cache.get(obj_id)
+    if obj is None:
+        # Same behaviour as the XML serializer: create an empty instance
+        obj = get_serialization_plan(get_class_by_name(class_name)).create(obj_id)
+        cache[obj_id] = obj
+    return obj, pos
+
+_readers = {TAG_NONE: _read_none,
+            TAG_TRUE: _read_true,
+            TAG_FALSE: _read_false,
+            TAG_INT: _read_int,
+            TAG_LONG: _read_long,
+            TAG_FLOAT: _read_float,
+            TAG_STR: _read_str,
+            TAG_UNICODE: _read_unicode,
+            TAG_UUID: _read_uuid,
+            TAG_VALUE: _read_custom_value,
+            TAG_LIST: _read_list,
+            TAG_TUPLE: _read_tuple,
+            TAG_DICT: _read_dict,
+            TAG_INSTANCE: _read_instance,
+            TAG_REFERENCE: _read_reference,
+            TAG_PACKED: _read_packed}
+
+_length_prefixed_tags = (TAG_LIST, TAG_TUPLE, TAG_DICT, TAG_INSTANCE, TAG_PACKED)
@@ -31,7 +31,12 @@ Advanced
 --------
 
 Use the method get_service_interface to retrieve additional interfaces to a server side
-service.
+service. Use get_async_service_interface to get an interface that does not wait
+for results, so multiple method calls can be in progress at the same time:
+
+>>> database = conn.get_async_service_interface("database")
+>>> pending = [database.get(id_) for id_ in ids]
+>>> drinks = [p.wait() for p in pending]
 
 As long as the connector is running, it will keep trying to reconnect any
 lost connections using an exponential back-off.
@@ -45,8 +50,8 @@ __docformat__ = "restructuredtext en"
 
 from quartjes.connector.protocol import QuartjesClientFactory
 from twisted.internet import reactor, threads
-from threading import Thread
-from quartjes.connector.services import ServiceInterface
+from threading import Thread, Lock
+from quartjes.connector.services import ServiceInterface, AsyncServiceInterface
 import quartjes.controllers.database
 import quartjes.controllers.stock_exchange2
 
@@ -60,6 +65,13 @@ class ClientConnector(object):
         Host to connect to. If no host is specified, a local server is started.
     port : int
         Port to connect to.
+    codecs : iterable of strings
+        Names of the message codecs to use, in order of preference. The codec
+        is negotiated with the server upon connection. See
+        :mod:`quartjes.connector.messages`.
+    compressions : iterable of strings
+        Names of the compression methods to use, in order of preference.
+        Negotiated like the codec. Pass an empty list to disable compression.
         
     Attributes
     ----------
@@ -72,14 +84,20 @@ class ClientConnector(object):
     
     """
 
-    def __init__(self, host=None, port=None):
+    _reactor_thread = None
+    # Thread running the reactor, shared by all connectors.
+
+    _reactor_lock = Lock()
+    # Protects starting the reactor thread.
+
+    def __init__(self, host=None, port=None, codecs=None, compressions=None):
         self._host = host
         if port:
             self._port = port
         else:
             from quartjes.connector.server import default_port
             self._port = default_port
-        self._factory = QuartjesClientFactory()
+        self._factory = QuartjesClientFactory(codecs=codecs, compressions=compressions)
         self._database = None
         self._stock_exchange = None
         self._connection = None
@@ -146,10 +164,12 @@ class ClientConnector(object):
             self._database = quartjes.controllers.database.default_database()
             self._stock_exchange = quartjes.controllers.stock_exchange2.StockExchange2()
         else:
-            reactor.callLater(0, self._connect) #@UndefinedVariable
-            if not reactor.running:             #@UndefinedVariable
-                self._reactor_thread = ClientConnector._ReactorThread()
-                self._reactor_thread.start()
+            reactor.callFromThread(self._connect) #@UndefinedVariable
+            with ClientConnector._reactor_lock:
+                # Another connector may have started the reactor thread already
+                if not reactor.running and ClientConnector._reactor_thread is None: #@UndefinedVariable
+                    ClientConnector._reactor_thread = ClientConnector._ReactorThread()
+                    ClientConnector._reactor_thread.start()
             self._factory.wait_for_connection()
 
             self._database = self.get_service_interface("database")
@@ -189,6 +209,25 @@ class ClientConnector(object):
         """
         return ServiceInterface(self._factory, service_name)
 
+    def get_async_service_interface(self, service_name):
+        """
+        Construct a service interface for which the method calls do not wait
+        for the server to respond.
+        
+        Parameters
+        ----------
+        service_name : string
+            Name of the service on the server to which you want a remote
+            interface.
+        
+        Returns
+        -------
+        service_interface : :class:`quartjes.connector.services.AsyncServiceInterface`
+            An interface to the service. Method calls return a
+            :class:`quartjes.connector.protocol.PendingResult`.
+        """
+        return AsyncServiceInterface(self._factory, service_name)
+
     def is_connected(self):
         """
         Determine whether the connection to the server is active.
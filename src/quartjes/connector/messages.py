@@ -6,10 +6,49 @@ clients.
 __author__ = "Rob van der Most"
 __docformat__ = "restructuredtext en"
 
+from threading import Lock
+import uuid
+import zlib
+
 from quartjes.util.classtools import QuartjesBaseClass
 import quartjes.connector.serializer as serializer
+import quartjes.connector.binary_serializer as binary_serializer
 from quartjes.connector.serializer import et
 
+XML_CODEC = "xml"
+"""
+Name of the XML codec. Supported by all servers and clients.
+"""
+
+XML_PACKED_CODEC = "xml-packed"
+"""
+Name of the XML codec packing sequences of numbers, like the histories of
+drinks, into a single element. Strings are parsed by the XML codec.
+"""
+
+BINARY_CODEC = "binary"
+"""
+Name of the compact binary codec.
+"""
+
+ZLIB_COMPRESSION = "zlib"
+"""
+Name of the zlib (deflate) compression method.
+"""
+
+compression_threshold = 1024
+"""
+Messages shorter than this number of bytes are never compressed. Compressing
+small messages costs more time than it saves.
+"""
+
+xml_streaming_threshold = 256 * 1024
+"""
+XML messages of at least this number of bytes are deserialized while parsing,
+without building the element tree first. Uses far less memory, but takes
+about twice as long.
+"""
+
 
 class Message(QuartjesBaseClass):
     """
@@ -50,6 +89,24 @@ class MethodCallMessage(Message):
         self.kwargs = kwargs
 
 
+class BatchCallMessage(Message):
+    """
+    Message type used to perform multiple method calls on the server in one
+    round trip. The calls are performed in order. The response contains a list
+    of (result_code, result) tuples, one for each call.
+    
+    Parameters
+    ----------
+    calls : list of :class:`MethodCallMessage`
+        The method calls to perform.
+    """
+
+    def __init__(self, calls=None):
+        super(BatchCallMessage, self).__init__()
+
+        self.calls = calls or []
+
+
 class ResponseMessage(Message):
     """
     Message used to respond to server request messages.
@@ -127,13 +184,42 @@ class ServerMotdMessage(Message):
         Message of the day. Short message from the server for new clients.
     client_id : UUID
         Unique identifier of the client at the server side.
+    codecs : list of strings
+        Names of the message codecs supported by the server. None for servers
+        that only support XML.
+    compressions : list of strings
+        Names of the compression methods supported by the server. None for
+        servers that do not support compression.
     """
 
-    def __init__(self, motd="Hello there!", client_id=None):
+    def __init__(self, motd="Hello there!", client_id=None, codecs=None, compressions=None):
         super(ServerMotdMessage, self).__init__()
 
         self.motd = motd
         self.client_id = client_id
+        self.codecs = codecs
+        self.compressions = compressions
+
+
+class SelectCodecMessage(Message):
+    """
+    Message sent by the client in response to the :class:`ServerMotdMessage`
+    to select the codec the server uses for the rest of the session. Part of
+    the initial handshake.
+    
+    Parameters
+    ----------
+    codec : string
+        Name of the message codec to use.
+    compression : string
+        Name of the compression method to use. None for no compression.
+    """
+
+    def __init__(self, codec=XML_CODEC, compression=None):
+        super(SelectCodecMessage, self).__init__()
+
+        self.codec = codec
+        self.compression = compression
 
 
 class FindServerMessage(Message):
@@ -168,41 +254,584 @@ class ServerFoundMessage(Message):
         self.host_address = host_address
 
 
-def parse_message_string(string):
+message_lazy_fields = {EventMessage: ("pargs", "kwargs"),
+                       ResponseMessage: ("result",)}
+"""
+Attributes of messages that :func:`parse_message_envelope` leaves encoded
+until the message is loaded, by message class.
+"""
+
+
+class MessageEnvelope(object):
     """
-    Parse a string for an XML message an return an instance of the contained
-    message type.
+    Message of which only the header has been deserialized. The attributes
+    listed in :data:`message_lazy_fields` are deserialized by :meth:`load`,
+    so messages that turn out not to be needed cost little.
+    
+    Parameters
+    ----------
+    message : :class:`Message`
+        The message with only the header attributes set.
+    load_method : callable object
+        Method returning the remaining attributes as a list of tuples of
+        attribute name and value. None if the message is already complete.
+    """
+
+    def __init__(self, message, load_method=None):
+        self._message = message
+        self._load_method = load_method
+        self._lock = Lock()
+
+    @property
+    def header(self):
+        """
+        The message. Until loaded, the lazy attributes have the values set by
+        the constructor.
+        """
+        return self._message
+
+    @property
+    def loaded(self):
+        """
+        True if all attributes of the message are deserialized.
+        """
+        return self._load_method is None
+
+    def load(self):
+        """
+        Deserialize the remaining attributes of the message, if not done yet.
+        Safe to call from any thread.
+        
+        Returns
+        -------
+        message : :class:`Message`
+            The complete message.
+        """
+        with self._lock:
+            if self._load_method is not None:
+                for (attr_name, value) in self._load_method():
+                    setattr(self._message, attr_name, value)
+                self._load_method = None
+        return self._message
+
+
+def parse_message_envelope(string):
+    """
+    Parse only the header of a message, see :class:`MessageEnvelope`. Like
+    :func:`parse_message_string` the codec is detected automatically and
+    compressed strings are decompressed first.
     
     Parameters
     ----------
     string : string
-        A string containing an XML message to be parsed.
+        A string containing a serialized message to be parsed.
         
     Returns
     -------
-    node
-        An XML node containing the XML from the input string.
+    envelope : :class:`MessageEnvelope`
+        Envelope containing the message.
     """
+    string = decompress_message_string(string)
+    return detect_message_codec(string).parse_envelope(string)
 
-    node = et.fromstring(string)
-    return serializer.deserialize(node)
+
+def parse_message_string(string):
+    """
+    Parse a string for a message and return an instance of the contained
+    message type. The codec used to create the string is detected automatically,
+    and compressed strings are decompressed first.
+    
+    Parameters
+    ----------
+    string : string
+        A string containing a serialized message to be parsed.
+        
+    Returns
+    -------
+    message : :class:`Message`
+        The message contained in the string.
+    """
+    string = decompress_message_string(string)
+    return detect_message_codec(string).parse(string)
 
 
-def create_message_string(msg):
+def create_message_string(msg, codec=XML_CODEC):
     """
-    Create an xml string to represent the given message.
+    Create a string to represent the given message.
     
     Parameters
     ----------
     msg : :class:`quartjes.connector.messages.Message`
-        Message object to create XML for.
+        Message object to create a string for.
+    codec : string
+        Name of the codec to use. Defaults to XML.
         
     Returns
     -------
-    xml : string
-        The XML for the input object.
+    string : string
+        The serialized message.
         
+    """
+    return message_codecs_by_name[codec].create(msg)
+
+
+class PreparedResponse(object):
+    """
+    Response message serialized once, to be sent in reply to many requests.
+    
+    Only the ids of the message and of the request it responds to differ
+    between the replies. These are replaced in the serialized string, so the
+    result is not serialized again. Codecs that cannot encode ids, see
+    :meth:`MessageCodec.encode_uuid`, serialize the response for every reply.
+    
+    Parameters
+    ----------
+    result
+        Result to send in the replies.
+    codec : string
+        Name of the codec to serialize the response with.
+    result_code : int
+        Code determining the outcome of the requests.
+    """
+
+    def __init__(self, result, codec=XML_CODEC, result_code=0):
+        self._codec = message_codecs_by_name[codec]
+        msg = ResponseMessage(result_code, result, response_to=uuid.uuid4())
+        string = self._codec.create(msg)
+
+        ids = [msg.id, msg.response_to]
+        encoded = [self._codec.encode_uuid(id_) for id_ in ids]
+        if None in encoded:
+            (self._result, self._result_code, self._parts) = (result, result_code, None)
+            return
+
+        positions = sorted((string.index(enc), enc, name) for (enc, name) in zip(encoded, ("id", "response_to")))
+        self._parts = []
+        self._order = []
+        start = 0
+        for (pos, enc, name) in positions:
+            self._parts.append(string[start:pos])
+            self._order.append(name)
+            start = pos + len(enc)
+        self._parts.append(string[start:])
+
+    def create(self, response_to):
+        """
+        Create the serialized response to a request.
+        
+        Parameters
+        ----------
+        response_to : UUID
+            Id of the request.
+        
+        Returns
+        -------
+        string : string
+            The serialized response, not compressed.
+        """
+        if self._parts is None:
+            return self._codec.create(ResponseMessage(self._result_code, self._result, response_to))
+
+        ids = {"id": self._codec.encode_uuid(uuid.uuid4()),
+               "response_to": self._codec.encode_uuid(response_to)}
+        out = [self._parts[0]]
+        for (name, part) in zip(self._order, self._parts[1:]):
+            out.append(ids[name])
+            out.append(part)
+        return "".join(out)
+
+
+def _parse_xml_message_string(string):
+    """
+    Parse a string for an XML message an return an instance of the contained
+    message type.
+    """
+    if len(string) >= xml_streaming_threshold:
+        return serializer.deserialize_string(string)
+    node = et.fromstring(string)
+    return serializer.deserialize(node)
+
+
+def _create_xml_message_string(msg):
+    """
+    Create an xml string to represent the given message.
     """
     root = serializer.serialize(msg, parent=None, tag_name="message")
     return et.tostring(root)
 
+def _create_packed_xml_message_string(msg):
+    """
+    Create an xml string to represent the given message, packing sequences of
+    numbers.
+    """
+    root = serializer.serialize(msg, parent=None, tag_name="message", pack_arrays=True)
+    return et.tostring(root)
+
+def _parse_xml_message_envelope(string):
+    """
+    Parse the header of an XML message. Large messages are deserialized
+    completely while streaming instead, keeping their element tree would
+    defeat the streaming.
+    """
+    if len(string) >= xml_streaming_threshold:
+        return MessageEnvelope(serializer.deserialize_string(string))
+
+    cache = {}
+    (msg, skipped) = serializer.deserialize_envelope(et.fromstring(string), message_lazy_fields, cache)
+    if not skipped:
+        return MessageEnvelope(msg)
+    return MessageEnvelope(msg, lambda: [(element.tag, serializer.deserialize(element, cache))
+                                         for element in skipped])
+
+def _parse_binary_message_envelope(string):
+    """
+    Parse the header of a binary message.
+    """
+    cache = {}
+    (msg, skipped) = binary_serializer.deserialize_envelope(string, message_lazy_fields, cache)
+    if not skipped:
+        return MessageEnvelope(msg)
+    return MessageEnvelope(msg, lambda: [(attr_name, binary_serializer.read_value(string, pos, cache)[0])
+                                         for (attr_name, pos) in skipped])
+
+
+message_codecs_by_name = {}
+# Dictionary of registered message codecs by name.
+
+message_codecs_by_prefix = []
+# List of (prefix, codec) tuples used to detect the codec of incoming strings.
+
+default_message_codec = None
+# Codec used for strings that do not match any registered prefix.
+
+
+def add_message_codec(codec, default=False):
+    """
+    Add a codec to the list of available message codecs.
+    
+    Parameters
+    ----------
+    codec : :class:`MessageCodec`
+        Codec to add.
+    default : boolean
+        Use this codec for strings that are not recognized by any other codec.
+    """
+    global default_message_codec
+    message_codecs_by_name[codec.name] = codec
+    if codec.prefix:
+        message_codecs_by_prefix.append((codec.prefix, codec))
+    if default:
+        default_message_codec = codec
+
+
+def get_message_codec(name):
+    """
+    Get a registered message codec by name.
+    
+    Parameters
+    ----------
+    name : string
+        Name of the codec.
+    
+    Returns
+    -------
+    codec : :class:`MessageCodec`
+        The codec registered under the name.
+    
+    Raises
+    ------
+    KeyError
+        No codec with this name is registered.
+    """
+    return message_codecs_by_name[name]
+
+
+def detect_message_codec(string):
+    """
+    Determine the codec used to create a message string.
+    
+    Parameters
+    ----------
+    string : string
+        Serialized message.
+    
+    Returns
+    -------
+    codec : :class:`MessageCodec`
+        The codec that can parse the string.
+    """
+    for (prefix, codec) in message_codecs_by_prefix:
+        if string.startswith(prefix):
+            return codec
+    return default_message_codec
+
+
+class MessageCodec(object):
+    """
+    Wire format used to turn messages into strings and back again.
+    
+    Instantiate this class and register it using :func:`add_message_codec` to
+    add support for a new wire format.
+    
+    Parameters
+    ----------
+    name : string
+        Unique name of the codec. Used during the handshake.
+    create_method : callable object
+        Method accepting a message and returning a string.
+    parse_method : callable object
+        Method accepting a string and returning a message.
+    prefix : string
+        Leading bytes that identify strings created by this codec. Can be None
+        for the default codec.
+    parse_envelope_method : callable object
+        Method accepting a string and returning a :class:`MessageEnvelope`.
+        If omitted, envelopes contain the completely parsed message.
+    encode_uuid_method : callable object
+        Method accepting a UUID and returning the exact string it is written as
+        in serialized messages, see :meth:`encode_uuid`.
+    """
+
+    def __init__(self, name, create_method, parse_method, prefix=None, parse_envelope_method=None,
+                 encode_uuid_method=None):
+        self._name = name
+        self._create_method = create_method
+        self._parse_method = parse_method
+        self._prefix = prefix
+        self._parse_envelope_method = parse_envelope_method
+        self._encode_uuid_method = encode_uuid_method
+
+    @property
+    def name(self):
+        """
+        Unique name of the codec.
+        """
+        return self._name
+
+    @property
+    def prefix(self):
+        """
+        Leading bytes that identify strings created by this codec.
+        """
+        return self._prefix
+
+    def create(self, msg):
+        """
+        Create a string to represent the given message.
+        
+        Parameters
+        ----------
+        msg : :class:`Message`
+            Message to serialize.
+        
+        Returns
+        -------
+        string : string
+            The serialized message.
+        """
+        return self._create_method(msg)
+
+    def parse(self, string):
+        """
+        Parse a string containing a message.
+        
+        Parameters
+        ----------
+        string : string
+            The serialized message.
+        
+        Returns
+        -------
+        message : :class:`Message`
+            The message contained in the string.
+        """
+        return self._parse_method(string)
+
+    def parse_envelope(self, string):
+        """
+        Parse only the header of a message.
+        
+        Parameters
+        ----------
+        string : string
+            The serialized message.
+        
+        Returns
+        -------
+        envelope : :class:`MessageEnvelope`
+            Envelope containing the message.
+        """
+        if self._parse_envelope_method is None:
+            return MessageEnvelope(self._parse_method(string))
+        return self._parse_envelope_method(string)
+
+    def encode_uuid(self, value):
+        """
+        Get the string a UUID is written as in serialized messages. Every
+        UUID must be written the same way, and with the same length, wherever
+        it appears. Used to reuse serialized messages, see
+        :class:`PreparedResponse`.
+        
+        Parameters
+        ----------
+        value : UUID
+            The UUID to encode.
+        
+        Returns
+        -------
+        string : string
+            The encoded UUID, or None if not supported by this codec.
+        """
+        if self._encode_uuid_method is None:
+            return None
+        return self._encode_uuid_method(value)
+
+
+message_compressions_by_name = {}
+# Dictionary of registered compression methods by name.
+
+
+def add_message_compression(compression):
+    """
+    Add a compression method to the list of available compression methods.
+    
+    Parameters
+    ----------
+    compression : :class:`MessageCompression`
+        Compression method to add.
+    """
+    message_compressions_by_name[compression.name] = compression
+
+
+def compress_message_string(string, compression):
+    """
+    Compress a serialized message if it is large enough to make it worth it.
+    
+    Parameters
+    ----------
+    string : string
+        The serialized message.
+    compression : string
+        Name of the compression method to use. None for no compression.
+    
+    Returns
+    -------
+    string : string
+        The possibly compressed message.
+    """
+    if compression is None or len(string) < compression_threshold:
+        return string
+    return message_compressions_by_name[compression].compress(string)
+
+
+def decompress_message_string(string):
+    """
+    Decompress a message string if it was compressed. Uncompressed strings are
+    returned unchanged.
+    
+    Parameters
+    ----------
+    string : string
+        String as received from the network.
+    
+    Returns
+    -------
+    string : string
+        The serialized message.
+    """
+    for compression in message_compressions_by_name.values():
+        if string.startswith(compression.prefix):
+            return compression.decompress(string)
+    return string
+
+
+class MessageCompression(object):
+    """
+    Compression method for serialized messages. Compressed strings start with a
+    prefix identifying the method, so they can be recognized on arrival.
+    
+    Parameters
+    ----------
+    name : string
+        Unique name of the compression method. Used during the handshake.
+    prefix : string
+        Leading bytes identifying strings compressed using this method. Should
+        not collide with any codec prefix.
+    compress_method : callable object
+        Method accepting a string and returning the compressed string.
+    decompress_method : callable object
+        Method accepting a compressed string and returning the original.
+    """
+
+    def __init__(self, name, prefix, compress_method, decompress_method):
+        self._name = name
+        self._prefix = prefix
+        self._compress_method = compress_method
+        self._decompress_method = decompress_method
+
+    @property
+    def name(self):
+        """
+        Unique name of the compression method.
+        """
+        return self._name
+
+    @property
+    def prefix(self):
+        """
+        Leading bytes identifying compressed strings.
+        """
+        return self._prefix
+
+    def compress(self, string):
+        """
+        Compress the string and add the prefix.
+        
+        Parameters
+        ----------
+        string : string
+            String to compress.
+        
+        Returns
+        -------
+        string : string
+            Compressed string including prefix.
+        """
+        return self._prefix + self._compress_method(string)
+
+    def decompress(self, string):
+        """
+        Remove the prefix and decompress the string.
+        
+        Parameters
+        ----------
+        string : string
+            Compressed string including prefix.
+        
+        Returns
+        -------
+        string : string
+            The original string.
+        """
+        return self._decompress_method(buffer(string, len(self._prefix)))
+
+
+_xml_codec = MessageCodec(XML_CODEC, _create_xml_message_string, _parse_xml_message_string,
+                          parse_envelope_method=_parse_xml_message_envelope,
+                          encode_uuid_method=lambda value: value.urn)
+_packed_xml_codec = MessageCodec(XML_PACKED_CODEC, _create_packed_xml_message_string, _parse_xml_message_string,
+                                 parse_envelope_method=_parse_xml_message_envelope,
+                                 encode_uuid_method=lambda value: value.urn)
+_binary_codec = MessageCodec(BINARY_CODEC, binary_serializer.serialize, binary_serializer.deserialize,
+                             prefix=binary_serializer.MAGIC,
+                             parse_envelope_method=_parse_binary_message_envelope,
+                             encode_uuid_method=lambda value: value.bytes)
+
+add_message_codec(_xml_codec, default=True)
+add_message_codec(_packed_xml_codec)
+add_message_codec(_binary_codec)
+
+_zlib_compression = MessageCompression(ZLIB_COMPRESSION, "\x00QZ\x01",
+                                       lambda x: zlib.compress(x, 6), zlib.decompress)
+
+add_message_compression(_zlib_compression)
@@ -20,26 +20,84 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.internet.protocol import ServerFactory
 from twisted.internet import reactor, threads, defer
 from twisted.protocols.basic import NetstringReceiver
+from twisted.python.threadpool import ThreadPool
+from collections import deque, OrderedDict
+import threading
 import uuid
-from quartjes.connector.messages import MethodCallMessage, ResponseMessage, SubscribeMessage
-from quartjes.connector.messages import ServerMotdMessage, create_message_string, parse_message_string
-from quartjes.connector.messages import EventMessage
+from quartjes.connector.messages import MethodCallMessage, ResponseMessage, SubscribeMessage, BatchCallMessage
+from quartjes.connector.messages import ServerMotdMessage, SelectCodecMessage, PreparedResponse
+from quartjes.connector.messages import EventMessage, XML_CODEC, XML_PACKED_CODEC, BINARY_CODEC, ZLIB_COMPRESSION
+from quartjes.connector.messages import detect_message_codec, get_message_codec, message_codecs_by_name
+from quartjes.connector.messages import compress_message_string, decompress_message_string
+from quartjes.connector.messages import message_compressions_by_name
 from quartjes.connector.exceptions import MessageHandleError, ConnectionError, TimeoutError
 from quartjes.connector.services import execute_remote_method_call, prepare_remote_service, subscribe_to_remote_event
+from quartjes.connector.services import is_cacheable, get_cache_version
 
 default_timeout = 10
 """
 Default value for the timeout in seconds.
 """
 
+default_max_workers = 10
+"""
+Default maximum number of threads the server uses to handle incoming messages.
+"""
+
+default_max_in_flight = 4
+"""
+Default maximum number of messages from a single connection the server handles
+at the same time.
+"""
+
+default_high_water = 64
+"""
+Default number of messages waiting for a single connection at which the server
+stops reading from that connection.
+"""
+
+default_low_water = 16
+"""
+Default number of messages waiting for a single connection at which the server
+starts reading from that connection again.
+"""
+
+default_response_cache_size = 256
+"""
+Default maximum number of serialized responses to cacheable remote methods
+the server keeps.
+"""
+
+default_codec_preference = (BINARY_CODEC, XML_PACKED_CODEC, XML_CODEC)
+"""
+Codecs a client asks for during the handshake, in order of preference.
+"""
+
+default_compression_preference = (ZLIB_COMPRESSION,)
+"""
+Compression methods a client asks for during the handshake, in order of preference.
+"""
+
 
 class QuartjesProtocol(NetstringReceiver):
     """
     Protocol implementation for the Quartjes application. For now we are using a basic
-    Netstring receiver to listen for xml messages encoded as netstrings.
+    Netstring receiver to listen for messages encoded as netstrings.
     
     No need to make instances of this class yourself. It is set as the protocol
     in the server and client factories.
+    
+    Attributes
+    ----------
+    id : UUID
+        Unique id of the connection.
+    codec : string
+        Name of the message codec used for messages sent over this connection.
+        See :mod:`quartjes.connector.messages`. Starts as XML and can be changed
+        during the handshake.
+    compression : string
+        Name of the compression method used for large messages sent over this
+        connection. None for no compression, which is also the initial value.
     """
 
     def __init__(self):
@@ -47,6 +105,8 @@ class QuartjesProtocol(NetstringReceiver):
         Construct a new protocol handler with a unique id.
         """
         self.id = uuid.uuid4()
+        self.codec = XML_CODEC
+        self.compression = None
         self.MAX_LENGTH = 999999999999
 
     def connectionMade(self):
@@ -69,16 +129,96 @@ class QuartjesProtocol(NetstringReceiver):
 
     def send_message(self, serial_message):
         """
-        Send the XML message to the other end of this connection.
+        Send the serialized message to the other end of this connection.
         """
         #print("Sending message: %s" % serial_message)
         self.sendString(serial_message)
 
+    def create_message_string(self, msg):
+        """
+        Serialize a message using the codec selected for this connection. If
+        compression is selected, large messages are compressed as well.
+        Safe to call from any thread, and preferably not called from the reactor
+        thread for large messages.
+        
+        Parameters
+        ----------
+        msg : :class:`quartjes.connector.messages.Message`
+            Message to serialize.
+        
+        Returns
+        -------
+        string : string
+            The serialized message.
+        """
+        return compress_message_string(get_message_codec(self.codec).create(msg), self.compression)
+
+    def parse_message_string(self, string):
+        """
+        Parse a message received on this connection. Strings in any registered
+        codec, compressed or not, are accepted, so messages sent before the
+        handshake completed are still understood. Safe to call from any thread,
+        and preferably not called from the reactor thread.
+        
+        Parameters
+        ----------
+        string : string
+            The serialized message.
+        
+        Returns
+        -------
+        msg : :class:`quartjes.connector.messages.Message`
+            The parsed message.
+        """
+        string = decompress_message_string(string)
+        return detect_message_codec(string).parse(string)
+
+    def parse_message_envelope(self, string):
+        """
+        Parse only the header of a message received on this connection, see
+        :class:`quartjes.connector.messages.MessageEnvelope`. Accepts the same
+        strings as :meth:`parse_message_string`.
+        
+        Parameters
+        ----------
+        string : string
+            The serialized message.
+        
+        Returns
+        -------
+        envelope : :class:`quartjes.connector.messages.MessageEnvelope`
+            Envelope containing the message.
+        """
+        string = decompress_message_string(string)
+        return detect_message_codec(string).parse_envelope(string)
+
 
 class QuartjesServerFactory(ServerFactory):
     """
     Protocol factory to handle incoming connections for the Quartjes server.
     
+    Parameters
+    ----------
+    max_workers : int
+        Maximum number of threads handling incoming messages. Defaults to
+        :data:`default_max_workers`.
+    max_in_flight : int
+        Maximum number of messages from a single connection handled at the same
+        time if `ordered` is False. Defaults to :data:`default_max_in_flight`.
+    ordered : boolean
+        Handle the messages of each connection one at a time, in the order they
+        were received. Messages of different connections are still handled in
+        parallel. Defaults to True.
+    high_water : int
+        Number of messages waiting for a single connection at which the server
+        stops reading from that connection. Defaults to :data:`default_high_water`.
+    low_water : int
+        Number of waiting messages at which reading is resumed. Defaults to
+        :data:`default_low_water`.
+    response_cache_size : int
+        Maximum number of responses to cacheable remote methods to keep.
+        Defaults to :data:`default_response_cache_size`.
+    
     Methods
     -------
     register_service
@@ -108,6 +248,45 @@ class QuartjesServerFactory(ServerFactory):
     
     If an exception occurs, any following step will be skipped and the error
     message is directly sent back using :meth:`_r_send_error`.
+    
+    Worker threads
+    ^^^^^^^^^^^^^^
+    The threads handling messages come from a thread pool owned by the
+    factory, so they do not compete with other users of the default reactor
+    thread pool. Incoming messages are queued per connection.
+    
+    By default the messages of a connection are handled strictly one after
+    the other: the next message is handed to the pool only after the response
+    to the previous one has been sent. Requests of one client therefore never
+    run at the same time or out of order, while requests of different clients
+    run in parallel. Without ordering at most `max_in_flight` messages of a
+    connection are handed to the pool at the same time, so a single busy
+    client cannot occupy all threads. If the queue
+    of a connection grows beyond `high_water` messages, the server stops
+    reading from that connection until the queue has shrunk to `low_water`
+    messages. The client then experiences the normal TCP back-pressure.
+    
+    Codecs
+    ^^^^^^
+    Upon connection the server sends a :class:`ServerMotdMessage
+    <quartjes.connector.messages.ServerMotdMessage>` in XML listing the
+    supported codecs and compression methods. The client answers with a
+    :class:`SelectCodecMessage <quartjes.connector.messages.SelectCodecMessage>`.
+    From that moment on all responses and events for that client use the
+    selected codec and compression. Clients that never select a codec keep
+    receiving uncompressed XML.
+    
+    Compressing and decompressing is done together with serializing and
+    parsing, so outside the reactor thread.
+    
+    Cached responses
+    ^^^^^^^^^^^^^^^^
+    Responses to remote methods decorated as :func:`cacheable
+    <quartjes.connector.services.cacheable>` are kept in a
+    :class:`ResponseCache`, serialized for each codec in use. Repeated calls
+    with the same arguments are answered without calling the method or
+    serializing the result again, until the cache version of the service
+    changes. Compression is still done for every response.
     """
 
     protocol = QuartjesProtocol
@@ -116,12 +295,36 @@ class QuartjesServerFactory(ServerFactory):
     to use for this factory.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=None, max_in_flight=None, ordered=True, high_water=None, low_water=None,
+                 response_cache_size=None):
         """
         Initialize the factory.
         """
         self._connections = {}
         self._services = {}
+        self._queues = {}
+        if ordered:
+            self._max_in_flight = 1
+        else:
+            self._max_in_flight = max_in_flight or default_max_in_flight
+        self._high_water = high_water or default_high_water
+        self._low_water = low_water or default_low_water
+        self._pool = ThreadPool(0, max_workers or default_max_workers, name="QuartjesServer")
+        self._response_cache = ResponseCache(response_cache_size or default_response_cache_size)
+
+    def startFactory(self):
+        """
+        Start the worker threads. Called by twisted when the factory starts
+        listening.
+        """
+        self._pool.start()
+
+    def stopFactory(self):
+        """
+        Stop the worker threads. Called by twisted when the factory stops
+        listening.
+        """
+        self._pool.stop()
 
     def register_service(self, service, name):
         """
@@ -164,8 +367,32 @@ class QuartjesServerFactory(ServerFactory):
             Twisted protocol object connected to the client.
         """
         self._connections[protocol.id] = protocol
-        motd = ServerMotdMessage(client_id=protocol.id)
-        protocol.send_message(create_message_string(motd))
+        self._queues[protocol.id] = _ConnectionQueue(protocol)
+        motd = ServerMotdMessage(client_id=protocol.id, codecs=self.supported_codecs(),
+                                 compressions=self.supported_compressions())
+        protocol.send_message(protocol.create_message_string(motd))
+
+    def supported_codecs(self):
+        """
+        Get the names of the message codecs this server supports.
+        
+        Returns
+        -------
+        codecs : list of strings
+            Names of the supported codecs.
+        """
+        return sorted(message_codecs_by_name.keys())
+
+    def supported_compressions(self):
+        """
+        Get the names of the compression methods this server supports.
+        
+        Returns
+        -------
+        compressions : list of strings
+            Names of the supported compression methods.
+        """
+        return sorted(message_compressions_by_name.keys())
 
     def _r_on_connection_lost(self, protocol):
         """
@@ -177,6 +404,7 @@ class QuartjesServerFactory(ServerFactory):
             Twisted protocol object connected to the client.
         """
         del self._connections[protocol.id]
+        self._queues.pop(protocol.id, None)
 
     def _r_on_incoming_message(self, string, protocol):
         """
@@ -191,9 +419,49 @@ class QuartjesServerFactory(ServerFactory):
             Twisted protocol object connected to the client.
         """
         #print("Incoming: %s" % string)
-        d = threads.deferToThread(self._parse_message, string, protocol)
-        d.addCallback(self._r_process_message, protocol)
-        d.addCallbacks(callback=self._r_send_result, errback=self._r_send_error, callbackArgs=(protocol,), errbackArgs=(protocol,))
+        queue = self._queues.get(protocol.id)
+        if queue is None:
+            return
+
+        queue.waiting.append(string)
+        if not queue.paused and len(queue.waiting) >= self._high_water:
+            queue.paused = True
+            protocol.transport.pauseProducing()
+
+        self._r_process_queue(queue)
+
+    def _r_process_queue(self, queue):
+        """
+        Hand waiting messages of a connection to the worker threads, as long as
+        the connection is below its limit of messages in flight. Resumes reading
+        from the connection once enough waiting messages have been handled.
+        
+        Parameters
+        ----------
+        queue : :class:`_ConnectionQueue`
+            Queue of the connection.
+        """
+        protocol = queue.protocol
+        while queue.waiting and queue.in_flight < self._max_in_flight:
+            string = queue.waiting.popleft()
+            queue.in_flight += 1
+
+            d = threads.deferToThreadPool(reactor, self._pool, self._parse_message, string, protocol)
+            d.addCallback(self._r_process_message, protocol)
+            d.addCallbacks(callback=self._r_send_result, errback=self._r_send_error, callbackArgs=(protocol,), errbackArgs=(protocol,))
+            d.addBoth(self._r_message_done, queue)
+
+        if queue.paused and len(queue.waiting) <= self._low_water:
+            queue.paused = False
+            protocol.transport.resumeProducing()
+
+    def _r_message_done(self, result, queue):
+        """
+        Handling a message has finished. Start on the next message waiting.
+        """
+        queue.in_flight -= 1
+        self._r_process_queue(queue)
+        return result
 
     def _parse_message(self, string, protocol):
         """
@@ -223,18 +491,31 @@ class QuartjesServerFactory(ServerFactory):
             If any error occurs while handling the message.
         """
         #print("Parsing message: %s" % string)
-        msg = parse_message_string(string)
+        msg = protocol.parse_message_string(string)
         result = MessageResult(original_message=msg)
 
         if isinstance(msg, MethodCallMessage):
             # Handle method call
-            res = self._method_call(msg)
+            result.response = self._method_call_response(msg, protocol)
+        elif isinstance(msg, BatchCallMessage):
+            # Handle multiple method calls, errors are reported per call
+            res = [self._batch_method_call(call) for call in msg.calls]
             response_msg = ResponseMessage(result_code=0, result=res, response_to=msg.id)
-            result.response = create_message_string(response_msg)
+            result.response = protocol.create_message_string(response_msg)
         elif isinstance(msg, SubscribeMessage):
             # Handle subscription to event
             response_msg = ResponseMessage(result_code=0, result=None, response_to=msg.id)
-            result.response = create_message_string(response_msg)
+            result.response = protocol.create_message_string(response_msg)
+        elif isinstance(msg, SelectCodecMessage):
+            # Handle codec selection, the switch itself happens in the reactor
+            if not msg.codec in message_codecs_by_name:
+                raise MessageHandleError(MessageHandleError.RESULT_INVALID_PARAMS, msg,
+                                         "Unsupported codec: %s" % msg.codec)
+            if msg.compression is not None and not msg.compression in message_compressions_by_name:
+                raise MessageHandleError(MessageHandleError.RESULT_INVALID_PARAMS, msg,
+                                         "Unsupported compression: %s" % msg.compression)
+            response_msg = ResponseMessage(result_code=0, result=None, response_to=msg.id)
+            result.response = protocol.create_message_string(response_msg)
         else:
             raise MessageHandleError(MessageHandleError.RESULT_UNEXPECTED_MESSAGE, msg)
 
@@ -269,6 +550,9 @@ class QuartjesServerFactory(ServerFactory):
             self._r_subscribe_to_event(result.original_message.service_name,
                                        result.original_message.event_name,
                                        protocol)
+        elif isinstance(result.original_message, SelectCodecMessage):
+            protocol.codec = result.original_message.codec
+            protocol.compression = result.original_message.compression
         
         return result.response
 
@@ -304,6 +588,67 @@ class QuartjesServerFactory(ServerFactory):
             error.original_message = msg
             raise error
 
+    def _method_call_response(self, msg, protocol):
+        """
+        Handle a MethodCall message and serialize the response. Responses to
+        cacheable methods are taken from the response cache if possible.
+        
+        Parameters
+        ----------
+        msg : :class:`quartjes.connector.messages.MethodCallMessage`
+            Message containg the method call to perform.
+        protocol
+            Twisted protocol object connected to the client.
+        
+        Returns
+        -------
+        response : string
+            Serialized response to send to the client.
+        
+        Raises
+        ------
+        MessageHandleError
+            If any error occurs while handling the message.
+        """
+        service = self._services.get(msg.service_name)
+        key = None
+        if service is not None and is_cacheable(service, msg.method_name):
+            key = ResponseCache.create_key(msg, protocol.codec)
+
+        if key is None:
+            res = self._method_call(msg)
+            response_msg = ResponseMessage(result_code=0, result=res, response_to=msg.id)
+            return protocol.create_message_string(response_msg)
+
+        # The version is read before the call, so changes during the call
+        # invalidate the response right away
+        version = get_cache_version(service)
+        prepared = self._response_cache.get(key, version)
+        if prepared is None:
+            prepared = PreparedResponse(self._method_call(msg), protocol.codec)
+            self._response_cache.put(key, version, prepared)
+        return compress_message_string(prepared.create(msg.id), protocol.compression)
+
+    def _batch_method_call(self, msg):
+        """
+        Perform a single method call from a batch.
+        
+        Parameters
+        ----------
+        msg : :class:`quartjes.connector.messages.MethodCallMessage`
+            Message containg the method call to perform.
+        
+        Returns
+        -------
+        result : tuple
+            Tuple of the result code and the result of the method call, or the
+            error details if the call failed.
+        """
+        try:
+            return (MessageHandleError.RESULT_OK, self._method_call(msg))
+        except MessageHandleError as error:
+            return (error.error_code, error.error_details)
+
     def _r_subscribe_to_event(self, service_name, event_name, protocol):
         """
         Subscribe the client to an event on the specified service.
@@ -347,10 +692,8 @@ class QuartjesServerFactory(ServerFactory):
 
     def _r_send_error(self, result, protocol):
         """
-        Send an exception to the client.
-        This is the only method that creates XML inside the reactor thread. This
-        might cause problems if the error contains a lot of data, but for now we
-        do not expect this to be the case.
+        Send an exception to the client. The response is created and
+        compressed in a worker thread, like other responses.
         
         Parameters
         ----------
@@ -360,6 +703,11 @@ class QuartjesServerFactory(ServerFactory):
             Twisted protocol object connected to the client that should receive
             event notifications.
         
+        Returns
+        -------
+        deferred
+            Deferred object that is triggered once the response has been sent.
+        
         Raises
         ------
         Exception
@@ -371,11 +719,32 @@ class QuartjesServerFactory(ServerFactory):
         if not isinstance(error, MessageHandleError):
             raise error
         print("Error occurred: %s" % result)
+        d = threads.deferToThreadPool(reactor, self._pool, self._create_error_response, error, protocol)
+        d.addCallback(protocol.send_message)
+        return d
+
+    def _create_error_response(self, error, protocol):
+        """
+        Create the response telling the client about an error. Runs in a
+        worker thread.
+        
+        Parameters
+        ----------
+        error : :class:`quartjes.connector.exceptions.MessageHandleError`
+            The error to send.
+        protocol
+            Twisted protocol object connected to the client.
+        
+        Returns
+        -------
+        response : string
+            Serialized message to send to the client.
+        """
         msgid = None
         if error.original_message is not None:
             msgid = error.original_message.id
         msg = ResponseMessage(result_code=error.error_code, response_to=msgid, result=error.error_details)
-        protocol.send_message(create_message_string(msg))
+        return protocol.create_message_string(msg)
 
     def send_event(self, service_name, event_name, listener, *pargs, **kwargs):
         """
@@ -398,10 +767,46 @@ class QuartjesServerFactory(ServerFactory):
             arguments to the client callback.
             
         """
-        msg = EventMessage(service_name, event_name, pargs, kwargs)
-        string = create_message_string(msg)
-        reactor.callFromThread(listener.send_message, string) #@UndefinedVariable
+        self.broadcast_event(service_name, event_name, [listener], *pargs, **kwargs)
+
+    def broadcast_event(self, service_name, event_name, listeners, *pargs, **kwargs):
+        """
+        Notify multiple clients of an event. The event message is serialized
+        only once for each combination of codec and compression in use by the
+        listeners, and the same string is sent to all of them.
         
+        Parameters
+        ----------
+        service_name : string
+            Name of the service firing the event.
+        event_name : string
+            Name of the event being fired.
+        listeners : iterable
+            Twisted protocol objects connected to the clients that should
+            receive event notifications.
+        *pargs
+            Any additional positional arguments will be sent as positional
+            arguments to the client callback.
+        **kwargs
+            Any additional keyword arguments will be sent as keyword
+            arguments to the client callback.
+        """
+        msg = EventMessage(service_name, event_name, pargs, kwargs)
+        groups = {}
+        for listener in listeners:
+            groups.setdefault((listener.codec, listener.compression), []).append(listener)
+
+        for group in groups.values():
+            string = group[0].create_message_string(msg)
+            reactor.callFromThread(self._r_send_to_all, string, group) #@UndefinedVariable
+
+    def _r_send_to_all(self, string, listeners):
+        """
+        Send the same serialized message to multiple clients.
+        """
+        for listener in listeners:
+            listener.send_message(string)
+
 
 class QuartjesClientFactory(ReconnectingClientFactory):
     """
@@ -413,6 +818,15 @@ class QuartjesClientFactory(ReconnectingClientFactory):
     timeout : int
         Timeout in seconds for messages. If no response is received within this time
         an exception will be returned.
+    codecs : iterable of strings
+        Names of the message codecs the client is willing to use, in order of
+        preference. During the handshake the first codec also supported by the
+        server is selected. XML is used if the server does not support any of
+        them. Defaults to :data:`default_codec_preference`.
+    compressions : iterable of strings
+        Names of the compression methods the client is willing to use, in order
+        of preference. Negotiated the same way as the codec. Pass an empty list
+        to disable compression. Defaults to :data:`default_compression_preference`.
         
     Notes
     -----
@@ -433,15 +847,26 @@ class QuartjesClientFactory(ReconnectingClientFactory):
     is added that will make sure the timeout call is cancelled when a response
     is received.
     
+    Asynchronous method calls use the same mechanism, but instead of blocking
+    the calling thread a :class:`PendingResult` is returned, which is completed
+    from the reactor thread. Any number of requests can be waiting for a
+    response at the same time. Responses are matched to the requests using the
+    message id.
+    
     Attributes
     ----------
     timeout
+    codec
+    compression
     
     Methods
     -------
     is_connected
     send_message_blocking
+    send_message_async
     send_method_call
+    send_method_call_async
+    send_batch_async
     subscribe
     wait_for_connection
     
@@ -453,7 +878,7 @@ class QuartjesClientFactory(ReconnectingClientFactory):
     to use for this factory.
     """
 
-    def __init__(self, timeout=None):
+    def __init__(self, timeout=None, codecs=None, compressions=None):
         """
         Initialize the client factory.
         """
@@ -461,10 +886,20 @@ class QuartjesClientFactory(ReconnectingClientFactory):
         self._waiting_for_connection = []
         self._current_protocol = None
         self._event_callbacks = {}
+        self._event_queues = {}
+        self._server_supports_batches = True
         if timeout:
             self._timeout = timeout
         else:
             self._timeout = default_timeout
+        if codecs:
+            self._codecs = tuple(codecs)
+        else:
+            self._codecs = default_codec_preference
+        if compressions is None:
+            self._compressions = default_compression_preference
+        else:
+            self._compressions = tuple(compressions)
 
     @property
     def timeout(self):
@@ -478,6 +913,38 @@ class QuartjesClientFactory(ReconnectingClientFactory):
     def timeout(self, value):
         self._timeout = value
 
+    @property
+    def codec(self):
+        """
+        Name of the message codec currently used for messages sent to the server.
+        XML until the handshake has selected another codec.
+        """
+        protocol = self._current_protocol
+        if protocol is None:
+            return XML_CODEC
+        return protocol.codec
+
+    @property
+    def compression(self):
+        """
+        Name of the compression method currently used for large messages sent
+        to the server. None if no compression is used.
+        """
+        protocol = self._current_protocol
+        if protocol is None:
+            return None
+        return protocol.compression
+
+    def _create_message_string(self, message):
+        """
+        Serialize a message for the current connection. Falls back to
+        uncompressed XML if there is no connection.
+        """
+        protocol = self._current_protocol
+        if protocol is None:
+            return get_message_codec(XML_CODEC).create(message)
+        return protocol.create_message_string(message)
+
     def _r_on_connection_established(self, protocol):
         """
         Handle a newly established connection to the server. Called by the 
@@ -529,32 +996,136 @@ class QuartjesClientFactory(ReconnectingClientFactory):
             Twisted protocol object connected to the server.
         """
         #print("Incoming: %s" % string)
-        d = threads.deferToThread(parse_message_string, string)
+        d = threads.deferToThread(self._parse_message, string, protocol)
         d.addCallback(self._r_handle_message_contents, protocol)
 
-    def _r_handle_message_contents(self, msg, protocol):
+    def _parse_message(self, string, protocol):
+        """
+        Parse the header of a message in a worker thread. The result of a
+        response is parsed right away if someone is waiting for it. The
+        arguments of events are only parsed if there is a callback, in the
+        thread calling it.
+        """
+        envelope = protocol.parse_message_envelope(string)
+        msg = envelope.header
+        # Only reading the dictionary, safe outside the reactor thread
+        if isinstance(msg, ResponseMessage) and msg.response_to in self._waiting_messages:
+            envelope.load()
+        return envelope
+
+    def _r_handle_message_contents(self, envelope, protocol):
         """
-        After parsing a message handle it in the reactor loop.
+        After parsing the header of a message handle it in the reactor loop.
         
         Parameters
         ----------
-        msg : :class:`quartjes.connector.messages.Message`
-            Message object to handle.
+        envelope : :class:`quartjes.connector.messages.MessageEnvelope`
+            Envelope containing the message to handle.
         protocol
             Twisted protocol object connected to the server.
         """
+        msg = envelope.header
         if isinstance(msg, ResponseMessage):
             d = self._waiting_messages.pop(msg.response_to, None)
             if d is not None:
-                d.callback(msg)
+                d.callback(envelope.load())
         elif isinstance(msg, ServerMotdMessage):
+            msg = envelope.load()
             print("Connected: %s" % msg.motd)
+            # Servers not advertising codecs predate batched calls
+            self._server_supports_batches = bool(msg.codecs)
+            self._r_select_codec(msg, protocol)
             self._r_successful_connection()
         elif isinstance(msg, EventMessage):
-            callback = self._event_callbacks.get((msg.service_name, msg.event_name))
+            key = (msg.service_name, msg.event_name)
+            callback = self._event_callbacks.get(key)
             if callback is not None:
-                threads.deferToThread(callback, *msg.pargs, **msg.kwargs)
+                self._r_queue_event(key, callback, envelope)
+
+    def _r_queue_event(self, key, callback, envelope):
+        """
+        Call the callback of an event in a worker thread. Events with the same
+        service and event name are handled one after another, in the order
+        they were received.
+        
+        Parameters
+        ----------
+        key : tuple
+            Service name and event name.
+        callback
+            Method to call with the arguments of the event.
+        envelope : :class:`quartjes.connector.messages.MessageEnvelope`
+            Envelope containing the event message.
+        """
+        queue = self._event_queues.get(key)
+        if queue is not None:
+            queue.append((callback, envelope))
+            return
+        self._event_queues[key] = deque()
+        self._r_run_event(key, callback, envelope)
+
+    def _r_run_event(self, key, callback, envelope):
+        """
+        Start handling an event in a worker thread.
+        """
+        d = threads.deferToThread(self._call_event_callback, callback, envelope)
+        d.addBoth(self._r_event_done, key)
+
+    def _r_event_done(self, result, key):
+        """
+        Handling an event has finished. Start on the next event with the same
+        key, if any.
+        """
+        queue = self._event_queues[key]
+        if queue:
+            (callback, envelope) = queue.popleft()
+            self._r_run_event(key, callback, envelope)
+        else:
+            del self._event_queues[key]
+        return result
+
+    def _call_event_callback(self, callback, envelope):
+        """
+        Parse the arguments of an event and call the callback with them.
+        Called in a worker thread.
+        """
+        msg = envelope.load()
+        callback(*msg.pargs, **msg.kwargs)
             
+    def _r_select_codec(self, motd, protocol):
+        """
+        Select the codec to use based on the codecs the server advertises and
+        tell the server about it. Servers not advertising any codecs only
+        understand XML. The compression method is selected the same way.
+        
+        Parameters
+        ----------
+        motd : :class:`quartjes.connector.messages.ServerMotdMessage`
+            MOTD message received from the server.
+        protocol
+            Twisted protocol object connected to the server.
+        """
+        if not motd.codecs:
+            return
+
+        for codec in self._codecs:
+            if codec in motd.codecs and codec in message_codecs_by_name:
+                break
+        else:
+            codec = XML_CODEC
+
+        compression = None
+        for name in self._compressions:
+            if motd.compressions and name in motd.compressions and name in message_compressions_by_name:
+                compression = name
+                break
+
+        if codec != protocol.codec or compression != protocol.compression:
+            msg = SelectCodecMessage(codec=codec, compression=compression)
+            protocol.send_message(protocol.create_message_string(msg))
+            protocol.codec = codec
+            protocol.compression = compression
+
     def _r_successful_connection(self):
         """
         Handle a succesful connection. Resets the reconnect backoff and makes
@@ -563,7 +1134,7 @@ class QuartjesClientFactory(ReconnectingClientFactory):
         self.resetDelay()
         for (service_name, event_name) in self._event_callbacks.keys():
             msg = SubscribeMessage(service_name=service_name, event_name=event_name)
-            serial_message = create_message_string(msg)
+            serial_message = self._current_protocol.create_message_string(msg)
             self._current_protocol.send_message(serial_message)
 
     def send_message_blocking(self, message):
@@ -591,16 +1162,77 @@ class QuartjesClientFactory(ReconnectingClientFactory):
         TimeoutError
             No response was received within the set timeout.
         """
-        serial_message = create_message_string(message)
+        serial_message = self._create_message_string(message)
         try:
             result_msg = threads.blockingCallFromThread(reactor, self._r_send_message_and_wait, message.id, serial_message)
-            if result_msg.result_code > 0:
-                raise MessageHandleError(error_code=result_msg.result_code, error_details = result_msg.result)
-            return result_msg.result
+            return self._get_response_result(result_msg)
         except TimeoutError:
             self._waiting_messages.pop(message.id, None)
             raise
 
+    def send_message_async(self, message, translate_error=None):
+        """
+        Send a message to the server without waiting for the result. Can be
+        called from any thread, including the reactor thread.
+
+        Parameters
+        ----------
+        message : :class:`quartjes.connector.messages.Message`
+            Message object to send to the server.
+        translate_error : callable object
+            Optional method accepting an exception and returning the exception
+            to report instead.
+        
+        Returns
+        -------
+        result : :class:`PendingResult`
+            Will contain the response returned by the server, or one of the
+            errors :meth:`send_message_blocking` can raise.
+        """
+        serial_message = self._create_message_string(message)
+        result = PendingResult(translate_error)
+        reactor.callFromThread(self._r_send_message_async, message.id, serial_message, result) #@UndefinedVariable
+        return result
+
+    def _r_send_message_async(self, message_id, serial_message, result):
+        """
+        Send a message to the server and complete the pending result once the
+        response is received.
+        """
+        try:
+            d = self._r_send_message_and_wait(message_id, serial_message)
+        except ConnectionError as err:
+            result._set_error(err)
+            return
+
+        d.addCallbacks(self._r_complete_result, self._r_fail_result,
+                       callbackArgs=(result,), errbackArgs=(message_id, result))
+
+    def _r_complete_result(self, result_msg, result):
+        """
+        Complete a pending result with the response from the server.
+        """
+        try:
+            result._set_result(self._get_response_result(result_msg))
+        except MessageHandleError as err:
+            result._set_error(err)
+
+    def _r_fail_result(self, failure, message_id, result):
+        """
+        Complete a pending result with an error in the connection or a timeout.
+        """
+        self._waiting_messages.pop(message_id, None)
+        result._set_error(failure.value)
+
+    def _get_response_result(self, result_msg):
+        """
+        Get the result from a response message, or raise an error if the server
+        reported a failure.
+        """
+        if result_msg.result_code > 0:
+            raise MessageHandleError(error_code=result_msg.result_code, error_details = result_msg.result)
+        return result_msg.result
+
     def _r_send_message_and_wait(self, message_id, serial_message):
         """
         Send a message to the server and return a Deferred which is called back
@@ -655,6 +1287,68 @@ class QuartjesClientFactory(ReconnectingClientFactory):
         msg = MethodCallMessage(service_name=service_name, method_name=method_name, pargs=pargs, kwargs=kwargs)
         return self.send_message_blocking(msg)
 
+    def send_method_call_async(self, service_name, method_name, *pargs, **kwargs):
+        """
+        Request a method call to be performed at the server without waiting for
+        the result. Can be called from any thread.
+
+        Parameters
+        ----------
+        service_name : string
+            Name of the service containing the method.
+        method_name : string
+            Name of the method to call.
+        *pargs
+            Positional arguments to supply to the method.
+        **kwargs
+            Keyword arguments to supply to the method.
+        
+        Returns
+        -------
+        result : :class:`PendingResult`
+            Will contain the result of the method, or one of the errors
+            :meth:`send_method_call` can raise.
+        """
+        msg = MethodCallMessage(service_name=service_name, method_name=method_name, pargs=pargs, kwargs=kwargs)
+        return self.send_message_async(msg)
+
+    def send_batch_async(self, calls, results=None):
+        """
+        Send multiple method calls to the server in a single message. The
+        server performs the calls in order. Can be called from any thread.
+        Servers that do not support batches receive the calls one by one.
+
+        Parameters
+        ----------
+        calls : list of :class:`quartjes.connector.messages.MethodCallMessage`
+            The method calls to perform.
+        results : list of :class:`PendingResult`
+            Optional results to complete, one for each call. Created if not
+            given.
+        
+        Returns
+        -------
+        results : list of :class:`PendingResult`
+            A result for each call, in the same order. Each contains either the
+            result of the method, or the error :meth:`send_method_call` would
+            raise.
+        """
+        if results is None:
+            results = [PendingResult() for _ in calls]
+
+        if not self._server_supports_batches:
+            for (call, result) in zip(calls, results):
+                serial_message = self._create_message_string(call)
+                reactor.callFromThread(self._r_send_message_async, call.id, serial_message, #@UndefinedVariable
+                                       result)
+            return results
+
+        msg = BatchCallMessage(calls=list(calls))
+        serial_message = self._create_message_string(msg)
+        reactor.callFromThread(self._r_send_message_async, msg.id, serial_message, #@UndefinedVariable
+                               _BatchResult(results))
+        return results
+
     def subscribe(self, service_name, event_name, callback):
         """
         Call from another thread to subscribe to an event on a specific service.
@@ -768,6 +1462,258 @@ class QuartjesClientFactory(ReconnectingClientFactory):
         return self._current_protocol is not None
 
 
+class PendingResult(object):
+    """
+    Result of a request to the server that may not have been received yet.
+    Safe to use from any thread.
+    
+    Parameters
+    ----------
+    translate_error : callable object
+        Optional method accepting an exception and returning the exception to
+        report instead.
+    
+    Attributes
+    ----------
+    done
+    
+    Methods
+    -------
+    wait
+    add_callbacks
+    """
+
+    def __init__(self, translate_error=None):
+        self._translate_error = translate_error
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    @property
+    def done(self):
+        """
+        True if the result or an error has been received.
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the result is received.
+        
+        Parameters
+        ----------
+        timeout : float
+            Maximum time in seconds to wait. If not given, wait until the
+            request completes or the timeout of the client factory expires.
+        
+        Returns
+        -------
+        result
+            The result of the request.
+        
+        Raises
+        ------
+        TimeoutError
+            No result was received within the timeout.
+        Exception
+            Any error the corresponding blocking call can raise.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("No result received within %s seconds." % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_callbacks(self, callback, errback=None):
+        """
+        Add methods to call when the request completes. Like event callbacks
+        they are called in a thread from the reactor thread pool.
+        
+        Parameters
+        ----------
+        callback : callable object
+            Called with the result if the request succeeds.
+        errback : callable object
+            Called with the exception if the request fails.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, errback))
+                return
+        self._run_callbacks(callback, errback)
+
+    def _set_result(self, result):
+        """
+        Complete the request successfully.
+        """
+        self._complete(result, None)
+
+    def _set_error(self, error):
+        """
+        Complete the request with an error.
+        """
+        if self._translate_error is not None:
+            error = self._translate_error(error)
+        self._complete(None, error)
+
+    def _complete(self, result, error):
+        """
+        Store the outcome and notify waiting threads and callbacks.
+        """
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for (callback, errback) in callbacks:
+            self._run_callbacks(callback, errback)
+
+    def _run_callbacks(self, callback, errback):
+        """
+        Hand the outcome to the matching callback in a pool thread.
+        """
+        if self._error is None:
+            reactor.callFromThread(threads.deferToThread, callback, self._result) #@UndefinedVariable
+        elif errback is not None:
+            reactor.callFromThread(threads.deferToThread, errback, self._error) #@UndefinedVariable
+
+
+class _BatchResult(object):
+    """
+    Distributes the response to a :class:`BatchCallMessage
+    <quartjes.connector.messages.BatchCallMessage>` over the pending results of
+    the individual calls.
+    """
+
+    def __init__(self, results):
+        self._results = results
+
+    def _set_result(self, responses):
+        for (result, (result_code, value)) in zip(self._results, responses):
+            if result_code > 0:
+                result._set_error(MessageHandleError(error_code=result_code, error_details=value))
+            else:
+                result._set_result(value)
+
+    def _set_error(self, error):
+        for result in self._results:
+            result._set_error(error)
+
+
+class _ConnectionQueue(object):
+    """
+    Messages of a single client connection waiting to be handled by the server.
+    
+    Parameters
+    ----------
+    protocol
+        Twisted protocol object connected to the client.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.waiting = deque()
+        self.in_flight = 0
+        self.paused = False
+
+
+class ResponseCache(object):
+    """
+    Serialized responses to calls of cacheable remote methods, see
+    :func:`quartjes.connector.services.cacheable`. Each response is stored
+    together with the cache version of the service at the time of the call,
+    and is only used while the version is unchanged. The least recently used
+    responses are dropped when the cache is full. Safe to use from multiple
+    threads.
+    
+    Parameters
+    ----------
+    size : int
+        Maximum number of responses to keep.
+    """
+
+    def __init__(self, size=default_response_cache_size):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_key(msg, codec):
+        """
+        Create the key of the response to a method call.
+        
+        Parameters
+        ----------
+        msg : :class:`quartjes.connector.messages.MethodCallMessage`
+            The method call.
+        codec : string
+            Name of the codec the response is serialized with.
+        
+        Returns
+        -------
+        key : tuple
+            The key, or None if the arguments cannot be used in a key.
+        """
+        pargs = tuple((type(arg), arg) for arg in msg.pargs or ())
+        kwargs = tuple(sorted((name, type(arg), arg) for (name, arg) in (msg.kwargs or {}).items()))
+        key = (msg.service_name, msg.method_name, pargs, kwargs, codec)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key, version):
+        """
+        Get a cached response.
+        
+        Parameters
+        ----------
+        key : tuple
+            Key of the response, see :meth:`create_key`.
+        version
+            Current cache version of the service.
+        
+        Returns
+        -------
+        response : :class:`quartjes.connector.messages.PreparedResponse`
+            The response, or None if not cached for this version.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def put(self, key, version, response):
+        """
+        Store a response.
+        
+        Parameters
+        ----------
+        key : tuple
+            Key of the response, see :meth:`create_key`.
+        version
+            Cache version of the service before the call was made.
+        response : :class:`quartjes.connector.messages.PreparedResponse`
+            The response.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, response)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class MessageResult(object):
     """
     Intermediate result of an incoming message in the server protocol.
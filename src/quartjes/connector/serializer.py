@@ -6,12 +6,19 @@ Several types of objects are supported for serialization:
 
 * objects implementing a __serialize__ class variable and a constructor allowing
   zero arguments
+* objects implementing __getstate__ and __setstate__ like for pickle, returning
+  and accepting a dictionary, and a constructor allowing zero arguments
 * objects with a __dict__ variable (e.g. python classes) and a constructor 
   allowing zero arguments
 * several builtin types like str, int, float, uuid
 * tuples, lists and dictionaries of supported types
 * custom types that are registered with this module
 
+Long lists or tuples of equally long tuples of ints and floats, like the
+histories of drinks, can be packed into a single element containing the base64
+encoded array of numbers. See :func:`pack_sequence`. Packing is only done
+when asked for, as older versions cannot read packed elements.
+
 Some object types are not supported and will be ignored (this will not break
 existing methods on classes, just happens when you assign such a method to
 a instance variable):
@@ -26,6 +33,13 @@ is added to the instance.
 Usage
 -----
 In most cases only :func:`serialize` and :func:`deserialize` need to be used.
+To deserialize a document without building the whole tree in memory first, use
+:func:`deserialize_string` or :func:`deserialize_stream`.
+
+Classes are only inspected the first time an instance is serialized or
+deserialized, the result is kept in a :class:`SerializationPlan`. How to write
+a value is also remembered per class. Changing ``__serialize__`` of a class
+after it has been serialized is not supported.
 
 Cache
 -----
@@ -47,8 +61,12 @@ try:
     import xml.etree.cElementTree as et
 except ImportError:
     import xml.etree.ElementTree as et
-import uuid
+import base64
+from cStringIO import StringIO
 import types
+import uuid
+
+import numpy
 
 
 # For these internal types, serialization is not supported. They will be ignored
@@ -57,7 +75,7 @@ ignored_types = (types.FunctionType, types.BuiltinFunctionType, types.BuiltinMet
                  types.FileType, types.GeneratorType, types.LambdaType, types.MemberDescriptorType,
                  types.MethodType, types.ModuleType, types.TypeType, types.UnboundMethodType)
 
-def serialize(obj, parent=None, tag_name="unknown", cache=None):
+def serialize(obj, parent=None, tag_name="unknown", cache=None, pack_arrays=False):
     """
     Serialize an object.
     
@@ -71,6 +89,8 @@ def serialize(obj, parent=None, tag_name="unknown", cache=None):
         Name of the tag to enclose the object in.
     cache : dict
         Dictionary to use as cache.
+    pack_arrays : boolean
+        Pack sequences of numbers, see :func:`pack_sequence`.
     
     Returns
     -------
@@ -80,7 +100,7 @@ def serialize(obj, parent=None, tag_name="unknown", cache=None):
     if cache == None:
         cache = {}
 
-    return add_value_element(obj, parent, tag_name, cache=cache)
+    return add_value_element(obj, parent, tag_name, cache=cache, pack_arrays=pack_arrays)
 
 def deserialize(node, cache=None):
     """
@@ -103,8 +123,230 @@ def deserialize(node, cache=None):
 
     return parse_value_element(node, cache=cache)
 
+def deserialize_envelope(node, lazy_fields, cache=None):
+    """
+    Deserialize a class instance, skipping some of its attributes. The
+    elements of the skipped attributes can be deserialized later using
+    :func:`deserialize` with the same cache.
+    
+    The skipped elements should be deserialized in order. Attributes that are
+    deserialized directly should not refer to objects inside skipped elements.
+    
+    Parameters
+    ----------
+    node : ElementTree Node
+        Root node of the instance to deserialize.
+    lazy_fields : dict
+        Names of the attributes to skip, by class.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    obj
+        Deserialized object. Skipped attributes keep the value set by the
+        constructor.
+    skipped : list of ElementTree Nodes
+        Elements of the skipped attributes. Empty if the node does not contain
+        a class instance.
+    """
+    if cache == None:
+        cache = {}
+
+    if node.get("type") != "instance" or node.get("stub") == "yes" or node.get("class") == None:
+        return parse_value_element(node, cache=cache), []
+
+    plan = get_serialization_plan(get_class_by_name(node.get("class")))
+    obj = plan.create(uuid.UUID(node.get("id")))
+    cache[obj.id] = obj
+
+    lazy = lazy_fields.get(plan.klass, ())
+    state = []
+    skipped = []
+    for element in node:
+        if element.tag in lazy:
+            skipped.append(element)
+        else:
+            state.append((element.tag, parse_value_element(element, cache=cache)))
+    plan.set_state(obj, state)
+    return obj, skipped
+
+def deserialize_string(string, cache=None):
+    """
+    Deserialize an XML document in a string, see :func:`deserialize_stream`.
+    
+    Parameters
+    ----------
+    string : string
+        The XML document.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    obj
+        Deserialized object.
+    """
+    return deserialize_stream(StringIO(string), cache)
+
+def deserialize_stream(source, cache=None):
+    """
+    Deserialize an XML document while it is being parsed.
+    
+    Objects are built from the parser events as soon as their element is
+    complete, no element tree is created. Only the objects currently being
+    built are kept in memory, not the whole document. The result is the same
+    as parsing the document and using :func:`deserialize`.
+    
+    Parameters
+    ----------
+    source : file like object
+        Stream to read the XML document from.
+    cache : dict
+        Dictionary to use as cache.
+
+    Returns
+    -------
+    obj
+        Deserialized object.
+    """
+    if cache == None:
+        cache = {}
+
+    parser = et.XMLParser(target=_StreamBuilder(cache))
+    while True:
+        data = source.read(stream_chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
+
+stream_chunk_size = 64 * 1024
+# Number of bytes deserialize_stream reads at once.
+
+_stream_composite_types = frozenset(["instance", "dict", "list", "tuple"])
+# Types of elements containing other elements.
+
+_dict_item = object()
+# Type given to the untyped item elements of a dictionary while streaming.
+
+class _StreamBuilder(object):
+    """
+    Parser target building the values for :func:`deserialize_stream`.
+    
+    Elements containing other elements get a :class:`_StreamFrame` on a stack
+    when they start. Other elements only contain text, their value is created
+    directly when they end.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._stack = []
+        self._leaf = None
+        self._text = []
+        self._value = None
+
+    def start(self, tag, attrib):
+        stack = self._stack
+        if self._leaf is not None:
+            # Not a value element after all
+            (leaf_tag, leaf_attrib) = self._leaf
+            self._leaf = None
+            stack.append(_StreamFrame(leaf_tag, leaf_attrib.get("type"), leaf_attrib, self._cache))
+
+        type_name = attrib.get("type")
+        if type_name in _stream_composite_types:
+            stack.append(_StreamFrame(tag, type_name, attrib, self._cache))
+        elif type_name == None and tag == "item" and stack and stack[-1].type_name == "dict":
+            stack.append(_StreamFrame(tag, _dict_item, attrib, self._cache))
+        else:
+            self._leaf = (tag, attrib)
+            self._text = []
+
+    def data(self, text):
+        self._text.append(text)
+
+    def end(self, tag):
+        stack = self._stack
+        if self._leaf is not None:
+            attrib = self._leaf[1]
+            self._leaf = None
+            text = "".join(self._text) or None
+            type_name = attrib.get("type")
+            if type_name == None or type_name == "NoneType":
+                if tag == "key" and stack and stack[-1].type_name is _dict_item:
+                    value = text or ""
+                else:
+                    value = None
+            elif type_name == "packed":
+                value = _unpack_text(text, attrib.get("kinds"), attrib.get("container"))
+            else:
+                ser = value_serializers_by_klass_name.get(type_name)
+                value = ser.deserialize(text) if ser is not None else None
+        else:
+            value = stack.pop().finish()
+
+        if stack:
+            stack[-1].children.append((tag, value))
+        else:
+            self._value = value
+
+    def close(self):
+        return self._value
 
-def serialize_dict(value, parent=None, tag_name="dict", cache=None):
+class _StreamFrame(object):
+    """
+    Value being built by :class:`_StreamBuilder` for an element containing
+    other elements. Instances are created and added to the cache when the
+    element starts, so references inside the instance resolve to it.
+    """
+
+    __slots__ = ("tag", "type_name", "obj", "plan", "children")
+
+    def __init__(self, tag, type_name, attrib, cache):
+        self.tag = tag
+        self.type_name = type_name
+        self.obj = None
+        self.plan = None
+        self.children = []
+
+        if type_name == "instance":
+            class_name = attrib.get("class")
+            if class_name == None:
+                return
+            obj_id = uuid.UUID(attrib.get("id"))
+
+            if attrib.get("stub") == "yes":
+                assert cache != None, "When stubs are present, cache is required."
+                self.obj = cache.get(obj_id)
+
+            if self.obj is None:
+                self.plan = get_serialization_plan(get_class_by_name(class_name))
+                self.obj = self.plan.create(obj_id)
+                if cache != None:
+                    cache[obj_id] = self.obj
+
+    def finish(self):
+        """
+        Complete the value now that all child elements have been read.
+        """
+        type_name = self.type_name
+        if type_name == "instance":
+            if self.plan is not None:
+                self.plan.set_state(self.obj, self.children)
+            return self.obj
+        if type_name == "list":
+            return [value for (_, value) in self.children]
+        if type_name == "tuple":
+            return tuple(value for (_, value) in self.children)
+        if type_name == "dict":
+            return dict(value for (tag, value) in self.children if tag == "item" and value[0] != None)
+        if type_name is _dict_item:
+            first = dict(reversed(self.children))
+            return (first.get("key"), first.get("value"))
+        return None
+
+def serialize_dict(value, parent=None, tag_name="dict", cache=None, pack_arrays=False):
     """
     Construct an XML representation of the given dictionary.
 
@@ -118,6 +360,8 @@ def serialize_dict(value, parent=None, tag_name="dict", cache=None):
         Name of the tag to enclose the object in.
     cache : dict
         Dictionary to use as cache.
+    pack_arrays : boolean
+        Pack sequences of numbers, see :func:`pack_sequence`.
     
     Returns
     -------
@@ -131,7 +375,7 @@ def serialize_dict(value, parent=None, tag_name="dict", cache=None):
 
         item_node = add_element("item", parent=dict_node)
         add_element("key", text=key, parent=item_node)
-        add_value_element(value, parent=item_node, tag_name="value", cache=cache)
+        add_value_element(value, parent=item_node, tag_name="value", cache=cache, pack_arrays=pack_arrays)
 
     return dict_node
 
@@ -166,9 +410,10 @@ def deserialize_dict(node, cache=None):
 
     return params
 
-def serialize_list_or_tuple(values, parent=None, tag_name="list", cache=None):
+def serialize_list_or_tuple(values, parent=None, tag_name="list", cache=None, pack_arrays=False):
     """
-    Serialize the contents of a list to xml.
+    Serialize the contents of a list to xml. If asked for and possible, the
+    contents are packed, see :func:`pack_sequence`.
 
     Parameters
     ----------
@@ -180,6 +425,8 @@ def serialize_list_or_tuple(values, parent=None, tag_name="list", cache=None):
         Name of the tag to enclose the object in.
     cache : dict
         Dictionary to use as cache.
+    pack_arrays : boolean
+        Pack sequences of numbers.
     
     Returns
     -------
@@ -191,9 +438,18 @@ def serialize_list_or_tuple(values, parent=None, tag_name="list", cache=None):
     if isinstance(values, tuple):
         type_name = "tuple"
 
+    if pack_arrays:
+        packed = pack_sequence(values)
+        if packed is not None:
+            (kinds, array) = packed
+            node = add_element(tag_name, base64.b64encode(array.astype(">f8").tostring()), parent, "packed")
+            node.set("container", type_name)
+            node.set("kinds", kinds)
+            return node
+
     node = add_element(tag_name, parent=parent, type_name=type_name)
     for value in values:
-        add_value_element(value, parent=node, tag_name="value", cache=cache)
+        add_value_element(value, parent=node, tag_name="value", cache=cache, pack_arrays=pack_arrays)
 
     return node
 
@@ -223,7 +479,117 @@ def deserialize_list_or_tuple(node, cache=None):
     else:
         return value
 
-def serialize_instance(obj=None, parent=None, tag_name="object", cache=None):
+def deserialize_packed(node, cache=None):
+    """
+    Parse an XML node containing a packed list or tuple.
+    
+    Parameters
+    ----------
+    node : ElementTree Node
+        Root node of the object to deserialize.
+    cache : dict
+        Not used, present for symmetry with the other functions.
+
+    Returns
+    -------
+    obj : list or tuple
+        Deserialized list or tuple of tuples.
+    """
+    return _unpack_text(node.text, node.get("kinds"), node.get("container"))
+
+def _unpack_text(text, kinds, container):
+    """
+    Unpack the base64 encoded text of a packed element.
+    """
+    array = numpy.frombuffer(base64.b64decode(text or ""), dtype=">f8").reshape(-1, len(kinds))
+    return unpack_sequence(kinds, array, tuple if container == "tuple" else list)
+
+packed_min_length = 8
+# Lists and tuples shorter than this are never packed.
+
+_max_packed_int = 2 ** 53
+# Larger ints cannot be stored exactly in a float.
+
+def pack_sequence(values):
+    """
+    Pack a list or tuple of equally long tuples of numbers into an array.
+    
+    Only done if unpacking results in exactly the same values: each position
+    in the tuples should contain only ints or only floats, optionally mixed
+    with None. None is stored as NaN, so NaN itself is not supported. Other
+    types, including bool and long, are not supported either.
+    
+    Parameters
+    ----------
+    values : list or tuple
+        Values to pack.
+    
+    Returns
+    -------
+    packed : tuple
+        Tuple of a string with the type of each column, "i" for int and "f"
+        for float, and an array of floats with one row per tuple. None if the
+        values cannot be packed.
+    """
+    if len(values) < packed_min_length:
+        return None
+    width = len(values[0]) if type(values[0]) is tuple else 0
+    if not width:
+        return None
+    for value in values:
+        if type(value) is not tuple or len(value) != width:
+            return None
+
+    kinds = []
+    none_counts = []
+    for column in zip(*values):
+        types = set(map(type, column))
+        types.discard(type(None))
+        if types == set([float]):
+            kinds.append("f")
+        elif types == set([int]) or not types:
+            ints = [value for value in column if value is not None]
+            if ints and (max(ints) > _max_packed_int or min(ints) < -_max_packed_int):
+                return None
+            kinds.append("i")
+        else:
+            return None
+        none_counts.append(column.count(None))
+
+    array = numpy.array(values, dtype=float)
+    if numpy.isnan(array).sum(axis=0).tolist() != none_counts:
+        return None
+    return "".join(kinds), array
+
+def unpack_sequence(kinds, array, container=list):
+    """
+    Restore the values packed by :func:`pack_sequence`.
+    
+    Parameters
+    ----------
+    kinds : string
+        Type of each column.
+    array : numpy array
+        The packed values, one row per tuple.
+    container : type
+        Type of sequence to return, list or tuple.
+    
+    Returns
+    -------
+    values : list or tuple
+        The unpacked tuples.
+    """
+    columns = []
+    for (kind, column) in zip(kinds, array.T):
+        values = column.tolist()
+        if kind == "i":
+            values = [None if value != value else int(value) for value in values]
+        elif numpy.isnan(column).any():
+            values = [None if value != value else value for value in values]
+        columns.append(values)
+    return container(zip(*columns))
+
+def serialize_instance(obj=None, parent=None, tag_name="object", cache=None, pack_arrays=False):
     """
     Create an XML representation of an object instance. All variables are stored in a
     parameter list. 
@@ -238,6 +604,8 @@ def serialize_instance(obj=None, parent=None, tag_name="object", cache=None):
         Name of the tag to enclose the object in.
     cache : dict
         Dictionary to use as cache.
+    pack_arrays : boolean
+        Pack sequences of numbers, see :func:`pack_sequence`.
     
     Returns
     -------
@@ -248,30 +616,24 @@ def serialize_instance(obj=None, parent=None, tag_name="object", cache=None):
 
     obj_node = add_element(tag_name, parent=parent, type_name="instance")
 
-    class_name = "%s.%s" % (obj.__class__.__module__, obj.__class__.__name__)
+    plan = get_serialization_plan(obj.__class__)
 
     if not hasattr(obj, "id"):
         obj.id = uuid.uuid4()
 
-    obj_node.set("class", class_name)
+    obj_node.set("class", plan.class_name)
     obj_node.set("id", obj.id.urn)
 
     if cache != None and obj.id in cache:
         obj_node.set("stub", "yes")
     else:
-        attributes = None
-        if hasattr(obj, "__serialize__"):
-            attributes = obj.__serialize__
-        else:
-            attributes = obj.__dict__
-
         if cache != None:
             cache[obj.id] = obj
-        for attr_name in attributes:
+        for (attr_name, value) in plan.get_state(obj):
             if attr_name == "id":
                 continue
                 
-            add_value_element(getattr(obj, attr_name, None), parent=obj_node, tag_name=attr_name, cache=cache)
+            add_value_element(value, parent=obj_node, tag_name=attr_name, cache=cache, pack_arrays=pack_arrays)
 
     return obj_node
 
@@ -305,22 +667,135 @@ def deserialize_instance(node, cache=None):
         obj = cache.get(obj_id)
 
     if obj == None:
-        klass = get_class_by_name(class_name)
-        obj = klass()
-        obj.id = obj_id
+        plan = get_serialization_plan(get_class_by_name(class_name))
+        obj = plan.create(obj_id)
 
         if cache != None:
             cache[obj_id] = obj
 
-        for element in node:
-            value = parse_value_element(element, cache=cache)
-            setattr(obj, element.tag, value)
+        plan.set_state(obj, [(element.tag, parse_value_element(element, cache=cache)) for element in node])
 
     return obj
 
+class SerializationPlan(object):
+    """
+    How to serialize instances of a single class. Inspecting a class for
+    ``__serialize__``, ``__getstate__`` and ``__setstate__`` is done once when
+    the plan is created, see :func:`get_serialization_plan`.
+    
+    Parameters
+    ----------
+    klass : type
+        Class the plan is for.
+    """
+
+    def __init__(self, klass):
+        self.klass = klass
+        self.class_name = "%s.%s" % (klass.__module__, klass.__name__)
+
+        self.fields = None
+        if hasattr(klass, "__serialize__"):
+            self.fields = tuple(klass.__serialize__)
+            self.get_state = self._get_fields
+        elif hasattr(klass, "__getstate__"):
+            self.get_state = self._get_state
+        else:
+            self.get_state = self._get_dict
+
+        if hasattr(klass, "__setstate__"):
+            self.set_state = self._set_state
+        else:
+            self.set_state = self._set_attributes
+
+    def create(self, obj_id):
+        """
+        Create an empty instance with the given id.
+        """
+        obj = self.klass()
+        obj.id = obj_id
+        return obj
+
+    def _get_fields(self, obj):
+        return [(attr_name, getattr(obj, attr_name, None)) for attr_name in self.fields]
+
+    def _get_state(self, obj):
+        return obj.__getstate__().items()
+
+    def _get_dict(self, obj):
+        return obj.__dict__.items()
+
+    def _set_state(self, obj, state):
+        state = dict(state)
+        state["id"] = obj.id
+        obj.__setstate__(state)
+
+    def _set_attributes(self, obj, state):
+        for (attr_name, value) in state:
+            setattr(obj, attr_name, value)
+
+_serialization_plans = {}
+# Plans by class, created on first use.
+
+_classes_by_name = {}
+# Classes resolved by get_class_by_name, by fully qualified name.
+
+def get_serialization_plan(klass):
+    """
+    Get the serialization plan for a class, creating it on first use.
+    
+    Parameters
+    ----------
+    klass : type
+        Class of the instances to serialize.
+    
+    Returns
+    -------
+    plan : :class:`SerializationPlan`
+        Plan for the class.
+    """
+    plan = _serialization_plans.get(klass)
+    if plan is None:
+        plan = _serialization_plans[klass] = SerializationPlan(klass)
+    return plan
+
+def get_instance_state(obj):
+    """
+    Get the attributes of an object instance to serialize.
+    
+    Uses the attribute names in ``__serialize__`` if present, otherwise the
+    dictionary returned by ``__getstate__`` if present, otherwise all
+    attributes of the instance.
+    
+    Parameters
+    ----------
+    obj
+        The object instance.
+    
+    Returns
+    -------
+    state : list of tuples
+        Tuples of attribute name and value.
+    """
+    return get_serialization_plan(obj.__class__).get_state(obj)
+
+def set_instance_state(obj, state):
+    """
+    Restore the attributes of a deserialized object instance. Uses
+    ``__setstate__`` if present, otherwise sets the attributes in order.
+    
+    Parameters
+    ----------
+    obj
+        The newly created object instance.
+    state : list of tuples
+        Tuples of attribute name and value.
+    """
+    get_serialization_plan(obj.__class__).set_state(obj, state)
+
 def get_class_by_name(class_name):
     """
-    Get a class using the fully qualified name.
+    Get a class using the fully qualified name. Classes are only imported
+    the first time they are asked for.
     
     Parameters
     ----------
@@ -332,12 +807,15 @@ def get_class_by_name(class_name):
     klass
         Class object matching the name.
     """
-    parts = class_name.split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
-    return m
+    klass = _classes_by_name.get(class_name)
+    if klass is None:
+        parts = class_name.split('.')
+        module = ".".join(parts[:-1])
+        klass = __import__( module )
+        for comp in parts[1:]:
+            klass = getattr(klass, comp)
+        _classes_by_name[class_name] = klass
+    return klass
 
 
 def add_element(tag_name, text=None, parent=None, type_name=None):
@@ -375,7 +853,7 @@ def add_element(tag_name, text=None, parent=None, type_name=None):
 
     return node
 
-def add_value_element(value, parent=None, tag_name="value", cache=None):
+def add_value_element(value, parent=None, tag_name="value", cache=None, pack_arrays=False):
     """
     Add a value inside an element. Use the correct way to serialize built-in
     types, library types or serializable types. 
@@ -390,42 +868,68 @@ def add_value_element(value, parent=None, tag_name="value", cache=None):
         Name of the tag the value is encapsulated in.
     cache : dict
         Dictionary to use as cache.
+    pack_arrays : boolean
+        Pack sequences of numbers, see :func:`pack_sequence`.
     
     Returns
     -------
     node : ElementTree Node
         The newly created node.
     """
-    
-    if isinstance(value, ignored_types):
-        print("Warning: value type cannot be serialized: %s. Ignoring value." % value.__class__)
-        return None
-    
-
-    if hasattr(value, "__serialize__"):
-
-        return serialize_instance(value, parent, tag_name, cache=cache)
+    writer = _element_writers.get(value.__class__)
+    if writer is None:
+        writer = _get_element_writer(value)
+    return writer(value, parent, tag_name, cache, pack_arrays)
 
+def _get_element_writer(value):
+    """
+    Find the function writing values of the same class as the given value to
+    XML and remember it for the class.
+    """
+    if isinstance(value, ignored_types):
+        writer = _ignore_element
+    elif hasattr(value, "__serialize__"):
+        writer = serialize_instance
     elif isinstance(value, dict):
-
-        return serialize_dict(parent=parent, value=value, tag_name=tag_name, cache=cache)
-        
+        writer = _serialize_dict_element
     elif isinstance(value, list) or isinstance(value, tuple):
-
-        return serialize_list_or_tuple(parent=parent, values=value, tag_name=tag_name, cache=cache)
-        
+        writer = _serialize_list_or_tuple_element
     elif value.__class__ in value_serializers_by_klass:
-        (string, type_name) = get_serialized_value(value)
+        writer = _value_element_writer(value_serializers_by_klass[value.__class__])
+    elif hasattr(value, "__dict__"):
+        writer = serialize_instance
+    else:
+        writer = _empty_element
 
-        return add_element(tag_name, string, parent, type_name)
+    _element_writers[value.__class__] = writer
+    return writer
 
-    elif hasattr(value, "__dict__"):
+def _ignore_element(value, parent, tag_name, cache, pack_arrays):
+    print("Warning: value type cannot be serialized: %s. Ignoring value." % value.__class__)
+    return None
 
-        return serialize_instance(value, parent, tag_name, cache=cache)
+def _serialize_dict_element(value, parent, tag_name, cache, pack_arrays):
+    return serialize_dict(parent=parent, value=value, tag_name=tag_name, cache=cache, pack_arrays=pack_arrays)
 
-    else:
+def _serialize_list_or_tuple_element(value, parent, tag_name, cache, pack_arrays):
+    return serialize_list_or_tuple(parent=parent, values=value, tag_name=tag_name, cache=cache,
+                                   pack_arrays=pack_arrays)
+
+def _empty_element(value, parent, tag_name, cache, pack_arrays):
+    return add_element(tag_name, None, parent, None)
+
+def _value_element_writer(ser):
+    """
+    Create a writer for values handled by a value serializer.
+    """
+    serialize_method = ser.serialize
+    type_name = ser.klass_name
+    def write(value, parent, tag_name, cache, pack_arrays):
+        return add_element(tag_name, serialize_method(value), parent, type_name)
+    return write
 
-        return add_element(tag_name, None, parent, None)
+_element_writers = {}
+# Functions writing values to XML by class of the value, see add_value_element.
 
 def parse_value_element(node, cache=None):
     """
@@ -446,14 +950,9 @@ def parse_value_element(node, cache=None):
     if type_name == None or type_name == "NoneType":
         return None
 
-    if type_name == "instance":
-        return deserialize_instance(node, cache=cache)
-
-    if type_name == "dict":
-        return deserialize_dict(node, cache=cache)
-
-    if type_name == "list" or type_name == "tuple":
-        return deserialize_list_or_tuple(node, cache=cache)
+    reader = _element_readers.get(type_name)
+    if reader is not None:
+        return reader(node, cache=cache)
 
     if not type_name in value_serializers_by_klass_name:
         return None
@@ -461,6 +960,13 @@ def parse_value_element(node, cache=None):
     ser = value_serializers_by_klass_name[type_name]
     return ser.deserialize(node.text)
 
+_element_readers = {"instance": deserialize_instance,
+                    "dict": deserialize_dict,
+                    "list": deserialize_list_or_tuple,
+                    "tuple": deserialize_list_or_tuple,
+                    "packed": deserialize_packed}
+# Readers for the composite types, by type name.
+
 
 value_serializers_by_klass = {}
 # Dictionary of registered value serializers by class. Key is the corresponding class object.
@@ -468,6 +974,10 @@ value_serializers_by_klass = {}
 value_serializers_by_klass_name = {}
 # Dictionary of registered value serializers by class name.
 
+writer_caches = [_element_writers]
+# Dictionaries of writers by class. Emptied when a value serializer is added,
+# as that may change how a class is written.
+
 
 def get_serialized_value(value):
     """
@@ -508,6 +1018,8 @@ def add_value_serializer(ser):
     """
     value_serializers_by_klass[ser.klass] = ser
     value_serializers_by_klass_name[ser.klass_name] = ser
+    for writers in writer_caches:
+        writers.clear()
 
 class ValueSerializer(object):
     """
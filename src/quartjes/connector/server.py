@@ -25,6 +25,18 @@ Both version of the stock exchange should work fine. But it might be necessary
 to clear the database when switching.
 """
 
+pricing_engine = None
+"""
+Name of the pricing engine used by the stock exchange, see
+:mod:`quartjes.controllers.pricing`. None to use the engine matching the
+version of the stock exchange.
+"""
+
+pricing_engine_parameters = {}
+"""
+Tuning parameters passed to the pricing engine.
+"""
+
 class ServerConnector(object):
     """
     Server side endpoint of the quartjes connector.
@@ -40,13 +52,22 @@ class ServerConnector(object):
     ----------
     port : int
         Port number to listen for connections on.
+    max_workers : int
+        Maximum number of threads handling requests from clients.
+    max_in_flight : int
+        Maximum number of requests from a single client handled at the same
+        time if `ordered` is False.
+    ordered : boolean
+        Handle the requests of each client one at a time, in the order they
+        were sent. Requests of different clients are handled in parallel.
     """
-    def __init__(self, port=None):
+    def __init__(self, port=None, max_workers=None, max_in_flight=None, ordered=True):
         if port:
             self.port = port
         else:
             self.port = default_port
-        self.factory = QuartjesServerFactory()
+        self.factory = QuartjesServerFactory(max_workers=max_workers, max_in_flight=max_in_flight,
+                                             ordered=ordered)
 
     def start(self):
         """
@@ -100,16 +121,21 @@ def run_server():
     from quartjes.controllers.stock_exchange import StockExchange
     from quartjes.controllers.stock_exchange2 import StockExchange2
     from quartjes.controllers.database import default_database
+    from quartjes.controllers.pricing import create_pricing_engine
     from quartjes.controllers.random_mixer import run_random_mixer
     from quartjes.controllers.mix_discounter import run_mix_discounter
     
     server = ServerConnector(default_port)
     print("Using stock exchange version %i" % stock_exchange_version)
+    engine = None
+    if pricing_engine:
+        print("Using pricing engine %s" % pricing_engine)
+        engine = create_pricing_engine(pricing_engine, **pricing_engine_parameters)
     if stock_exchange_version == 1:
-        exchange = StockExchange()
+        exchange = StockExchange(engine=engine)
         server.register_service(exchange, "stock_exchange")
     else:
-        exchange = StockExchange2()
+        exchange = StockExchange2(engine=engine)
         server.register_service(exchange, "stock_exchange")
     server.register_service(default_database(), "database")
     run_random_mixer()
@@ -11,6 +11,10 @@ each method that should be available remotely with :meth:`remote_method`.
 If the class contains any axel events, these can also be exposed. Define the
 event using :meth:`remote_event` instead of Event.
 
+Remote methods that only read the state of the service can also be decorated
+with :meth:`cacheable`. The server then keeps the serialized responses to
+these methods, until the state of the service changes.
+
 The service can now be registered with the :class:`ServerConnector 
 <quartjes.connector.server.ServerConnector>`. 
 During registration a service name is given, which remote clients must use to gain access to
@@ -27,6 +31,7 @@ import traceback
 from axel import Event
 
 from quartjes.connector.exceptions import MessageHandleError
+from quartjes.connector.messages import MethodCallMessage
 from quartjes.util.classtools import cached_class
 
 def remote_service(C):
@@ -47,16 +52,20 @@ def remote_service(C):
     
     methods = []
     events = []
+    cacheable_methods = []
     
     for name in dir(C):
         attr = getattr(C, name)
         if getattr(attr, "_remote_method", False):
             methods.append(name)
+            if getattr(attr, "_remote_cacheable", False):
+                cacheable_methods.append(name)
         if getattr(attr, "_remote_event", False):
             events.append(name)
     
     C._remote_methods = methods
     C._remote_events = events        
+    C._cacheable_methods = cacheable_methods
     
     return C
 
@@ -78,6 +87,65 @@ def remote_method(F):
     F._remote_method = True
     return F
 
+def cacheable(F):
+    """
+    Decorator for remote methods of which the server may cache the response.
+    Also requires the method to be decorated as :func:`remote_method`.
+    
+    The result of the method may only depend on the arguments and on the
+    state of the service. If that state can change, the service must have a
+    `cache_version` attribute that is changed on every change, after the
+    change is made. Responses cached for an older version are not used. See
+    :func:`get_cache_version`.
+    
+    Parameters
+    ----------
+    F : method
+        Method to decorate as cacheable.
+    
+    Returns
+    -------
+    F : method
+        The decorated method.
+    """
+    F._remote_cacheable = True
+    return F
+
+def is_cacheable(service, method_name):
+    """
+    Check whether the server may cache the response to a remote method.
+    
+    Parameters
+    ----------
+    service : class decorated as remote service
+        Service containing the method.
+    method_name : string
+        Name of the method.
+    
+    Returns
+    -------
+    cacheable : boolean
+        True if the method is decorated as :func:`cacheable`.
+    """
+    return method_name in getattr(service, "_cacheable_methods", ())
+
+def get_cache_version(service):
+    """
+    Get the version of the state of a service, used to invalidate cached
+    responses.
+    
+    Parameters
+    ----------
+    service : class decorated as remote service
+        The service.
+    
+    Returns
+    -------
+    version
+        The `cache_version` attribute of the service, or None if it has none.
+    """
+    return getattr(service, "cache_version", None)
+
 def remote_event(*args, **kwargs):
     """
     Generate an event that should be exposed through a remote service.
@@ -264,8 +332,13 @@ class RemoteEventRegistry(object):
         **kwargs
             Keyword arguments for the event.
         """
+        # Group the listeners so each factory only has to serialize the event once
+        groups = {}
         for (service_name, listener, factory) in self._events[event_name]:
-            factory.send_event(service_name, event_name, listener, *pargs, **kwargs)
+            groups.setdefault((service_name, factory), []).append(listener)
+
+        for ((service_name, factory), listeners) in groups.items():
+            factory.broadcast_event(service_name, event_name, listeners, *pargs, **kwargs)
         
     def _create_event_listener(self, event_name):
         """
@@ -333,7 +406,7 @@ class ServiceInterface(object):
         remote method from being overwritten by mistake.
         """
         if name.startswith("_") or isinstance(value, ServiceInterfaceAttribute):
-            self.__dict__[name] = value
+            object.__setattr__(self, name, value)
         else:
             raise AttributeError("Do not assign values to ServiceInterface objects.")
     
@@ -371,14 +444,29 @@ class ServiceInterface(object):
         try:
             return self._client_factory.send_method_call(self._service_name, name, *pargs, **kwargs)
         except MessageHandleError as err:
-            if err.error_code == MessageHandleError.RESULT_UNKNOWN_METHOD:
-                raise AttributeError("Method %s does not exist in service %s." % (name, self._service_name))
-            elif err.error_code == err.RESULT_INVALID_PARAMS:
-                raise TypeError(err.error_details)
-            elif err.error_code == err.RESULT_EXCEPTION_RAISED:
-                raise err.error_details
-            else:
+            translated = translate_remote_error(err, self._service_name, name)
+            if translated is err:
                 raise
+            raise translated
+
+    def batch(self):
+        """
+        Collect method calls to send them to the server in a single message.
+        Use the returned object as a context manager and call the methods on
+        it. The calls are sent when the block ends.
+        
+        >>> with stock_exchange.batch() as batch:
+        ...     results = [batch.sell(drink, 1) for drink in round_of_drinks]
+        >>> prices = [result.wait() for result in results]
+        
+        Note that this hides any remote method called "batch".
+        
+        Returns
+        -------
+        batch : :class:`ServiceBatch`
+            Object collecting the method calls.
+        """
+        return ServiceBatch(self._client_factory, self._service_name)
 
     def _do_subscribe(self, name, handler):
         """
@@ -431,6 +519,174 @@ class ServiceInterface(object):
     
     del operator_handler
 
+class AsyncServiceInterface(ServiceInterface):
+    """
+    Client side interface to a service that does not wait for the results of
+    method calls. Each call immediately returns a
+    :class:`quartjes.connector.protocol.PendingResult`, so many calls can be
+    waiting for the server at the same time.
+    
+    The errors a :class:`ServiceInterface` raises are raised when waiting for
+    the result instead. Subscribing to events still blocks until the server
+    confirms the subscription.
+    
+    Parameters
+    ----------
+    client_factory : :class:`quartjes.connector.protocol.QuartjesClientFactory`
+        Factory handling connections to the server.
+    service_name : string
+        Name of the service to provide an interface to.
+    """
+
+    def _do_remote_call(self, name, *pargs, **kwargs):
+        """
+        Start the remote method call.
+        
+        Parameters
+        ----------
+        name
+            Name of the remote method to call.
+        *pargs
+            Positional arguments for the method.
+        **kwargs
+            Keyword arguments for the method.
+        
+        Returns
+        -------
+        result : :class:`quartjes.connector.protocol.PendingResult`
+            Will contain the result returned from the server method.
+        """
+        msg = MethodCallMessage(service_name=self._service_name, method_name=name, pargs=pargs, kwargs=kwargs)
+        return self._client_factory.send_message_async(
+                msg, lambda err: translate_remote_error(err, self._service_name, name))
+
+    def _do_subscribe(self, name, handler):
+        """
+        Subscribe using the blocking interface, so both interfaces share the
+        event callbacks.
+        """
+        ServiceInterface(self._client_factory, self._service_name)._do_subscribe(name, handler)
+
+
+class ServiceBatch(object):
+    """
+    Collects method calls on a service so they can be sent to the server in
+    a single :class:`quartjes.connector.messages.BatchCallMessage`. Each call
+    immediately returns a :class:`quartjes.connector.protocol.PendingResult`
+    that is completed once the server has responded to the batch.
+    
+    Normally used as a context manager, see :meth:`ServiceInterface.batch`.
+    
+    Parameters
+    ----------
+    client_factory : :class:`quartjes.connector.protocol.QuartjesClientFactory`
+        Factory handling connections to the server.
+    service_name : string
+        Name of the service to call methods on.
+    """
+
+    def __init__(self, client_factory, service_name):
+        self._client_factory = client_factory
+        self._service_name = service_name
+        self._calls = []
+        self._results = []
+        self._sent = False
+
+    def __getattr__(self, name):
+        """
+        Return a proxy recording calls to the method.
+        """
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return ServiceInterfaceAttribute(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+        else:
+            self.cancel(exc_value)
+        return False
+
+    def _do_remote_call(self, name, *pargs, **kwargs):
+        """
+        Record a method call.
+        
+        Returns
+        -------
+        result : :class:`quartjes.connector.protocol.PendingResult`
+            Will contain the result returned from the server method.
+        """
+        assert not self._sent, "Batch has already been sent."
+        from quartjes.connector.protocol import PendingResult
+        self._calls.append(MethodCallMessage(service_name=self._service_name, method_name=name,
+                                             pargs=pargs, kwargs=kwargs))
+        result = PendingResult(lambda err: translate_remote_error(err, self._service_name, name))
+        self._results.append(result)
+        return result
+
+    def send(self):
+        """
+        Send the recorded method calls to the server. Called automatically at
+        the end of the with block.
+        """
+        assert not self._sent, "Batch has already been sent."
+        self._sent = True
+        if self._calls:
+            self._client_factory.send_batch_async(self._calls, self._results)
+
+    def cancel(self, error=None):
+        """
+        Do not send the recorded method calls. Their pending results are
+        completed with the given error. Called automatically if the with
+        block raises an exception.
+        
+        Parameters
+        ----------
+        error : Exception
+            Error for the pending results. Defaults to a RuntimeError.
+        """
+        assert not self._sent, "Batch has already been sent."
+        self._sent = True
+        if error is None:
+            error = RuntimeError("Batch was not sent.")
+        for result in self._results:
+            result._set_error(error)
+
+
+def translate_remote_error(err, service_name, method_name):
+    """
+    Translate an error returned by the server for a method call into the
+    exception the method call should raise at the client side.
+    
+    Parameters
+    ----------
+    err : Exception
+        The error received.
+    service_name : string
+        Name of the service called.
+    method_name : string
+        Name of the method called.
+    
+    Returns
+    -------
+    err : Exception
+        The exception to raise. The original error if it does not need
+        translation.
+    """
+    if not isinstance(err, MessageHandleError):
+        return err
+    if err.error_code == MessageHandleError.RESULT_UNKNOWN_METHOD:
+        return AttributeError("Method %s does not exist in service %s." % (method_name, service_name))
+    elif err.error_code == err.RESULT_INVALID_PARAMS:
+        return TypeError(err.error_details)
+    elif err.error_code == err.RESULT_EXCEPTION_RAISED:
+        return err.error_details
+    return err
+
+
 class ServiceInterfaceAttribute(object):
     """
     Special proxy object that acts as either a callable method or an event.
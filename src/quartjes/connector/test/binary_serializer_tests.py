@@ -0,0 +1,101 @@
+"""
+Test cases for the quartjes.connector.binary_serializer module.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import unittest
+import uuid
+from quartjes.connector.binary_serializer import serialize, deserialize, is_binary, read_value, skip_value
+from quartjes.connector.binary_serializer import MAGIC
+from quartjes.connector.test.serializer_tests import TestKlassOld, TestKlassNew, TestKlassOverride
+from quartjes.connector.test.serializer_tests import TestQuartjesKlass
+
+class BinarySerializerTestCase(unittest.TestCase):
+    """
+    Test serializing and deserializing using the binary serializer.
+
+    Methods
+    -------
+    test_round_trip
+    test_override
+    test_ignored_values
+    test_cache_references
+    test_skip_value
+    test_not_binary
+    """
+
+    def setUp(self):
+        """
+        Prepare some test cases.
+        """
+        self.test_cases = [12, -2 ** 40, 2 ** 80, 1234.23, "testsdfda@#nfasnalsk32", u"caf\xe9",
+                           uuid.UUID('urn:uuid:3f22b1ff-424d-468c-aa47-b399a6fd1795'),
+                           True, False, None, [12, 1234.23, "bladfsd"], (12, 1234.23, "bladfsd"),
+                           {"a": 1, "b": [1, (2, 3)]}, [], (),
+                           [(i, i * 0.5, None) for i in range(10)], tuple((1.0, i) for i in range(10)),
+                           TestKlassOld(), TestKlassNew(), TestQuartjesKlass()]
+
+    def test_round_trip(self):
+        """
+        Serialize and deserialize each test case.
+        """
+        for value in self.test_cases:
+            string = serialize(value)
+            self.assertTrue(is_binary(string), "Output should be recognized as binary")
+            result = deserialize(string)
+            self.assertEqual(result, value, "Round trip failed for %r" % (value,))
+            self.assertEqual(type(result), type(value), "Type changed for %r" % (value,))
+
+    def test_override(self):
+        """
+        Only attributes in __serialize__ should be transferred.
+        """
+        obj = TestKlassOverride()
+        obj.s = "changed"
+        result = deserialize(serialize(obj))
+        self.assertEqual(result, obj)
+        self.assertEqual(result.s, "teststring", "Attribute not in __serialize__ should not be sent")
+        self.assertEqual(result.id, obj.id, "Id should be preserved")
+
+    def test_ignored_values(self):
+        """
+        Values that cannot be serialized are left out, like the XML serializer does.
+        """
+        def func():
+            pass
+        result = deserialize(serialize([1, func, 2]))
+        self.assertEqual(result, [1, 2])
+
+    def test_cache_references(self):
+        """
+        The same object present twice should only be serialized once.
+        """
+        obj = TestKlassNew()
+        string = serialize([obj, obj])
+        single = serialize([obj])
+        self.assertLess(len(string) - len(single), len(single) / 2, "Second occurrence should be a reference")
+
+        result = deserialize(string)
+        self.assertIs(result[0], result[1], "References should resolve to the same object")
+
+    def test_skip_value(self):
+        """
+        Skipping a value should end at the same position as reading it.
+        """
+        for value in self.test_cases:
+            string = serialize(value)
+            (_, end) = read_value(string, len(MAGIC), {})
+            self.assertEqual(skip_value(string, len(MAGIC)), end)
+            self.assertEqual(end, len(string))
+
+    def test_not_binary(self):
+        """
+        XML input should be rejected.
+        """
+        with self.assertRaises(ValueError):
+            deserialize("<test type=\"int\">12</test>")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@ Created on Jul 7, 2012
 import unittest
 from quartjes.connector.client import ClientConnector
 from quartjes.connector.exceptions import TimeoutError
+from quartjes.connector.messages import XML_CODEC, BINARY_CODEC
 
 test_port = 3421
 
@@ -16,7 +17,9 @@ class ClientServerTest(unittest.TestCase):
         """
         Prepare a server
         """
+        import time
         start_test_server()
+        time.sleep(1)
 
     def testClientServer(self):
         """
@@ -73,6 +76,123 @@ class ClientServerTest(unittest.TestCase):
     
         cl.stop()
     
+    def testCodecNegotiation(self):
+        """
+        Check that the codec is negotiated during the handshake.
+        """
+        import time
+
+        for (codecs, expected) in ((None, BINARY_CODEC), ((XML_CODEC,), XML_CODEC)):
+            cl = ClientConnector("localhost", test_port, codecs=codecs)
+            cl.start()
+            self.assertTrue(cl.is_connected(), "Connection failed.")
+            time.sleep(1)
+            self.assertEqual(cl.factory.codec, expected, "Unexpected codec selected.")
+
+            testService = cl.get_service_interface("test")
+            result = testService.test(text="Spam")
+            self.assertEqual(result, "Spam", "Expecting same message back.")
+            cl.stop()
+
+    def testAsyncCalls(self):
+        """
+        Check that asynchronous calls can be in progress at the same time.
+        """
+        cl = ClientConnector("localhost", test_port)
+        cl.start()
+        self.assertTrue(cl.is_connected(), "Connection failed.")
+
+        testService = cl.get_async_service_interface("test")
+        pending = [testService.test(i) for i in range(50)]
+        self.assertEqual([result.wait() for result in pending], range(50),
+                         "Expecting all results in order.")
+
+        self.assertEqual(testService.test("Spam").wait(), "Spam", "Expecting same message back.")
+        with self.assertRaises(AttributeError):
+            testService.does_not_exist().wait()
+
+        cl.stop()
+
+    def testBatchCalls(self):
+        """
+        Check that batched calls return results and errors per call.
+        """
+        cl = ClientConnector("localhost", test_port)
+        cl.start()
+        self.assertTrue(cl.is_connected(), "Connection failed.")
+
+        testService = cl.get_service_interface("test")
+        with testService.batch() as batch:
+            results = [batch.test("Spam"), batch.does_not_exist(), batch.test("Eggs")]
+
+        self.assertEqual(results[0].wait(), "Spam", "Expecting same message back.")
+        with self.assertRaises(AttributeError):
+            results[1].wait()
+        self.assertEqual(results[2].wait(), "Eggs", "Expecting same message back.")
+
+        cl.stop()
+
+    def testEventOrder(self):
+        """
+        Callbacks of an event should be called in the order the events were sent.
+        """
+        import time
+
+        def callback(text):
+            time.sleep(0.01)
+            received.append(text)
+        received = []
+
+        cl = ClientConnector("localhost", test_port)
+        cl.start()
+        self.assertTrue(cl.is_connected(), "Connection failed.")
+
+        testService = cl.get_service_interface("test")
+        testService.on_trigger += callback
+        for i in range(20):
+            testService.trigger(text=str(i))
+        time.sleep(1)
+        self.assertEqual(received, ["Callback: %d" % i for i in range(20)])
+
+        cl.stop()
+
+    def testCancelledBatch(self):
+        """
+        Calls of a batch that is not sent should fail instead of waiting forever.
+        """
+        cl = ClientConnector("localhost", test_port)
+        cl.start()
+        self.assertTrue(cl.is_connected(), "Connection failed.")
+
+        testService = cl.get_service_interface("test")
+        with self.assertRaises(ValueError):
+            with testService.batch() as batch:
+                result = batch.test("Spam")
+                raise ValueError("Stop")
+        with self.assertRaises(ValueError):
+            result.wait(1)
+
+        cl.stop()
+
+    def testBatchCallsOldServer(self):
+        """
+        Batched calls should be sent one by one to servers not supporting batches.
+        """
+        cl = ClientConnector("localhost", test_port)
+        cl.start()
+        self.assertTrue(cl.is_connected(), "Connection failed.")
+        cl.factory._server_supports_batches = False
+
+        testService = cl.get_service_interface("test")
+        with testService.batch() as batch:
+            results = [batch.test("Spam"), batch.does_not_exist()]
+
+        self.assertEqual(results[0].wait(), "Spam", "Expecting same message back.")
+        with self.assertRaises(AttributeError):
+            results[1].wait()
+
+        cl.stop()
+
     @classmethod
     def tearDownClass(cls):
         """
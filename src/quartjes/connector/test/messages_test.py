@@ -8,6 +8,10 @@ __docformat__ = "restructuredtext en"
 import unittest
 
 from quartjes.connector.messages import MethodCallMessage, create_message_string, parse_message_string
+from quartjes.connector.messages import BatchCallMessage, EventMessage, parse_message_envelope
+from quartjes.connector.messages import BINARY_CODEC, XML_CODEC, XML_PACKED_CODEC, detect_message_codec
+from quartjes.connector.messages import xml_streaming_threshold, PreparedResponse
+from quartjes.connector.messages import ZLIB_COMPRESSION, compress_message_string, compression_threshold
 from quartjes.models.drink import Drink
 
 class TestMessages(unittest.TestCase):
@@ -19,6 +23,11 @@ class TestMessages(unittest.TestCase):
     setUp
     test_equality
     test_create_and_parse
+    test_create_and_parse_binary
+    test_compression
+    test_large_xml
+    test_envelope
+    test_batch
     """
 
     def setUp(self):
@@ -50,5 +59,88 @@ class TestMessages(unittest.TestCase):
         result = parse_message_string(string)
         self.assertEqual(self.message, result)
 
+    def test_create_and_parse_binary(self):
+        """
+        Test whether a message survives the binary codec and whether the codec is detected.
+        """
+        string = create_message_string(self.message, BINARY_CODEC)
+        self.assertEqual(detect_message_codec(string).name, BINARY_CODEC)
+        self.assertEqual(detect_message_codec(create_message_string(self.message)).name, XML_CODEC)
+
+        result = parse_message_string(string)
+        self.assertEqual(self.message, result)
+
+    def test_compression(self):
+        """
+        Test whether large messages are compressed and small ones are left alone.
+        """
+        small = create_message_string(MethodCallMessage("a", "b"))
+        self.assertLess(len(small), compression_threshold)
+        self.assertEqual(compress_message_string(small, ZLIB_COMPRESSION), small)
+
+        self.message.pargs = [Drink("drink %d" % i) for i in range(50)]
+        for codec in (XML_CODEC, BINARY_CODEC):
+            string = create_message_string(self.message, codec)
+            compressed = compress_message_string(string, ZLIB_COMPRESSION)
+            self.assertLess(len(compressed), len(string))
+            self.assertEqual(compress_message_string(string, None), string)
+
+            result = parse_message_string(compressed)
+            self.assertEqual(self.message, result)
+
+    def test_large_xml(self):
+        """
+        Test whether large XML messages, which are parsed while streaming,
+        survive both XML codecs.
+        """
+        self.message.pargs = [Drink("drink %d" % i) for i in range(1000)]
+        for codec in (XML_CODEC, XML_PACKED_CODEC):
+            string = create_message_string(self.message, codec)
+            self.assertGreaterEqual(len(string), xml_streaming_threshold)
+            self.assertEqual(self.message, parse_message_string(string))
+
+    def test_envelope(self):
+        """
+        Test whether only the header of events is parsed until they are loaded.
+        """
+        event = EventMessage("database", "on_drinks_updated", [self.drink], {"drink": self.drink})
+        for codec in (XML_CODEC, XML_PACKED_CODEC, BINARY_CODEC):
+            envelope = parse_message_envelope(create_message_string(event, codec))
+            self.assertFalse(envelope.loaded)
+            self.assertEqual(envelope.header.event_name, "on_drinks_updated")
+            self.assertIsNone(envelope.header.pargs)
+
+            result = envelope.load()
+            self.assertTrue(envelope.loaded)
+            self.assertEqual(event, result)
+            self.assertIs(result.pargs[0], result.kwargs["drink"])
+
+            envelope = parse_message_envelope(create_message_string(self.message, codec))
+            self.assertTrue(envelope.loaded)
+            self.assertEqual(self.message, envelope.load())
+
+    def test_prepared_response(self):
+        """
+        Test whether a prepared response can be sent to different requests.
+        """
+        for codec in (XML_CODEC, XML_PACKED_CODEC, BINARY_CODEC):
+            prepared = PreparedResponse([self.drink, 2], codec)
+            first = parse_message_string(prepared.create(self.message.id))
+            second = parse_message_string(prepared.create(self.drink.id))
+            self.assertEqual(first.response_to, self.message.id)
+            self.assertEqual(second.response_to, self.drink.id)
+            self.assertNotEqual(first.id, second.id)
+            self.assertEqual(first.result, [self.drink, 2])
+            self.assertEqual(second.result, first.result)
+
+    def test_batch(self):
+        """
+        Test whether a batch of method calls survives both codecs.
+        """
+        batch = BatchCallMessage([self.message, MethodCallMessage("a", "b", [1], {})])
+        for codec in (XML_CODEC, BINARY_CODEC):
+            result = parse_message_string(create_message_string(batch, codec))
+            self.assertEqual(batch, result)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,164 @@
+"""
+Test cases for the message scheduling of the server protocol factory.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import unittest
+from twisted.test.proto_helpers import StringTransport
+from quartjes.connector.messages import MethodCallMessage, create_message_string, BINARY_CODEC
+from quartjes.connector.protocol import QuartjesServerFactory
+from quartjes.connector.services import remote_service, remote_method, cacheable
+
+class ServerQueueTest(unittest.TestCase):
+    """
+    Test limiting the messages in flight and pausing the transport. The worker
+    pool is never started, so messages handed to it stay in flight.
+    """
+
+    def setUp(self):
+        self.factory = QuartjesServerFactory(max_in_flight=2, ordered=False, high_water=4, low_water=1)
+        self.protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.queue = self.factory._queues[self.protocol.id]
+
+    def test_in_flight_limit(self):
+        """
+        No more than max_in_flight messages should be handed to the workers.
+        """
+        for _ in range(3):
+            self.factory._r_on_incoming_message("message", self.protocol)
+        self.assertEqual(self.queue.in_flight, 2)
+        self.assertEqual(len(self.queue.waiting), 1)
+
+        self.factory._r_message_done(None, self.queue)
+        self.assertEqual(self.queue.in_flight, 2)
+        self.assertEqual(len(self.queue.waiting), 0)
+
+    def test_pause_and_resume(self):
+        """
+        Reading should pause at the high water mark and resume at the low water mark.
+        """
+        for _ in range(6):
+            self.factory._r_on_incoming_message("message", self.protocol)
+        self.assertTrue(self.queue.paused)
+        self.assertEqual(self.transport.producerState, "paused")
+
+        self.factory._r_message_done(None, self.queue)
+        self.factory._r_message_done(None, self.queue)
+        self.assertTrue(self.queue.paused, "Should stay paused above the low water mark")
+
+        self.factory._r_message_done(None, self.queue)
+        self.assertFalse(self.queue.paused)
+        self.assertEqual(self.transport.producerState, "producing")
+
+    def test_ordered(self):
+        """
+        In ordered mode a message should only start after the previous one is done.
+        """
+        factory = QuartjesServerFactory()
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        queue = factory._queues[protocol.id]
+
+        for _ in range(3):
+            factory._r_on_incoming_message("message", protocol)
+        self.assertEqual(queue.in_flight, 1)
+        self.assertEqual(len(queue.waiting), 2)
+
+        factory._r_message_done(None, queue)
+        self.assertEqual(queue.in_flight, 1)
+        self.assertEqual(len(queue.waiting), 1)
+
+    def test_connection_lost(self):
+        """
+        Messages arriving after the connection is lost should be ignored.
+        """
+        self.protocol.connectionLost(None)
+        self.factory._r_on_incoming_message("message", self.protocol)
+        self.assertNotIn(self.protocol.id, self.factory._queues)
+
+@remote_service
+class CountingService(object):
+    """
+    Service counting the calls of its methods.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.value = "first"
+        self.cache_version = 0
+
+    @remote_method
+    @cacheable
+    def get_value(self, suffix=""):
+        self.calls += 1
+        return self.value + suffix
+
+    @remote_method
+    def get_uncached(self):
+        self.calls += 1
+        return self.value
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """
+    Test caching the responses to cacheable remote methods.
+    """
+
+    def setUp(self):
+        self.factory = QuartjesServerFactory(response_cache_size=2)
+        self.service = CountingService()
+        self.factory.register_service(self.service, "counting")
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(StringTransport())
+
+    def call(self, method_name, *pargs):
+        msg = MethodCallMessage("counting", method_name, pargs, {})
+        result = self.factory._parse_message(create_message_string(msg, self.protocol.codec), self.protocol)
+        response = self.protocol.parse_message_string(result.response)
+        self.assertEqual(response.response_to, msg.id)
+        return response.result
+
+    def test_cached(self):
+        """
+        Repeated calls should only call the method once per version.
+        """
+        for codec in (self.protocol.codec, BINARY_CODEC):
+            self.protocol.codec = codec
+            self.assertEqual(self.call("get_value"), "first")
+            self.assertEqual(self.call("get_value"), "first")
+        self.assertEqual(self.service.calls, 2, "Responses are cached per codec")
+
+        self.service.value = "second"
+        self.assertEqual(self.call("get_value"), "first")
+        self.service.cache_version += 1
+        self.assertEqual(self.call("get_value"), "second")
+        self.assertEqual(self.service.calls, 3)
+
+    def test_arguments(self):
+        """
+        Calls with different arguments should be cached separately.
+        """
+        self.assertEqual(self.call("get_value", "a"), "firsta")
+        self.assertEqual(self.call("get_value", "b"), "firstb")
+        self.assertEqual(self.call("get_value", "a"), "firsta")
+        self.assertEqual(self.service.calls, 2)
+
+        self.call("get_value", "c")
+        self.assertEqual(len(self.factory._response_cache), 2)
+        self.call("get_value", "b")
+        self.assertEqual(self.service.calls, 4, "Least recently used response should be dropped")
+
+    def test_not_cacheable(self):
+        """
+        Methods not decorated as cacheable should be called every time.
+        """
+        self.call("get_uncached")
+        self.call("get_uncached")
+        self.assertEqual(self.service.calls, 2)
+
+if __name__ == "__main__":
+    unittest.main()
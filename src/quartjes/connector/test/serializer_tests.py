@@ -186,6 +186,132 @@ class TestKlassOverride(object):
     def __eq__(self, other):
         return (self.i == other.i and self.l == other.l)
 
+class SerializationPlanTestCase(unittest.TestCase):
+    """
+    Test the caching of class information.
+    
+    Methods
+    -------
+    test_plan
+    test_class_by_name
+    test_add_value_serializer
+    """
+
+    def test_plan(self):
+        """
+        Each class should get a single plan using its fields.
+        """
+        plan = serializer.get_serialization_plan(TestKlassOverride)
+        self.assertIs(serializer.get_serialization_plan(TestKlassOverride), plan)
+        self.assertEqual(plan.class_name, "quartjes.connector.test.serializer_tests.TestKlassOverride")
+        self.assertEqual(plan.get_state(TestKlassOverride()), [("i", 43432), ("l", [23, 543, "sds"])])
+
+        obj = serializer.get_serialization_plan(TestKlassNew).create(uuid.uuid4())
+        serializer.set_instance_state(obj, [("i", 1)])
+        self.assertEqual(obj.i, 1)
+
+    def test_class_by_name(self):
+        """
+        Classes should be resolved once by name.
+        """
+        name = "quartjes.connector.test.serializer_tests.TestKlassNew"
+        self.assertIs(serializer.get_class_by_name(name), TestKlassNew)
+        self.assertIs(serializer._classes_by_name[name], TestKlassNew)
+
+    def test_add_value_serializer(self):
+        """
+        Adding a value serializer should change how an already written class
+        is written.
+        """
+        class Temperature(object):
+            def __init__(self, degrees=0.0):
+                self.degrees = degrees
+
+        self.assertEqual(serialize(Temperature(20.0)).get("type"), "instance")
+
+        ser = serializer.ValueSerializer(Temperature, lambda x: repr(x.degrees),
+                                         lambda x: Temperature(float(x)), klass_name="temperature")
+        serializer.add_value_serializer(ser)
+        try:
+            node = serialize(Temperature(20.0))
+            self.assertEqual(node.get("type"), "temperature")
+            self.assertEqual(deserialize(node).degrees, 20.0)
+        finally:
+            del serializer.value_serializers_by_klass[Temperature]
+            del serializer.value_serializers_by_klass_name["temperature"]
+            for writers in serializer.writer_caches:
+                writers.clear()
+
+class PackedSequenceTestCase(unittest.TestCase):
+    """
+    Test packing sequences of numbers.
+    
+    Methods
+    -------
+    test_round_trip
+    test_not_packed
+    """
+
+    def test_round_trip(self):
+        """
+        Packed sequences should unpack to the same values and types.
+        """
+        values = [(i, i * 0.5, None if i % 3 else 2.5) for i in range(10)]
+        (kinds, array) = serializer.pack_sequence(values)
+        self.assertEqual(kinds, "iff")
+        self.assertEqual(array.shape, (10, 3))
+        self.assertEqual(serializer.unpack_sequence(kinds, array), values)
+        self.assertIsInstance(serializer.unpack_sequence(kinds, array)[0][0], int)
+
+        node = serialize(tuple(values), tag_name="test", pack_arrays=True)
+        self.assertEqual(node.get("type"), "packed")
+        self.assertEqual(deserialize(serializer.et.fromstring(serializer.et.tostring(node))), tuple(values))
+        self.assertEqual(serialize(values, tag_name="test").get("type"), "list")
+
+    def test_not_packed(self):
+        """
+        Sequences that would not unpack to the same values should not be packed.
+        """
+        rows = [(i, float(i)) for i in range(10)]
+        for values in (rows[:5], rows[:9] + [(1, 2.0, 3.0)], rows[:9] + [(1.0, 2.0)],
+                       rows[:9] + [(True, 2.0)], rows[:9] + [(1, float("nan"))],
+                       rows[:9] + [(2 ** 60, 2.0)], rows[:9] + [[1, 2.0]], [i for i in range(10)]):
+            self.assertIsNone(serializer.pack_sequence(values))
+
+class StreamDeserializerTestCase(unittest.TestCase):
+    """
+    Test deserializing while parsing.
+    
+    Methods
+    -------
+    test_same_as_tree
+    test_references
+    """
+
+    def test_same_as_tree(self):
+        """
+        Streaming should give the same values as deserializing the parsed tree.
+        """
+        values = [12, "abc", None, [1, (2.5, "x")], {"a": 1, "b": {"c": [None]}, "": 3}, {},
+                  TestKlassOld(), TestKlassNew(), TestQuartjesKlass(), TestKlassOverride(),
+                  [(i, i * 0.5) for i in range(10)]]
+        for value in values:
+            for pack_arrays in (False, True):
+                string = serializer.et.tostring(serialize(value, tag_name="test", pack_arrays=pack_arrays))
+                self.assertEqual(serializer.deserialize_string(string),
+                                 deserialize(serializer.et.fromstring(string)))
+                self.assertEqual(serializer.deserialize_string(string), value)
+
+    def test_references(self):
+        """
+        Objects present more than once should be the same instance.
+        """
+        obj = TestKlassNew()
+        obj.self = obj
+        result = serializer.deserialize_string(serializer.et.tostring(serialize([obj, obj])))
+        self.assertIs(result[0], result[1])
+        self.assertIs(result[0].self, result[0])
+
 serializer_test_cases = [SerializerTestCase(
                              name="int",
                              input_=12,
@@ -252,6 +378,9 @@ def load_tests(loader, *_):
     
     suite = unittest.TestSuite()
     suite.addTests(loader.loadTestsFromTestCase(ValueSerializerTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(SerializationPlanTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(PackedSequenceTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(StreamDeserializerTestCase))
     suite.addTests(serializer_test_cases)
     return suite
 
@@ -1,38 +1,101 @@
 """
 The 'database' used by the Quartjesavond server. 
-Just a simple memory store of drinks that uses shelve to constantly write
-a copy to disk.
+Just a simple memory store of drinks. Changes are appended to a journal on
+disk, and every now and then a complete copy is written using shelve.
 """
-import os
+import cPickle as pickle
 import shelve
-import time
 import threading
+import time
+import uuid
+import whichdb
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from quartjes.models.drink import Drink, Mix, __version__
-from quartjes.connector.services import remote_event, remote_method, remote_service
+from quartjes.models.delta import DrinksDelta, take_snapshot, diff_drink
+from quartjes.controllers.journal import Journal, dump_record
+from quartjes.connector.services import cacheable, remote_event, remote_method, remote_service
 
 debug_mode = False
 
+lock_stripes = 16
+"""
+Number of locks protecting the drinks. Each drink is protected by one of the
+locks based on its id.
+"""
+
+journal_compact_size = 1024 * 1024
+"""
+Size in bytes the journal can grow to before a new copy of the database is
+written and the journal is emptied.
+"""
+
 @remote_service
 class Database:
     """
     Very basic database containing all drinks for Quartjesavond.
     
     When constructed, it will try to load the file 'database' from the current
-    working directory. If the file does not exist, a new default database
-    containing default drinks is created.
+    working directory and replay the changes recorded in 'database.log'. If
+    the file does not exist, a new default database containing default drinks
+    is created. Without a file name the database is kept in memory only,
+    starting with the default drinks.
     
     A monitor thread is started to keep track of changes. As soon as changes
-    are detected they will be saved to disk. This will only happen once per
-    second for performance reasons.
+    are detected they will be appended to the journal. This will only happen
+    once per second for performance reasons. Once the journal grows larger
+    than :data:`journal_compact_size`, the complete database is written again
+    and the journal is emptied. Use :meth:`close` to stop the monitor thread
+    when the database is no longer needed.
+    
+    Every time changes are saved, a :class:`quartjes.models.delta.DrinksDelta`
+    is published through :attr:`on_drinks_delta` and the version of the
+    database is increased. Clients use :meth:`get_changes_since` to catch up
+    after missing deltas.
+    
+    Changes made to drinks outside the database must be reported using
+    :meth:`mark_dirty`. Only the drinks, and the fields of those drinks, that
+    were marked are compared when the changes are saved. Every report also
+    increases :attr:`cache_version` right away, so the server stops using
+    cached responses to :meth:`get` and :meth:`get_drinks`.
+    
+    The database is safe to use from multiple threads. Adding and removing
+    drinks is protected by an internal lock. Methods returning drinks return
+    the live objects though, so code changing drinks outside the database
+    should hold :meth:`drink_lock` for the drink, or :meth:`lock_all_drinks`
+    when changing many drinks at once. Never wait for a drink lock while
+    another thread may be waiting for this one; the database itself only
+    takes its internal lock while holding a drink lock, never the other way
+    around.
+    
+    Parameters
+    ----------
+    db_file : string
+        Name of the file to store the database in. None to keep the database
+        in memory only.
     """
     
-    def __init__(self):        
-        self._drinks = None
-        self._drink_index = {}
+    def __init__(self, db_file="database"):
+        self._drinks = OrderedDict()
+        self._lock = threading.RLock()
+        self._drink_locks = [threading.RLock() for _ in range(lock_stripes)]
         self._drink_dirty = False
+        self._dirty_drinks = OrderedDict()
+        self._all_dirty = False
         self._service = None
-        self._db_file = "database"
+        self._db_file = db_file
+        self._journal = None
+
+        self._version = 0
+        self._epoch = uuid.uuid4()
+        self._drink_versions = {}
+        self._tombstones = {}
+        self._published = {}
+        self._store_lock = threading.RLock()
+
+        # Increased on every reported change, invalidates cached responses
+        self.cache_version = 0
 
         self._monitor = Database._DatabaseMonitor(self)
         
@@ -48,13 +111,12 @@ class Database:
         drinks : iterable of :class:`quartjes.models.drink.Drink`
             A new list of drinks to replace the current in the database.
         """
-        index = {}
-        for dr in drinks:
-            if isinstance(dr, Mix):
-                self._localize_mix(dr)
-            index[dr.id] = dr
-        self._drinks, self._drink_index = drinks, index
-        self._drink_dirty = True
+        with self._lock:
+            for dr in drinks:
+                if isinstance(dr, Mix):
+                    self._localize_mix(dr)
+            self._internal_replace_drinks(drinks)
+            self._mark_all_dirty()
 
     @remote_method
     def update(self, drink):
@@ -74,6 +136,13 @@ class Database:
         drink : :class:`quartjes.models.drink.Drink`
             The drink to update. Can be a copy.
         """
+        with self.drink_lock(drink):
+            self._update(drink)
+
+    def _update(self, drink):
+        """
+        Update the drink while holding its lock.
+        """
         local_drink = self.get(drink.id)
 
         if not local_drink:
@@ -92,7 +161,7 @@ class Database:
                 local_drink.unit_amount = drink.unit_amount
                 local_drink.unit_price = drink.unit_price
 
-            self._drink_dirty = True
+            self.mark_dirty(local_drink)
 
     @remote_method
     def clear_history(self, drink):
@@ -109,12 +178,13 @@ class Database:
         KeyError
             The drink does not exist in the database.
         """
-        local_drink = self.get(drink.id)
-        if not local_drink:
-            raise KeyError
-        
-        local_drink.clear_price_history()
-        self._drink_dirty = True
+        with self.drink_lock(drink):
+            local_drink = self.get(drink.id)
+            if not local_drink:
+                raise KeyError
+            
+            local_drink.clear_price_history()
+            self.mark_dirty(local_drink, ("price_history",))
 
     @remote_method
     def clear_price_factor(self, drink):
@@ -131,12 +201,13 @@ class Database:
         KeyError
             The drink does not exist in the database.
         """
-        local_drink = self.get(drink.id)
-        if not local_drink:
-            raise KeyError
-        
-        local_drink.price_factor = 1.0
-        self._drink_dirty = True
+        with self.drink_lock(drink):
+            local_drink = self.get(drink.id)
+            if not local_drink:
+                raise KeyError
+            
+            local_drink.price_factor = 1.0
+            self.mark_dirty(local_drink, ("price_factor",))
 
     @remote_method
     def add(self, drink):
@@ -153,17 +224,17 @@ class Database:
         ValueError
             A drink with the same id already exists in the database.
         """
-        if self.contains(drink):
-            raise ValueError
-        
-        if isinstance(drink, Mix):
-            self._localize_mix(drink)
-        
-        self._drink_index[drink.id] = drink
-        self._drinks.append(drink)
-        self._drink_dirty = True
-        if debug_mode:
-            self._dump_drinks()
+        with self._lock:
+            if self.contains(drink):
+                raise ValueError
+            
+            if isinstance(drink, Mix):
+                self._localize_mix(drink)
+            
+            self._drinks[drink.id] = drink
+            self.mark_dirty(drink)
+            if debug_mode:
+                self._dump_drinks()
         
     @remote_method
     def remove(self, drink):
@@ -180,19 +251,19 @@ class Database:
         KeyError
             The drink does not exist in the database.
         """
-        local_drink = self._drink_index.get(drink.id, None)
-        if local_drink:
-            if debug_mode:
-                print("Removing drink %s" % local_drink.name)
-            del self._drink_index[local_drink.id]
-            self._drinks.remove(local_drink)
-            self._drink_dirty = True
-            if debug_mode:
-                self._dump_drinks()
-        else:
-            raise KeyError
+        with self._lock:
+            local_drink = self._drinks.pop(drink.id, None)
+            if local_drink:
+                if debug_mode:
+                    print("Removing drink %s" % local_drink.name)
+                self.mark_dirty(local_drink)
+                if debug_mode:
+                    self._dump_drinks()
+            else:
+                raise KeyError
 
     @remote_method
+    @cacheable
     def get(self, id_):
         """
         Get a drink from the database by id.
@@ -207,9 +278,10 @@ class Database:
         drink : :class:`quartjes.models.drink.Drink`
             The drink with the given id. None if it does not exist.
         """
-        return self._drink_index.get(id_)
+        return self._drinks.get(id_)
 
     @remote_method
+    @cacheable
     def get_drinks(self):
         """
         Get all drinks in the database.
@@ -217,9 +289,11 @@ class Database:
         Returns
         -------
         drinks : list of :class:`quartjes.models.drink.Drink`
-            All drinks in the database.
+            All drinks in the database. A new list is returned, so it is not
+            affected by drinks added or removed later.
         """
-        return self._drinks[:]
+        with self._lock:
+            return self._drinks.values()
 
     @remote_method
     def contains(self, drink):
@@ -236,7 +310,39 @@ class Database:
         contains : boolean
             True if (a copy of) the drink is already present.
         """
-        return drink.id in self._drink_index
+        return drink.id in self._drinks
+
+    def drink_lock(self, drink):
+        """
+        Get the lock protecting a drink. Hold it while changing the drink.
+        
+        Parameters
+        ----------
+        drink : :class:`quartjes.models.drink.Drink` or UUID
+            The drink, a copy of it, or its id.
+        
+        Returns
+        -------
+        lock : RLock
+            The lock, to be used in a with statement. Some other drinks share
+            the same lock.
+        """
+        id_ = getattr(drink, "id", drink)
+        return self._drink_locks[hash(id_) % len(self._drink_locks)]
+
+    @contextmanager
+    def lock_all_drinks(self):
+        """
+        Context manager holding the locks of all drinks, for changing many
+        drinks at once.
+        """
+        for lock in self._drink_locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._drink_locks):
+                lock.release()
 
     def _localize_mix(self, mix):
         """
@@ -261,21 +367,35 @@ class Database:
         """
         Debug method to dump the contents to the console.
         """
-        for drink in self._drinks:
+        for drink in self.get_drinks():
             print(drink)
     
     def _load_database(self):
         """
         Load the current database from disk.
-        If no database exists on disk, create a new one.
+        If no database exists on disk, or the database is kept in memory only,
+        create a new one.
+        """
+        if self._db_file is None:
+            self.reset()
+        else:
+            self._load_file()
+
+        self._published = dict((drink.id, take_snapshot(drink)) for drink in self.get_drinks())
+
+        self._monitor.start()
+
+    def _load_file(self):
         """
-        if not os.path.exists(self._db_file):
+        Load the copy on disk and replay the journal.
+        """
+        if not whichdb.whichdb(self._db_file):
             print("No database available yet, creating one")
             db_valid = False
         else:
             db_valid = True
             
-        db = shelve.open(self._db_file)
+        db = shelve.open(self._db_file, "r" if db_valid else "c")
         
         if db_valid:
             if not db.has_key('version'):
@@ -290,44 +410,270 @@ class Database:
 
         if db_valid:
             self._internal_replace_drinks(db['drinks'])
-        else:
-            self.reset()
+            (epoch, version) = (db.get('epoch'), db.get('db_version', 0))
         db.close()
 
-        self._monitor.start()
+        self._journal = Journal(self._db_file + ".log")
+        if db_valid:
+            self._replay_journal(epoch, version)
+        else:
+            self.reset()
 
     def _internal_replace_drinks(self, drinks):
         """
         Replace all drinks in the database.
         Internal use only. Does not trigger any updates or saves.
         """
-        index = {}
-        for dr in drinks:
-            index[dr.id] = dr
-        self._drinks, self._drink_index = drinks, index
+        self._drinks = OrderedDict((dr.id, dr) for dr in drinks)
 
-    def _store(self):
+    def _replay_journal(self, epoch, version):
         """
-        Save the database to disk.
+        Apply the changes recorded in the journal since the copy on disk with
+        the given epoch and version was written. Afterwards a new copy is
+        written, as new changes are recorded using the epoch of this database.
         """
+        drinks = self.get_drinks()
+        for delta in self._journal.replay():
+            if delta.applies_to(version, epoch):
+                delta.apply(drinks)
+                version = delta.to_version
         if debug_mode:
-            print("Storing db")
-        db = shelve.open(self._db_file)
-        db['version'] = __version__
-        db['drinks'] = self._drinks
-        db.close()
+            print("Replayed journal up to version %d" % version)
 
-        if self._drink_dirty:
-            self._notify_drinks_updated()
+        self._internal_replace_drinks(drinks)
+        self._write_snapshot()
 
-        self._drink_dirty = False
+    def _write_snapshot(self, state=None):
+        """
+        Write a complete copy of the database to disk and empty the journal.
+        
+        Parameters
+        ----------
+        state : string
+            Copy of the database created by :meth:`_dump_state`. If None, a
+            new copy is created.
+        """
+        if self._journal is None:
+            return
+        if state is None:
+            with self.lock_all_drinks():
+                state = self._dump_state()
+        (drinks, epoch, version) = pickle.loads(state)
+        with self._store_lock:
+            if debug_mode:
+                print("Writing complete db")
+            db = shelve.open(self._db_file)
+            db['version'] = __version__
+            db['drinks'] = drinks
+            db['epoch'] = epoch
+            db['db_version'] = version
+            db.close()
+            self._journal.clear()
+
+    def _dump_state(self):
+        """
+        Pickle the drinks and the version of the database, while holding the
+        locks of all drinks. The copy can be written to disk after releasing
+        the locks.
+        """
+        return pickle.dumps((self.get_drinks(), self._epoch, self._version), pickle.HIGHEST_PROTOCOL)
+
+    def _store(self):
+        """
+        Save the changes to disk.
+        
+        The changes and, when the journal is full, a copy of the database are
+        pickled while holding the locks of all drinks. Writing them to disk
+        happens after releasing those locks, so selling drinks does not have
+        to wait for the disk.
+        """
+        with self._store_lock:
+            if debug_mode:
+                print("Storing db")
+            delta = None
+            record = None
+            state = None
+            with self.lock_all_drinks():
+                if self._drink_dirty:
+                    self._drink_dirty = False
+                    delta = self._create_delta()
+                    if not delta.empty and self._journal is not None:
+                        record = dump_record(delta)
+                        if self._journal.size + len(record) >= journal_compact_size:
+                            state = self._dump_state()
+
+            if state is not None:
+                self._write_snapshot(state)
+            elif record is not None:
+                self._journal.append_data(record)
+
+            if delta is not None:
+                if not delta.empty:
+                    self.on_drinks_delta(delta)
+                self._notify_drinks_updated()
+
+    def _create_delta(self):
+        """
+        Compare the drinks marked dirty against the last published state and
+        create a delta describing the changes. Updates the version if anything
+        changed.
+        """
+        delta = DrinksDelta(self._version, self._version + 1, self._epoch)
+        for (id_, fields) in self._take_dirty_drinks().items():
+            drink = self.get(id_)
+            snapshot = self._published.get(id_)
+            if drink is None:
+                if snapshot is not None:
+                    delta.removed.append(id_)
+                    del self._published[id_]
+                continue
+
+            if snapshot is None:
+                delta.added.append(drink)
+            else:
+                change = diff_drink(snapshot, drink, fields)
+                if change is False:
+                    delta.added.append(drink)
+                elif change is not None:
+                    delta.changes.append(change)
+            self._published[id_] = take_snapshot(drink)
+
+        if delta.empty:
+            delta.to_version = self._version
+            return delta
+
+        self._version = delta.to_version
+        for drink in delta.added:
+            self._drink_versions[drink.id] = self._version
+            self._tombstones.pop(drink.id, None)
+        for change in delta.changes:
+            self._drink_versions[change.drink_id] = self._version
+        for id_ in delta.removed:
+            self._drink_versions.pop(id_, None)
+            self._tombstones[id_] = self._version
+        return delta
+
+    @remote_method
+    def get_version(self):
+        """
+        Get the version of the last published changes.
+        
+        Returns
+        -------
+        version : tuple
+            Tuple of the epoch (UUID) and the version number (int).
+        """
+        return (self._epoch, self._version)
+
+    @remote_method
+    def get_changes_since(self, version, epoch=None):
+        """
+        Get the changes needed to bring a copy of the drinks from the given
+        version up to date.
+        
+        Drinks that changed are sent completely. If the epoch does not match,
+        or is not given, a full copy of the drinks is returned.
+        
+        Parameters
+        ----------
+        version : int
+            Last version seen by the client.
+        epoch : UUID
+            Epoch of that version.
+        
+        Returns
+        -------
+        delta : :class:`quartjes.models.delta.DrinksDelta`
+            The changes. Apply them to the local copy using
+            :meth:`quartjes.models.delta.DrinksDelta.apply`.
+        """
+        with self._store_lock:
+            current = self._version
+            if epoch != self._epoch or version > current:
+                return DrinksDelta(version, current, self._epoch, added=self.get_drinks(), full=True)
+
+            delta = DrinksDelta(version, current, self._epoch)
+            if version < current:
+                delta.added = [drink for drink in self.get_drinks()
+                               if self._drink_versions.get(drink.id, 0) > version]
+                delta.removed = [id_ for (id_, removed_version) in self._tombstones.items()
+                                 if removed_version > version]
+            return delta
+
+    def close(self):
+        """
+        Stop the monitor thread, save any pending changes and close the
+        journal. Changes made afterwards are no longer saved or published.
+        """
+        self._monitor.stop()
+        with self._store_lock:
+            if self._drink_dirty:
+                self._store()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
 
     def force_save(self):
         """
         Force the database to be saved the next time the monitor checks.
-        Will also trigger an update message to listeners.
+        Will also trigger an update message to listeners. All drinks are
+        checked for changes, so prefer :meth:`mark_dirty` if you know which
+        drinks changed.
         """
-        self._drink_dirty = True
+        self._mark_all_dirty()
+
+    def mark_dirty(self, drink, fields=None):
+        """
+        Report that a drink was changed, so the changes are saved and
+        published the next time the monitor checks.
+        
+        Parameters
+        ----------
+        drink : :class:`quartjes.models.drink.Drink`
+            The changed drink. Can be a copy.
+        fields : iterable of strings
+            Names of the changed properties. Use the names in
+            :data:`quartjes.models.delta.MIX_FIELDS`, "price_history",
+            "sales_history", or "drinks" for the components of a mix. Changes
+            to other properties are not detected. If None, the drink is
+            checked completely.
+        """
+        with self._lock:
+            if not self._all_dirty:
+                id_ = drink.id
+                if fields is None or self._dirty_drinks.get(id_, ()) is None:
+                    self._dirty_drinks[id_] = None
+                else:
+                    self._dirty_drinks.setdefault(id_, set()).update(fields)
+            self._drink_dirty = True
+            self.cache_version += 1
+
+    def _mark_all_dirty(self):
+        """
+        Check all drinks completely the next time changes are saved.
+        """
+        with self._lock:
+            self._all_dirty = True
+            self._dirty_drinks = OrderedDict()
+            self._drink_dirty = True
+            self.cache_version += 1
+
+    def _take_dirty_drinks(self):
+        """
+        Get the drinks marked dirty, and their dirty fields, since the last
+        call. Drinks that no longer exist are included, so their removal can
+        be detected.
+        """
+        with self._lock:
+            if self._all_dirty:
+                dirty = OrderedDict.fromkeys(self._drinks)
+                for id_ in self._published:
+                    dirty.setdefault(id_)
+            else:
+                dirty = self._dirty_drinks
+            self._all_dirty = False
+            self._dirty_drinks = OrderedDict()
+            return dirty
 
     def reset(self):
         """
@@ -352,15 +698,15 @@ class Database:
         drinks.append(Mix('Safari Cassis',[d1,d1,d1,d2]))
         self._internal_replace_drinks(drinks)
 
-        self._store()
+        self._write_snapshot()
     
     def clear(self):
         """
         Remove all contents from the database.
         """
-        self._drinks = []
-        self._drink_index = {}
-        self._drink_dirty = True
+        with self._lock:
+            self._drinks = OrderedDict()
+            self._mark_all_dirty()
         
         self._store()
 
@@ -370,17 +716,31 @@ class Database:
     """
     Event triggered when the contents of the database has changed.
     
+    Every subscriber receives all drinks including their history. Use
+    :attr:`on_drinks_delta` to only receive the changes.
+    
     Attributes
     ----------
     drinks : iterable of :class:`quartjes.models.drink.Drink`
         The latest contents of the database.
     """
 
+    on_drinks_delta = remote_event()
+    """
+    Event triggered when the contents of the database has changed, containing
+    only the changes since the previous version.
+    
+    Attributes
+    ----------
+    delta : :class:`quartjes.models.delta.DrinksDelta`
+        The changes.
+    """
+
     def _notify_drinks_updated(self):
         """
         Notify event listeners that the list of drinks has been updated.
         """
-        self.on_drinks_updated(self._drinks)
+        self.on_drinks_updated(self.get_drinks())
 
     @remote_method
     def count(self):
@@ -409,6 +769,7 @@ class Database:
             super(Database._DatabaseMonitor, self).__init__(name='DatabaseMonitor')
             self.daemon = True
             self.db = db
+            self._stopped = False
             
         def run(self):
             """
@@ -416,8 +777,17 @@ class Database:
             """
             while True:
                 time.sleep(1)
+                if self._stopped:
+                    break
                 if self.db._drink_dirty:
                     self.db._store()
+            self.db = None
+
+        def stop(self):
+            """
+            Stop monitoring. The thread ends within a second.
+            """
+            self._stopped = True
 
 _database = Database()
 '''
@@ -0,0 +1,144 @@
+"""
+Append-only log of changes to the database.
+
+Instead of rewriting the complete database every time something changes, the
+database appends a record describing the change to the journal. On startup
+the last snapshot of the database is loaded and the records in the journal
+are replayed on top of it. Once the journal grows too large, a new snapshot
+is written and the journal is emptied.
+
+Every record is stored with its length and a checksum. A record that was only
+partially written, for example because the server crashed, is detected during
+replay and removed from the journal together with everything after it.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import cPickle as pickle
+import os
+import struct
+import zlib
+
+_header = struct.Struct("<II")
+# Length and crc32 of the record following the header.
+
+
+def dump_record(record):
+    """
+    Pickle a record for :meth:`Journal.append_data`.
+
+    Parameters
+    ----------
+    record
+        Object to store. Must be picklable.
+
+    Returns
+    -------
+    data : string
+        The pickled record.
+    """
+    return pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+
+
+class Journal(object):
+    """
+    Append-only log of records stored in a file.
+
+    Parameters
+    ----------
+    file_name : string
+        Name of the file to store the records in. Created if it does not exist.
+    sync : boolean
+        Make sure each record is written to disk before :meth:`append` returns.
+    """
+
+    def __init__(self, file_name, sync=True):
+        self._file_name = file_name
+        self._sync = sync
+        self._file = open(file_name, "ab")
+        self._file.seek(0, os.SEEK_END)
+
+    @property
+    def size(self):
+        """
+        Current size of the journal in bytes.
+        """
+        return self._file.tell()
+
+    def append(self, record):
+        """
+        Add a record to the end of the journal.
+
+        Parameters
+        ----------
+        record
+            Object to store. Must be picklable.
+        """
+        self.append_data(dump_record(record))
+
+    def append_data(self, data):
+        """
+        Add a record created by :func:`dump_record` to the end of the journal.
+        Use this to pickle the record while it is protected by a lock, and
+        write it after releasing the lock.
+
+        Parameters
+        ----------
+        data : string
+            The pickled record.
+        """
+        self._file.write(_header.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self._file.write(data)
+        self._file.flush()
+        if self._sync:
+            os.fsync(self._file.fileno())
+
+    def replay(self):
+        """
+        Read all records in the journal. A damaged record at the end of the
+        journal is removed, so new records can be appended after the last
+        intact one.
+
+        Returns
+        -------
+        records : list
+            The records in the order they were appended.
+        """
+        records = []
+        valid_size = 0
+        with open(self._file_name, "rb") as f:
+            while True:
+                header = f.read(_header.size)
+                if len(header) < _header.size:
+                    break
+                (length, crc) = _header.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                try:
+                    records.append(pickle.loads(data))
+                except Exception:
+                    break
+                valid_size = f.tell()
+
+        if valid_size < self.size:
+            print("Removing damaged records from the end of %s" % self._file_name)
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        return records
+
+    def clear(self):
+        """
+        Remove all records from the journal.
+        """
+        self._file.truncate(0)
+        self._file.seek(0)
+        if self._sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Close the journal file.
+        """
+        self._file.close()
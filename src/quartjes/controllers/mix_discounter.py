@@ -47,11 +47,16 @@ class MixDiscounterThread(threading.Thread):
         while True:
             time.sleep(self._random.randint(min_interval, max_interval))
             
+            db = default_database()
             if self._current_mix:
-                self._current_mix.discount = self._old_discount
+                with db.drink_lock(self._current_mix):
+                    self._current_mix.discount = self._old_discount
+                    db.mark_dirty(self._current_mix, ("discount",))
             
             self._current_mix = self.get_random_mix()
-            self._current_mix.discount *= discount_factor
+            with db.drink_lock(self._current_mix):
+                self._current_mix.discount *= discount_factor
+                db.mark_dirty(self._current_mix, ("discount",))
             
             print("Mix %s now has discount %f" % (self._current_mix.name, self._current_mix.discount))
             
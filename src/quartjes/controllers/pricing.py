@@ -0,0 +1,167 @@
+"""
+Interface for the algorithms determining the prices of drinks.
+
+A pricing engine receives a :class:`SalesSnapshot` containing the current
+price factors and the recent sales of all drinks, and returns the new price
+factors. Engines do not touch the database, so they can be swapped, tested and
+benchmarked separately from the stock exchange running them.
+
+Engines are registered by name using :func:`add_pricing_engine`. The engines
+of the stock exchanges are registered when their module is imported.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import numpy
+
+from quartjes.models.drink import Mix
+
+
+class SalesSnapshot(object):
+    """
+    Sales of all drinks at the end of a round. Sales are grouped per round,
+    with one row per drink and one column per round, oldest round first.
+
+    Parameters
+    ----------
+    now : float
+        Time the snapshot was taken.
+    drink_ids : list of UUID
+        Ids of the drinks, one for each row.
+    mixes : numpy array
+        True for the rows containing a mix. Sales of mixes are included in the
+        rows of their components, the rows of mixes are empty.
+    price_factors : numpy array
+        Current price factor of each drink.
+    amounts : numpy array
+        Amount sold per drink per round.
+    timestamps : numpy array
+        End time of each round, same shape as amounts.
+    sale_price_factors : numpy array
+        Price factor at the time of the sales, same shape as amounts.
+    """
+
+    def __init__(self, now, drink_ids, mixes, price_factors, amounts, timestamps, sale_price_factors):
+        self.now = now
+        self.drink_ids = drink_ids
+        self.mixes = mixes
+        self.price_factors = price_factors
+        self.amounts = amounts
+        self.timestamps = timestamps
+        self.sale_price_factors = sale_price_factors
+
+    @property
+    def count(self):
+        """
+        Number of drinks in the snapshot.
+        """
+        return len(self.drink_ids)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays in the snapshot.
+        """
+        return sum(array.nbytes for array in (self.mixes, self.price_factors, self.amounts,
+                                              self.timestamps, self.sale_price_factors))
+
+
+def take_sales_snapshot(drinks, now, rounds=1):
+    """
+    Create an empty snapshot for the given drinks. The caller fills in the
+    sales of the components.
+
+    Parameters
+    ----------
+    drinks : list of :class:`quartjes.models.drink.Drink`
+        Drinks to include.
+    now : float
+        Current time.
+    rounds : int
+        Number of rounds to reserve space for.
+
+    Returns
+    -------
+    snapshot : :class:`SalesSnapshot`
+        Snapshot without sales. Timestamps are set to now.
+    """
+    count = len(drinks)
+    return SalesSnapshot(now, [drink.id for drink in drinks],
+                         numpy.array([isinstance(drink, Mix) for drink in drinks], dtype=bool),
+                         numpy.array([drink.price_factor for drink in drinks], dtype=float),
+                         numpy.zeros((count, rounds)), numpy.tile(float(now), (count, rounds)),
+                         numpy.ones((count, rounds)))
+
+
+class PricingEngine(object):
+    """
+    Base class for pricing engines. Override :meth:`calculate` and set
+    :attr:`name`, then register the class using :func:`add_pricing_engine`.
+    The constructor should accept the tuning parameters of the engine as
+    keyword arguments with sensible defaults.
+    """
+
+    name = None
+    """
+    Unique name of the engine.
+    """
+
+    def calculate(self, snapshot):
+        """
+        Calculate new price factors.
+
+        Parameters
+        ----------
+        snapshot : :class:`SalesSnapshot`
+            Current price factors and recent sales.
+
+        Returns
+        -------
+        price_factors : dict
+            New price factor by drink id. Drinks that are left out keep their
+            price factor. Mixes are normally left out, their price follows from
+            their components. An empty dictionary if there is not enough
+            activity to determine prices.
+        """
+        raise NotImplementedError
+
+
+pricing_engines_by_name = {}
+# Dictionary of registered pricing engine classes by name.
+
+
+def add_pricing_engine(klass):
+    """
+    Add a pricing engine to the list of available engines.
+
+    Parameters
+    ----------
+    klass : type
+        Subclass of :class:`PricingEngine` to add.
+    """
+    pricing_engines_by_name[klass.name] = klass
+
+
+def create_pricing_engine(name, **kwargs):
+    """
+    Create a registered pricing engine.
+
+    Parameters
+    ----------
+    name : string
+        Name of the engine.
+    kwargs
+        Tuning parameters passed to the constructor of the engine.
+
+    Returns
+    -------
+    engine : :class:`PricingEngine`
+        New instance of the engine.
+
+    Raises
+    ------
+    KeyError
+        No engine with this name is registered.
+    """
+    return pricing_engines_by_name[name](**kwargs)
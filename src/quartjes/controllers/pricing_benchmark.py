@@ -0,0 +1,143 @@
+"""
+Benchmark harness for the pricing engines.
+
+Runs every registered pricing engine on synthetic bars of increasing size and
+reports the time needed per round and the memory used. Run it with::
+
+    python -m quartjes.controllers.pricing_benchmark [engine name ...]
+
+Without names all registered engines are benchmarked.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import resource
+import sys
+import time
+import uuid
+
+import numpy
+
+from quartjes.controllers.pricing import SalesSnapshot, pricing_engines_by_name, create_pricing_engine
+# Importing the exchanges registers their engines
+import quartjes.controllers.stock_exchange
+import quartjes.controllers.stock_exchange2
+
+default_drink_counts = (10, 100, 1000)
+"""
+Number of drinks in the synthetic bars.
+"""
+
+default_rounds = 90
+"""
+Number of rounds of sales in the synthetic bars.
+"""
+
+
+def create_synthetic_snapshot(drink_count, rounds=default_rounds, round_time=20.0, mix_fraction=0.2, seed=0):
+    """
+    Create a snapshot of a bar with random sales. Some drinks are very
+    popular, most are sold occasionally.
+
+    Parameters
+    ----------
+    drink_count : int
+        Number of drinks, including mixes.
+    rounds : int
+        Number of rounds of sales.
+    round_time : float
+        Time in seconds between rounds.
+    mix_fraction : float
+        Fraction of the drinks that are mixes.
+    seed : int
+        Seed for the random generator, the same seed gives the same bar.
+
+    Returns
+    -------
+    snapshot : :class:`quartjes.controllers.pricing.SalesSnapshot`
+        The snapshot.
+    """
+    rng = numpy.random.RandomState(seed)
+    now = time.time()
+    mixes = rng.random_sample(drink_count) < mix_fraction
+    popularity = rng.pareto(2.0, drink_count) + 0.1
+    amounts = rng.poisson(popularity[:, None], (drink_count, rounds)).astype(float)
+    amounts[mixes] = 0.0
+    timestamps = numpy.tile(now - round_time * numpy.arange(rounds - 1, -1, -1, dtype=float), (drink_count, 1))
+    price_factors = rng.uniform(0.5, 2.0, drink_count)
+    sale_price_factors = numpy.clip(price_factors[:, None] + rng.normal(0.0, 0.1, (drink_count, rounds)), 0.3, 3.0)
+    return SalesSnapshot(now, [uuid.uuid4() for _ in range(drink_count)], mixes, price_factors,
+                         amounts, timestamps, sale_price_factors)
+
+
+def benchmark_engine(engine, snapshot, repeat=20):
+    """
+    Time the calculation of one round.
+
+    Parameters
+    ----------
+    engine : :class:`quartjes.controllers.pricing.PricingEngine`
+        Engine to benchmark.
+    snapshot : :class:`quartjes.controllers.pricing.SalesSnapshot`
+        Sales to calculate prices for.
+    repeat : int
+        Number of rounds to calculate.
+
+    Returns
+    -------
+    mean_time : float
+        Mean time per round in seconds.
+    best_time : float
+        Fastest round in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start_time = time.time()
+        engine.calculate(snapshot)
+        times.append(time.time() - start_time)
+    return sum(times) / len(times), min(times)
+
+
+def run_benchmark(engine_names=None, drink_counts=default_drink_counts, rounds=default_rounds,
+                  repeat=20, out=sys.stdout):
+    """
+    Benchmark pricing engines and print a table of the results.
+
+    Parameters
+    ----------
+    engine_names : list of string
+        Engines to benchmark. Defaults to all registered engines.
+    drink_counts : list of int
+        Sizes of the synthetic bars.
+    rounds : int
+        Number of rounds of sales in each bar.
+    repeat : int
+        Number of rounds to calculate for each measurement.
+    out : file
+        Where to print the results.
+
+    Returns
+    -------
+    results : list of tuples
+        (engine name, drink count, mean time, best time, snapshot bytes) for
+        each measurement.
+    """
+    results = []
+    out.write("%-20s %8s %12s %12s %12s %14s\n" % ("engine", "drinks", "mean ms", "best ms",
+                                                   "snapshot kB", "peak RSS kB"))
+    for name in engine_names or sorted(pricing_engines_by_name):
+        engine = create_pricing_engine(name)
+        for drink_count in drink_counts:
+            snapshot = create_synthetic_snapshot(drink_count, rounds)
+            (mean_time, best_time) = benchmark_engine(engine, snapshot, repeat)
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            out.write("%-20s %8d %12.3f %12.3f %12.1f %14d\n" % (name, drink_count, mean_time * 1000,
+                                                                 best_time * 1000, snapshot.nbytes / 1024.0,
+                                                                 peak_rss))
+            results.append((name, drink_count, mean_time, best_time, snapshot.nbytes))
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv[1:] or None)
@@ -0,0 +1,312 @@
+"""
+Fast forward simulation of the stock exchange.
+
+A :class:`Simulation` runs :class:`quartjes.controllers.stock_exchange2.StockExchange2`
+on an in-memory database, using a :class:`SimulationClock` instead of the
+real time. Customers are simulated by a stream of sales generated in bulk for
+each round from a seeded random generator, so the same seed always results
+in the same night of trading.
+
+The results are collected in NumPy arrays with one row per round and one
+column per drink, and can be saved as a compressed ``.npz`` file containing
+one named array per column. Run a simulation from the command line using::
+
+    python -m quartjes.controllers.simulation [hours] [file name]
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import sys
+
+import numpy
+
+from quartjes.controllers.database import Database
+from quartjes.controllers.stock_exchange2 import StockExchange2
+from quartjes.models.drink import Mix
+from quartjes.util.sampling import WeightedSampler
+
+default_start_time = 1343836800.0
+"""
+Time the simulated night starts, in seconds since epoch.
+"""
+
+default_sales_rate = 1.0 / 3
+"""
+Mean number of sales per second.
+"""
+
+
+class SimulationClock(object):
+    """
+    Clock for simulated time. Only moves when told to. Call the clock to get
+    the current time, like time.time.
+
+    Parameters
+    ----------
+    start_time : float
+        Initial time in seconds since epoch.
+    """
+
+    def __init__(self, start_time=default_start_time):
+        self._now = float(start_time)
+
+    def __call__(self):
+        return self._now
+
+    def time(self):
+        """
+        Get the current simulated time.
+        """
+        return self._now
+
+    def set(self, now):
+        """
+        Move the clock to the given time.
+        """
+        self._now = float(now)
+
+    def advance(self, seconds):
+        """
+        Move the clock forward.
+        """
+        self._now += seconds
+
+
+def generate_sales(rng, sampler, start_time, duration, sales_rate, max_amount=3):
+    """
+    Generate the sales for a period of time at once. Sales arrive as a
+    Poisson process, each sale chooses a drink using the sampler.
+
+    Parameters
+    ----------
+    rng : numpy.random.RandomState
+        Random generator to use.
+    sampler : :class:`quartjes.util.sampling.WeightedSampler`
+        Sampler choosing the drinks.
+    start_time : float
+        Start of the period.
+    duration : float
+        Length of the period in seconds.
+    sales_rate : float
+        Mean number of sales per second.
+    max_amount : int
+        Maximum number of units in one sale. The amount is uniformly chosen
+        from 1 up to and including the maximum.
+
+    Returns
+    -------
+    timestamps : numpy array
+        Time of each sale, in order.
+    drinks : numpy array
+        Index of the drink sold in the sampler.
+    amounts : numpy array
+        Number of units sold.
+    """
+    count = rng.poisson(sales_rate * duration)
+    timestamps = start_time + numpy.sort(rng.random_sample(count)) * duration
+    drinks = sampler.sample_indices(count, rng)
+    amounts = rng.randint(1, max_amount + 1, count)
+    return timestamps, drinks, amounts
+
+
+class SimulationResult(object):
+    """
+    Results of a simulation. All arrays have one row per round and one column
+    per drink.
+
+    Parameters
+    ----------
+    names : list of string
+        Name of each drink.
+    mixes : numpy array
+        True for the columns containing a mix.
+    times : numpy array
+        Seconds since the start of the simulation at the end of each round.
+    price_factors : numpy array
+        Price factor of each drink after each round.
+    demands : numpy array
+        Demand for each drink after each round. NaN for mixes.
+    sales : numpy array
+        Units sold of each drink during each round.
+    revenue : numpy array
+        Quartjes earned by each drink during each round.
+    """
+
+    columns = ("names", "mixes", "times", "price_factors", "demands", "sales", "revenue")
+    """
+    Names of the arrays stored by :meth:`save`.
+    """
+
+    def __init__(self, names, mixes, times, price_factors, demands, sales, revenue):
+        self.names = names
+        self.mixes = mixes
+        self.times = times
+        self.price_factors = price_factors
+        self.demands = demands
+        self.sales = sales
+        self.revenue = revenue
+
+    def save(self, file_name):
+        """
+        Save the results as a compressed NumPy archive.
+
+        Parameters
+        ----------
+        file_name : string
+            Name of the file. The extension .npz is added if missing.
+        """
+        arrays = dict((name, getattr(self, name)) for name in self.columns)
+        arrays["names"] = numpy.array(self.names)
+        numpy.savez_compressed(file_name, **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Load results saved using :meth:`save`.
+
+        Parameters
+        ----------
+        file_name : string
+            Name of the file.
+
+        Returns
+        -------
+        result : :class:`SimulationResult`
+            The loaded results.
+        """
+        archive = numpy.load(file_name)
+        try:
+            arrays = dict((name, archive[name]) for name in cls.columns)
+        finally:
+            archive.close()
+        arrays["names"] = arrays["names"].tolist()
+        return cls(**arrays)
+
+
+class Simulation(object):
+    """
+    Simulated night of trading on the stock exchange.
+
+    The stock exchange gets its own in-memory database containing the
+    default drinks. The chance a drink is bought is proportional to its price
+    factor raised to the power of minus the price sensitivity. A price
+    sensitivity of 0 makes customers ignore the prices.
+
+    Parameters
+    ----------
+    seed : int
+        Seed for the random generator.
+    sales_rate : float
+        Mean number of sales per second.
+    price_sensitivity : float
+        How strongly customers prefer cheap drinks.
+    engine : :class:`quartjes.controllers.pricing.PricingEngine`
+        Engine calculating the prices. Defaults to the engine of the stock exchange.
+    start_time : float
+        Time the simulation starts, in seconds since epoch.
+    """
+
+    def __init__(self, seed=0, sales_rate=default_sales_rate, price_sensitivity=1.0, engine=None,
+                 start_time=default_start_time):
+        self.clock = SimulationClock(start_time)
+        self.database = Database(db_file=None)
+        self.exchange = StockExchange2(engine=engine, database=self.database, clock=self.clock,
+                                       start_thread=False)
+        self.sales_rate = sales_rate
+        self.price_sensitivity = price_sensitivity
+        self._start_time = start_time
+        self._rng = numpy.random.RandomState(seed)
+
+    def run(self, run_time):
+        """
+        Run the simulation.
+
+        Parameters
+        ----------
+        run_time : float
+            Time in seconds to simulate. Rounded down to whole rounds.
+
+        Returns
+        -------
+        result : :class:`SimulationResult`
+            Prices, demands and sales per round.
+        """
+        try:
+            return self._run(run_time)
+        finally:
+            # Stop the monitor thread of the database, it would otherwise
+            # keep running and keep the database alive.
+            self.database.close()
+
+    def _run(self, run_time):
+        """
+        Run the simulation without closing the database afterwards.
+        """
+        exchange = self.exchange
+        round_time = exchange.get_round_time()
+        rounds = int(run_time // round_time)
+        drinks = self.database.get_drinks()
+        mixes = numpy.array([isinstance(drink, Mix) for drink in drinks], dtype=bool)
+        components = [drink for drink in drinks if not isinstance(drink, Mix)]
+        sampler = WeightedSampler(drinks)
+
+        times = numpy.zeros(rounds)
+        price_factors = numpy.zeros((rounds, len(drinks)))
+        demands = numpy.empty((rounds, len(drinks)))
+        demands.fill(numpy.nan)
+        sales = numpy.zeros((rounds, len(drinks)))
+        revenue = numpy.zeros((rounds, len(drinks)))
+
+        for r in range(rounds):
+            start_time = self.clock.time()
+            sampler.update(drinks, numpy.array([drink.price_factor for drink in drinks]) ** -self.price_sensitivity)
+            for (timestamp, index, amount) in zip(*generate_sales(self._rng, sampler, start_time,
+                                                                  round_time, self.sales_rate)):
+                self.clock.set(timestamp)
+                revenue[r, index] += exchange.sell(drinks[index], int(amount))
+                sales[r, index] += amount
+
+            self.clock.set(start_time + round_time)
+            exchange._recalculate_prices()
+
+            times[r] = self.clock.time() - self._start_time
+            price_factors[r] = [drink.price_factor for drink in drinks]
+            demands[r, ~mixes] = exchange._calculate_demand_values(components)
+
+        return SimulationResult([drink.name for drink in drinks], mixes, times, price_factors,
+                                demands, sales, revenue)
+
+
+def simulate(run_time, file_name=None, seed=0):
+    """
+    Simulate running the stock exchange with the default settings.
+
+    Parameters
+    ----------
+    run_time : float
+        Time in seconds to simulate.
+    file_name : string
+        Save the results in this file if given.
+    seed : int
+        Seed for the random generator.
+
+    Returns
+    -------
+    simulation : :class:`Simulation`
+        The simulation, containing the database and stock exchange used.
+    result : :class:`SimulationResult`
+        Results of the simulation.
+    """
+    simulation = Simulation(seed)
+    result = simulation.run(run_time)
+    if file_name:
+        result.save(file_name)
+    return simulation, result
+
+
+if __name__ == "__main__":
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 12
+    file_name = sys.argv[2] if len(sys.argv) > 2 else "stock_exchange2_simulation.npz"
+    simulate(hours * 60 * 60, file_name)
+    print("Results written to %s" % file_name)
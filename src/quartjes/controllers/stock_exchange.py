@@ -4,7 +4,9 @@ Stock exchange controller. Changes prices of drinks according to sales.
 
 import threading
 import time
+import numpy
 import quartjes.controllers.database
+from quartjes.controllers.pricing import PricingEngine, add_pricing_engine, take_sales_snapshot
 from quartjes.models.drink import Mix
 from quartjes.connector.services import remote_service, remote_method, remote_event
 import random
@@ -16,6 +18,66 @@ debug_mode = False
 default_round_time = 120
 #default_round_time = 10
 
+
+class StockExchangeEngine(PricingEngine):
+    """
+    Pricing engine of version 1 of the stock exchange. Only looks at the sales
+    of the last round; all rounds in the snapshot are added together.
+    
+    The price factor of each drink is multiplied by its sales divided by the
+    mean sales, then all factors are corrected so they average to 1 again.
+    
+    Parameters
+    ----------
+    damp_sales : integer
+        Amount of sales to add to each component to dampen fluctuations.
+    max_price_factor : double
+        Maximum value the price factor of each drink may reach.
+    min_price_factor : double
+        Minimum value the price factor of each drink may reach.
+    """
+
+    name = "stock_exchange"
+
+    def __init__(self, damp_sales=2, max_price_factor=3, min_price_factor=0.4):
+        self.damp_sales = damp_sales
+        self.max_price_factor = max_price_factor
+        self.min_price_factor = min_price_factor
+
+    def calculate(self, snapshot):
+        rows = ~snapshot.mixes
+        sales = snapshot.amounts[rows].sum(axis=1)
+        total_sales = sales.sum()
+        component_count = len(sales)
+
+        # Mixes are counted as well, they dampen the changes somewhat
+        mean_sales = float(total_sales) / float(snapshot.count)
+
+        if debug_mode:
+            print("Total sales: %d, Mean sales: %f" % (total_sales, mean_sales))
+
+        if total_sales <= 0:
+            return {}
+
+        factors = snapshot.price_factors[rows] * (sales + self.damp_sales) / (mean_sales + self.damp_sales)
+        hits = (factors > self.max_price_factor).sum() + (factors < self.min_price_factor).sum()
+        numpy.clip(factors, self.min_price_factor, self.max_price_factor, factors)
+        total_factors = factors.sum()
+
+        skew_correction = float(component_count - hits) / (total_factors - hits)
+        if debug_mode:
+            print("Skew=%f Skew correction=%f" % (total_factors / component_count, skew_correction))
+
+        factors[(factors > self.min_price_factor) & (factors < self.max_price_factor)] *= skew_correction
+        if debug_mode:
+            print("Final skew=%f" % (factors.sum() / component_count))
+
+        drink_ids = [drink_id for (drink_id, mix) in zip(snapshot.drink_ids, snapshot.mixes) if not mix]
+        return dict(zip(drink_ids, factors.tolist()))
+
+add_pricing_engine(StockExchangeEngine)
+
+
 @remote_service
 class StockExchange(object):
     """
@@ -32,10 +94,15 @@ class StockExchange(object):
         Maximum value the price factor of each drink may reach.
     min_price_factor : double
         Minimum value the price factor of each drink may reach.
+    round_time : integer
+        Time in seconds between rounds.
+    engine : :class:`quartjes.controllers.pricing.PricingEngine`
+        Engine calculating the prices. Defaults to a :class:`StockExchangeEngine`
+        using the parameters above.
     """
 
     def __init__(self, start_thread=True, damp_sales=2, max_price_factor=3,
-                 min_price_factor=0.4, round_time=None):
+                 min_price_factor=0.4, round_time=None, engine=None):
         self._transactions = []
         self._db = quartjes.controllers.database.default_database()
         self._max_history = 120
@@ -44,9 +111,7 @@ class StockExchange(object):
             self._round_time = round_time
         else:
             self._round_time = default_round_time
-        self._damp_sales = damp_sales
-        self._max_price_factor = max_price_factor
-        self._min_price_factor = min_price_factor
+        self._engine = engine or StockExchangeEngine(damp_sales, max_price_factor, min_price_factor)
         self._min_mix_discount = 0.5
         self._max_mix_discount = 0.9
 
@@ -110,80 +175,17 @@ class StockExchange(object):
         """
         Recalculate all prices based on the current sales.
         """
-        sales = {}
         drinks = self._db.get_drinks()
-        total_sales = 0
-        component_count = 0
-
-        for dr in drinks:
-            if not isinstance(dr, Mix):
-                sales[dr] = 0
-                component_count += 1
-
-        for (dr, amount) in self._transactions:
-            if isinstance(dr, Mix):
-                parts = dr.drinks
-                amount *= 1.0 / len(parts)
-                for p in parts:
-                    total = sales.get(p)
-                    if total != None:
-                        sales[p] = total + amount
-                        total_sales += amount
-
-            else:
-                total = sales.get(dr)
-                if total != None:
-                    sales[dr] = total + amount
-                    total_sales += amount
-
-        mean_sales = float(total_sales) / float(len(drinks))
-
-        if debug_mode:
-            print("Total sales: %d, Mean sales: %f" % (total_sales, mean_sales))
-
         t = time.time()
 
-        if total_sales > 0:
-            
-            total_factors = 0
-            min_price_hits = 0
-            max_price_hits = 0
-            for (dr, amount) in sales.items():
-                sales_factor = float(amount + self._damp_sales) / (mean_sales + self._damp_sales)
-                dr.price_factor *= sales_factor
-                if dr.price_factor > self._max_price_factor:
-                    dr.price_factor = self._max_price_factor
-                    max_price_hits += 1
-                elif dr.price_factor < self._min_price_factor:
-                    dr.price_factor = self._min_price_factor
-                    min_price_hits += 1
-    
-                total_factors += dr.price_factor
-                
-                if debug_mode:
-                    print("Factor for %s = %f" % (dr.name, dr.price_factor))
-    
-            if debug_mode:
-                print("Amount of components: %i, Total factors: %f" % (component_count, total_factors))
-    
-            skew = total_factors / float(component_count)
-            skew_correction = (float(component_count - (max_price_hits + min_price_hits)) /
-                               (total_factors - (max_price_hits + min_price_hits)))
-    
-            if debug_mode:
-                print("Skew=%f Skew correction=%f" % (skew, skew_correction))
- 
-            total_factors = 0   
-            for (dr, amount) in sales.items():
-                if dr.price_factor > self._min_price_factor and dr.price_factor < self._max_price_factor:
-                    dr.price_factor *= skew_correction
-                total_factors += dr.price_factor
-                if debug_mode:
-                    print("Corrected factor for %s = %f" % (dr.name, dr.price_factor))
+        price_factors = self._engine.calculate(self._take_sales_snapshot(drinks, t))
+        for drink in drinks:
+            price_factor = price_factors.get(drink.id)
+            if price_factor is not None:
+                drink.price_factor = price_factor
 
-            skew = total_factors / float(component_count)
-            if debug_mode:
-                print("Final skew=%f" % skew)
+                if debug_mode:
+                    print("Factor for %s = %f" % (drink.name, drink.price_factor))
     
         for drink in drinks:
             if isinstance(drink, Mix):
@@ -198,6 +200,27 @@ class StockExchange(object):
         self._db.force_save()
         self._notify_next_round()
         
+    def _take_sales_snapshot(self, drinks, now):
+        """
+        Collect the sales of the current round for the pricing engine. Sales of
+        mixes are divided over their components.
+        """
+        snapshot = take_sales_snapshot(drinks, now)
+        rows = dict((drink.id, row) for (row, drink) in enumerate(drinks) if not isinstance(drink, Mix))
+
+        for (dr, amount) in self._transactions:
+            if isinstance(dr, Mix):
+                parts = dr.drinks
+                amount *= 1.0 / len(parts)
+            else:
+                parts = [dr]
+            for p in parts:
+                row = rows.get(p.id)
+                if row is not None:
+                    snapshot.amounts[row, 0] += amount
+
+        return snapshot
+
     def stop(self):
         print("Stock exchange stopping in 1 second...")
         self._thread.stop()
@@ -25,14 +25,15 @@ Possible todos
 @author: Rob
 '''
 
+import functools
 import math
 import numpy
-import random
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import time
 
 import quartjes.controllers.database
-from quartjes.connector.services import remote_service, remote_method, remote_event
+from quartjes.controllers.pricing import PricingEngine, add_pricing_engine, take_sales_snapshot
+from quartjes.connector.services import cacheable, remote_service, remote_method, remote_event
 from quartjes.models.drink import Mix, History
 
 debug_mode = False
@@ -56,52 +57,473 @@ def timed(F):
         return F
     
 
-max_sales_age = 30 * 60
+default_max_sales_age = 30 * 60
 """
-Maximum age of sales information in seconds.
+Default maximum age of sales information in seconds.
 """
 
-def linear_demand_time_correction(value, age):
+def linear_demand_time_correction(value, age, max_age=None):
     """
     Linear function to correct demand for age.
     """
-    if (age >= max_sales_age):
+    if max_age is None:
+        max_age = default_max_sales_age
+    if (age >= max_age):
         return 0.0
     
-    return float(value) * (1 - age / max_sales_age)
+    return float(value) * (1 - age / max_age)
 
-def sqrt_demand_time_correction(value, age):
+def sqrt_demand_time_correction(value, age, max_age=None):
     """
     Demand correction based on square root
     """
-    if (age >= max_sales_age):
+    if max_age is None:
+        max_age = default_max_sales_age
+    if (age >= max_age):
         return 0.0
     
-    return float(value) * math.sqrt(1 - age / max_sales_age)
+    return float(value) * math.sqrt(1 - age / max_age)
     
-def square_demand_time_correction(value, age):
+def square_demand_time_correction(value, age, max_age=None):
     """
     Demand correction based on square
     """
-    if (age >= max_sales_age):
+    if max_age is None:
+        max_age = default_max_sales_age
+    if (age >= max_age):
         return 0.0
     
-    return float(value) * math.pow(1 - age / max_sales_age, 2)
+    return float(value) * math.pow(1 - age / max_age, 2)
 
 default_demand_time_correction = linear_demand_time_correction
 """
 Default function used to for correction of demand over time. Change this if you do not like the default.
 """
 
+def _age_weights(ages, max_age):
+    """
+    Weight of sales for the given ages, dropping to 0 at the maximum age.
+    """
+    if max_age is None:
+        max_age = default_max_sales_age
+    return numpy.clip(1 - ages / float(max_age), 0.0, 1.0)
+
+def linear_demand_time_correction_kernel(values, ages, max_age=None):
+    """
+    Vectorized version of :func:`linear_demand_time_correction`. Accepts and
+    returns numpy arrays.
+    """
+    return values * _age_weights(ages, max_age)
+
+def sqrt_demand_time_correction_kernel(values, ages, max_age=None):
+    """
+    Vectorized version of :func:`sqrt_demand_time_correction`. Accepts and
+    returns numpy arrays.
+    """
+    return values * numpy.sqrt(_age_weights(ages, max_age))
+
+def square_demand_time_correction_kernel(values, ages, max_age=None):
+    """
+    Vectorized version of :func:`square_demand_time_correction`. Accepts and
+    returns numpy arrays.
+    """
+    return values * numpy.square(_age_weights(ages, max_age))
+
+demand_time_correction_kernels = {linear_demand_time_correction: linear_demand_time_correction_kernel,
+                                  sqrt_demand_time_correction: sqrt_demand_time_correction_kernel,
+                                  square_demand_time_correction: square_demand_time_correction_kernel}
+"""
+Vectorized kernels for the demand correction functions. Add an entry when adding a correction function,
+otherwise the function is called for each sale separately. Functions and kernels listed here accept the
+maximum age of sales as the max_age keyword argument.
+"""
+
+def get_demand_time_correction(correction, max_age=None):
+    """
+    Get a demand correction function using the given maximum age of sales.
+    
+    Parameters
+    ----------
+    correction : callable object
+        Function accepting a sales amount and an age, returning the corrected demand.
+    max_age : float
+        Maximum age of sales in seconds. Only used by the functions in
+        :data:`demand_time_correction_kernels`. Defaults to :data:`default_max_sales_age`.
+    
+    Returns
+    -------
+    correction : callable object
+        Function accepting a sales amount and an age.
+    """
+    if correction in demand_time_correction_kernels:
+        return functools.partial(correction, max_age=max_age)
+    return correction
+
+def get_demand_time_correction_kernel(correction, max_age=None):
+    """
+    Get the vectorized kernel for a demand correction function.
+    
+    Parameters
+    ----------
+    correction : callable object
+        Function accepting a sales amount and an age, returning the corrected demand.
+    max_age : float
+        Maximum age of sales in seconds, see :func:`get_demand_time_correction`.
+    
+    Returns
+    -------
+    kernel : callable object
+        Function accepting arrays of amounts and ages, returning an array of corrected demands.
+    """
+    kernel = demand_time_correction_kernels.get(correction)
+    if kernel is None:
+        return numpy.vectorize(correction, otypes=[float])
+    return functools.partial(kernel, max_age=max_age)
+
+def calculate_demands(amounts, timestamps, price_factors, now, kernel):
+    """
+    Calculate the total demand for multiple drinks at once. Each row of the
+    arrays contains the sales of one drink. Rows can be padded with zero amounts.
+    
+    Parameters
+    ----------
+    amounts : numpy array
+        Amounts sold, shape (drinks, sales).
+    timestamps : numpy array
+        Time of each sale, same shape as amounts.
+    price_factors : numpy array
+        Price factor at the time of each sale, same shape as amounts.
+    now : float
+        Current time.
+    kernel : callable object
+        Vectorized demand correction, see :func:`get_demand_time_correction_kernel`.
+    
+    Returns
+    -------
+    demands : numpy array
+        Total demand of each drink, weighed for time passed.
+    """
+    ages = numpy.maximum(now - timestamps, 0.0)
+    return (kernel(amounts, ages) * price_factors).sum(axis=1)
+
+
+class RoundBuckets(object):
+    """
+    Sales grouped per round for each drink, kept up to date while selling.
+    
+    For each drink the amount sold and the last price factor are stored per
+    round in a circular buffer. All drinks share the same rounds, so closing a
+    round only moves the start of the buffers. The sales history of a drink is
+    only read once, when the drink is first seen.
+    
+    Rounds for which a drink has no data, because it is newer than other
+    drinks, are filled with the average amount of the drinks that do have
+    data. Rounds before any drink has data are filled with an amount of 1.
+    
+    Parameters
+    ----------
+    rounds : int
+        Number of closed rounds to keep.
+    round_time : float
+        Time in seconds between rounds.
+    start_time : float
+        Start time of the first round. Defaults to the current time.
+    """
+    
+    def __init__(self, rounds, round_time, start_time=None):
+        self._rounds = rounds
+        self._round_time = round_time
+        self._columns = rounds + 1 # Including the round that is still open
+        self._head = 0 # Column of the open round
+        self._round_start = start_time if start_time is not None else time.time()
+        self._end_times = numpy.empty(self._columns)
+        self._end_times.fill(numpy.nan)
+        self._rows = {}
+        self._free_rows = []
+        self._amounts = numpy.zeros((0, self._columns))
+        self._price_factors = numpy.zeros((0, self._columns))
+        self._known = numpy.zeros(0, dtype=int) # Number of rounds with data, including the open round
+        self._lock = Lock()
+    
+    def add_sale(self, drink, amount, timestamp, price_factor):
+        """
+        Add a sale of a drink. Must not be a mix.
+        
+        Parameters
+        ----------
+        drink : :class:`quartjes.models.drink.Drink`
+            The drink sold. If it was not seen before, its sales history is
+            read first. Add the sale to the history afterwards.
+        amount : number
+            Amount sold.
+        timestamp : float
+            Time of the sale.
+        price_factor : float
+            Price factor at the time of the sale.
+        """
+        with self._lock:
+            row = self._row(drink)
+            column = self._column(timestamp)
+            if column is not None:
+                self._amounts[row, column] += amount
+                self._price_factors[row, column] = price_factor
+    
+    def close_round(self, now, drinks):
+        """
+        Close the current round and start a new one.
+        
+        Parameters
+        ----------
+        now : float
+            End time of the round.
+        drinks : iterable of :class:`quartjes.models.drink.Drink`
+            Drinks to keep. Drinks not seen before are added, other drinks are
+            removed.
+        """
+        with self._lock:
+            drinks = set(drinks)
+            for drink in drinks:
+                self._row(drink)
+            for drink in [drink for drink in self._rows if not drink in drinks]:
+                row = self._rows.pop(drink)
+                self._known[row] = 0
+                self._free_rows.append(row)
+            
+            self._end_times[self._head] = now
+            self._head = (self._head + 1) % self._columns
+            self._end_times[self._head] = numpy.nan
+            self._amounts[:, self._head] = 0.0
+            self._price_factors[:, self._head] = 0.0
+            numpy.minimum(self._known + 1, self._columns, self._known)
+            self._known[self._free_rows] = 0
+            self._round_start = now
+    
+    def arrays(self, drinks):
+        """
+        Get the sales per closed round of the given drinks, oldest round first.
+        
+        Parameters
+        ----------
+        drinks : list of :class:`quartjes.models.drink.Drink`
+            Drinks to get the sales for. All must have been added.
+        
+        Returns
+        -------
+        amounts : numpy array
+            Amount sold per drink per round, shape (drinks, rounds).
+        timestamps : numpy array
+            End time of each round, same shape as amounts.
+        price_factors : numpy array
+            Last price factor per drink per round, same shape as amounts.
+        """
+        with self._lock:
+            ages = numpy.arange(self._rounds, 0, -1)
+            columns = (self._head - ages) % self._columns
+            
+            known = self._known[:, None] > ages[None, :]
+            counts = known.sum(axis=0)
+            amounts = self._amounts[:, columns]
+            averages = numpy.where(known, amounts, 0.0).sum(axis=0) / numpy.maximum(counts, 1)
+            averages[counts == 0] = 1.0
+            
+            rows = [self._rows[drink] for drink in drinks]
+            known = known[rows]
+            amounts = numpy.where(known, amounts[rows], averages[None, :])
+            price_factors = numpy.where(known, self._price_factors[rows][:, columns], 1.0)
+            
+            timestamps = self._end_times[columns]
+            last_end = self._end_times[(self._head - 1) % self._columns]
+            if last_end != last_end:
+                last_end = self._round_start
+            missing = timestamps != timestamps
+            timestamps[missing] = last_end - (ages[missing] - 1) * self._round_time
+            
+            return amounts, numpy.tile(timestamps, (len(rows), 1)), price_factors
+    
+    def history(self, drink):
+        """
+        Get the sales per closed round of a drink.
+        
+        Parameters
+        ----------
+        drink : :class:`quartjes.models.drink.Drink`
+            The drink to get the sales for.
+        
+        Returns
+        -------
+        history : list of :class:`quartjes.models.drink.History`
+            Sales per round, oldest first.
+        """
+        (amounts, timestamps, price_factors) = self.arrays([drink])
+        return [History(None, amount, timestamp, drink.unit_price, price_factor) 
+                for (amount, timestamp, price_factor) in zip(amounts[0], timestamps[0], price_factors[0])]
+    
+    @property
+    def rounds(self):
+        """
+        Number of closed rounds kept.
+        """
+        return self._rounds
+    
+    def __contains__(self, drink):
+        return drink in self._rows
+    
+    def _column(self, timestamp):
+        """
+        Get the column for a sale at the given time, or None if it is too old.
+        """
+        if timestamp >= self._round_start:
+            age = 0
+        else:
+            age = 1 + int((self._round_start - timestamp) // self._round_time)
+            if age >= self._columns:
+                return None
+        return (self._head - age) % self._columns
+    
+    def _row(self, drink):
+        """
+        Get the row of a drink, adding it using its sales history if needed.
+        """
+        row = self._rows.get(drink)
+        if row is not None:
+            return row
+        
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            row = len(self._known)
+            size = max(16, 2 * row)
+            self._amounts = numpy.resize(self._amounts, (size, self._columns))
+            self._price_factors = numpy.resize(self._price_factors, (size, self._columns))
+            self._known = numpy.resize(self._known, size)
+            self._free_rows = range(size - 1, row, -1)
+            self._known[row:] = 0
+        self._rows[drink] = row
+        
+        self._amounts[row] = 0.0
+        self._price_factors[row] = 0.0
+        known = 1
+        history = drink._sales_history
+        for (amount, timestamp, price_factor) in zip(history.amounts, history.timestamps, history.price_factors):
+            column = self._column(timestamp)
+            if column is not None:
+                self._amounts[row, column] += amount
+                self._price_factors[row, column] = price_factor
+                known = max(known, (self._head - column) % self._columns + 1)
+        self._known[row] = known
+        return row
+
+class StockExchange2Engine(PricingEngine):
+    """
+    Pricing engine of version 2 of the stock exchange.
+    
+    The price factor of each drink is the average demand divided by the demand
+    for the drink. The demand is the sum of all recent sales, weighed for the
+    time passed and the price factor at the time of the sale. Drinks without
+    sales get the average demand. Demands deviating too much from the average
+    are clamped and left out of the average.
+    
+    Parameters
+    ----------
+    maximum_deviation : float
+        Maximum number of standard deviations allowed for demand values.
+    maximum_price_factor : float
+        Maximum value the price factor may attain.
+    minimum_price_factor : float
+        Minimum value the price factor may attain.
+    demand_time_correction : callable object
+        Function used to change weight of demand over time.
+    max_sales_age : float
+        Maximum age of sales information in seconds. Defaults to
+        :data:`default_max_sales_age`.
+    """
+    
+    name = "stock_exchange2"
+    
+    def __init__(self, maximum_deviation=2, maximum_price_factor=3.0, minimum_price_factor=0.3,
+                 demand_time_correction=None, max_sales_age=None):
+        self.maximum_deviation = maximum_deviation
+        self.maximum_price_factor = maximum_price_factor
+        self.minimum_price_factor = minimum_price_factor
+        self.demand_time_correction = demand_time_correction or default_demand_time_correction
+        self.max_sales_age = max_sales_age or default_max_sales_age
+    
+    def calculate(self, snapshot):
+        rows = ~snapshot.mixes
+        kernel = get_demand_time_correction_kernel(self.demand_time_correction, self.max_sales_age)
+        demands = calculate_demands(snapshot.amounts[rows], snapshot.timestamps[rows],
+                                    snapshot.sale_price_factors[rows], snapshot.now, kernel)
+        sold = demands > 0
+        if not sold.any():
+            return {} # No activity, stop for now
+        
+        (average_demand, demand_std) = self._statistics(demands, sold)
+        demands[~sold] = average_demand
+        (min_demand, max_demand) = self._limits(average_demand, demand_std)
+        
+        # Recalculate ignoring the demands that are too high or too low
+        too_low = demands < min_demand
+        too_high = demands > max_demand
+        if too_low.any() or too_high.any():
+            inliers = sold & ~too_low & ~too_high
+            if inliers.any():
+                (average_demand, demand_std) = self._statistics(demands, inliers)
+                demands[~sold] = average_demand
+                (min_demand, max_demand) = self._limits(average_demand, demand_std)
+            demands[too_low] = min_demand
+            demands[too_high] = max_demand
+        
+        if debug_mode:
+            print("Average demand: %f" % average_demand)
+            print("Std deviation: %f" % demand_std)
+            print("Nr of drinks without sales: %d" % (~sold).sum())
+            print("Nr of drinks out of bounds: %d" % (too_low | too_high).sum())
+        
+        drink_ids = [drink_id for (drink_id, mix) in zip(snapshot.drink_ids, snapshot.mixes) if not mix]
+        return dict(zip(drink_ids, (average_demand / demands).tolist()))
+    
+    def _statistics(self, demands, selection):
+        """
+        Average and standard deviation of the selected demands.
+        """
+        selected = demands[selection]
+        return float(selected.mean()), float(selected.std())
+    
+    def _limits(self, average_demand, demand_std):
+        """
+        Minimum and maximum demand allowed.
+        """
+        return (max(average_demand - self.maximum_deviation * demand_std,
+                    average_demand / self.maximum_price_factor),
+                min(average_demand + self.maximum_deviation * demand_std,
+                    average_demand / self.minimum_price_factor))
+
+add_pricing_engine(StockExchange2Engine)
+
 @remote_service
 class StockExchange2(Thread):
     """
     Version 2 of the stock exchange.
     
     Exposes the same methods as version 1 for backwards compatibility.
+    
+    Parameters
+    ----------
+    engine : :class:`quartjes.controllers.pricing.PricingEngine`
+        Engine calculating the prices. Defaults to :class:`StockExchange2Engine`.
+    database : :class:`quartjes.controllers.database.Database`
+        Database containing the drinks. Defaults to the default database.
+    clock : callable object
+        Function returning the current time in seconds since epoch. Defaults
+        to time.time. Replace it to run the stock exchange in simulated time.
+    start_thread : bool
+        Start the thread recalculating the prices every round.
+    max_sales_age : float
+        Maximum age of sales information in seconds. Defaults to the maximum
+        age of the engine, or :data:`default_max_sales_age` for engines without one.
     """
     
-    def __init__(self):
+    def __init__(self, engine=None, database=None, clock=None, start_thread=True, max_sales_age=None):
         Thread.__init__(self, name='StockExchange2')
         
         # Time between recalculations (seconds)
@@ -109,28 +531,27 @@ class StockExchange2(Thread):
         self._round_time = 20
         
         # Reference to the database
-        self._db = quartjes.controllers.database.default_database()
-        
-        # Function used to change weight of demand over time.
-        self._demand_time_correction = default_demand_time_correction
+        self._db = database or quartjes.controllers.database.default_database()
         
-        # Maximum number of standard deviations allowed for demand values
-        self._maximum_deviation = 2
+        # Source of the current time
+        self._clock = clock or time.time
         
-        # Maximum value the price factor may attain
-        self._maximum_price_factor = 3.0
+        # Algorithm calculating the prices
+        self._engine = engine or StockExchange2Engine()
         
-        # Minimum value the price factor may attain
-        self._minimum_price_factor = 0.3
+        # Maximum age of sales taken into account (seconds)
+        self._max_sales_age = (max_sales_age or getattr(self._engine, "max_sales_age", None) or
+                               default_max_sales_age)
 
-        # Internal cache of normalized sales history. drink:[sales history]        
-        self._normalized_sales_history = {}
+        # Sales per round for each drink, updated while selling
+        self._sales_rounds = RoundBuckets(int(self._max_sales_age / self._round_time), self._round_time,
+                                          self._clock())
         
         # Event triggered when the stock exchange needs to shut down
         self._shutdown_event = Event()
         
         # Start ourselves
-        if not unit_test_mode:
+        if start_thread and not unit_test_mode:
             self.start()
         
     @remote_method
@@ -151,13 +572,23 @@ class StockExchange2(Thread):
         total_price : integer
             Total price of the sale in quartjes. If the drink does not exist, this will be None!
         """
-        local_drink = self._db.get(drink.id)
+        with self._db.drink_lock(drink):
+            local_drink = self._db.get(drink.id)
 
-        if not local_drink:
-            return None
-        
-        total_price = amount * local_drink.current_price_quartjes
-        local_drink.add_sales_history(amount)
+            if not local_drink:
+                return None
+            
+            total_price = amount * local_drink.current_price_quartjes
+            timestamp = self._clock()
+            if isinstance(local_drink, Mix):
+                # Same division of mix sales as Mix.update_components_sale
+                parts = len(local_drink.drinks)
+                for component in local_drink.drinks:
+                    self._sales_rounds.add_sale(component, amount / parts, timestamp, local_drink.price_factor)
+            else:
+                self._sales_rounds.add_sale(local_drink, amount, timestamp, local_drink.price_factor)
+            local_drink.add_sales_history(amount, timestamp)
+            self._db.mark_dirty(local_drink, ("sales_history",))
         
         if debug_mode:
             print("Sold %d x %s for %d" % (amount, drink.name, total_price))
@@ -179,6 +610,7 @@ class StockExchange2(Thread):
         print("Changing the round time is not supported anymore")
 
     @remote_method
+    @cacheable
     def get_round_time(self):
         """
         Get the time in seconds between rounds.
@@ -224,6 +656,13 @@ class StockExchange2(Thread):
         if debug_mode:
             print("\n*** Recalculating Prices ***")
         
+        with self._db.lock_all_drinks():
+            self._recalculate_locked_prices()
+
+    def _recalculate_locked_prices(self):
+        """
+        Recalculate the prices while holding the locks of all drinks.
+        """
         drinks = self._db.get_drinks()
         if len(drinks) == 0:
             return # Nothing to do here
@@ -233,62 +672,22 @@ class StockExchange2(Thread):
             if isinstance(drink, Mix):
                 drink.update_components_sale()
         
-        self._normalize_sales(drinks)
+        now = self._clock()
+        self._normalize_sales(drinks, now)
         
-        # Determine demand values
-        average_demand, demand_std, demand_per_drink = self._calculate_demands(drinks)
-        
-        if demand_per_drink is None:
+        price_factors = self._engine.calculate(self._take_sales_snapshot(drinks, now))
+        if not price_factors:
             return # No activity, stop for now
         
-        min_demand = max(average_demand - self._maximum_deviation * demand_std, average_demand / self._maximum_price_factor)
-        max_demand = min(average_demand + self._maximum_deviation * demand_std, average_demand / self._minimum_price_factor)
-        
-        demand_too_high = []
-        demand_too_low = []
-        
-        # Do a first check for demands that are too high or too low
-        for (drink, demand) in demand_per_drink:
-            
-            if not isinstance(drink, Mix):
-                if demand < min_demand:
-                    demand_too_low.append(drink)
-                    drinks.remove(drink)
-                    if debug_mode:
-                        print("%s : Deviates more than %d std or price factor below %f" % (drink.name, self._maximum_deviation, self._minimum_price_factor))
-                if demand > max_demand:
-                    demand_too_high.append(drink)
-                    drinks.remove(drink)
-                    if debug_mode:
-                        print("%s : Deviates more than %d std or price factor above %f" % (drink.name, self._maximum_deviation, self._maximum_price_factor))
-        
-        # Recalculate ignoring the demands that are too high or too low
-        assert len(drinks) > 0, "All drinks are out of bounds, how could that happen??"
-        if len(demand_too_high) > 0 or len(demand_too_low) > 0:
-            
-            if debug_mode:
-                print("New calculation of demands required")
-                
-            average_demand, demand_std, demand_per_drink = self._calculate_demands(drinks)
-            min_demand = max(average_demand - self._maximum_deviation * demand_std, average_demand / self._maximum_price_factor)
-            max_demand = min(average_demand + self._maximum_deviation * demand_std, average_demand / self._minimum_price_factor)
-            
-            for drink in demand_too_high:
-                demand_per_drink.append((drink, max_demand))
-            for drink in demand_too_low:
-                demand_per_drink.append((drink, min_demand))
-        
-        # Calculate the new prices
-        for (drink, demand) in demand_per_drink:
-            
-                drink.price_factor = average_demand / demand
-                if debug_mode:
-                    print("%s : Demand = %f" % (drink.name, demand))
+        for drink in drinks:
+            price_factor = price_factors.get(drink.id)
+            if price_factor is not None:
+                drink.price_factor = price_factor
         
         for drink in drinks:
             if isinstance(drink, Mix):
                 drink.update_properties()
-            drink.add_price_history()
+            drink.add_price_history(now)
             
             if debug_mode:
                 print("%s : Factor = %f, Price = %d" % (drink.name, drink.price_factor, drink.current_price_quartjes))
@@ -296,68 +695,64 @@ class StockExchange2(Thread):
                     print(drink.sales_history)
                     #assert False
         
-        self._db.force_save()
+        # Mixes change completely, the others get new prices and mix sales
+        for drink in self._db.get_drinks():
+            if isinstance(drink, Mix):
+                self._db.mark_dirty(drink)
+            else:
+                self._db.mark_dirty(drink, ("price_factor", "price_history", "sales_history"))
         self._notify_next_round()
         
         if debug_mode:
             print()
     
-    @timed
-    def _calculate_demands(self, drinks):
+    def _take_sales_snapshot(self, drinks, now):
+        """
+        Collect the sales per round of the given drinks for the pricing engine.
+        The round of sales must have been closed already.
+        """
+        snapshot = take_sales_snapshot(drinks, now, self._sales_rounds.rounds)
+        components = [drink for drink in drinks if not isinstance(drink, Mix)]
+        if components:
+            rows = ~snapshot.mixes
+            (snapshot.amounts[rows], snapshot.timestamps[rows],
+             snapshot.sale_price_factors[rows]) = self._sales_rounds.arrays(components)
+        return snapshot
+    
+    def _calculate_demand_values(self, drinks):
         """
-        Calculate the demands of all drinks.
-        * Make sure mix sales are processed
-        * If demand = 0 (e.g. no sales at all or only old sales) use the
-          average demand (calculated without the 0s)
+        Calculate the total demand for all given drinks at once. Gives the same
+        results as :meth:`_calculate_demand` for each drink, using vectorized
+        calculations on arrays of the sales history.
         
         Parameters
         ----------
-        drinks : iterable of :class:`quartjes.models.drink.Drink`
+        drinks : list of :class:`quartjes.models.drink.Drink`
             Drinks to calculate demand for.
-        
+            
         Returns
         -------
-        average_demand : float
-            The average demand after all calculations and corrections.
-        std_deviation : float
-            Standard deviation of the demands.
-        demand_per_drink : list of tuples
-            A list of tuples where each tuple is (drink, demand)
-        
+        demands : numpy array
+            Total demand for each drink over a limited period weighed for time passed.
         """
-        
-        total_demand = 0.0
-        demand_per_drink = [] # Will contain tuples of (drink, demand)
-        demand_values = [] # Only the demand values for standard deviation calculation
-        drinks_without_sales = []
-        
-        for drink in drinks:
-            if not isinstance(drink, Mix):
-                demand = self._calculate_demand(drink)
-                total_demand += demand
-                if demand > 0:
-                    demand_per_drink.append((drink, demand))
-                    demand_values.append(demand)
-                else:
-                    drinks_without_sales.append(drink)
-        
-        if len(demand_per_drink) > 0:
-            average_demand = total_demand / len(demand_per_drink)
-            std_deviation = numpy.std(demand_values)
-        else:
-            return 0.0, 0.0, None
-
-        for drink in drinks_without_sales:
-            demand_per_drink.append((drink, average_demand))
-
-        if debug_mode:
-            print("Average demand: %f" % average_demand)
-            print("Std deviation: %f" % std_deviation)
-            print("Nr of drinks without sales: %d" % len(drinks_without_sales))
-        
-        
-        return average_demand, std_deviation, demand_per_drink
-        
+        kernel = get_demand_time_correction_kernel(self._demand_time_correction, self._max_sales_age)
+        if all(drink in self._sales_rounds for drink in drinks):
+            (amounts, timestamps, price_factors) = self._sales_rounds.arrays(drinks)
+            return calculate_demands(amounts, timestamps, price_factors, self._clock(), kernel)
+        
+        if debug_mode and not unit_test_mode:
+            assert False, "Not all drinks present in normalized history!"
+        
+        # Use the raw sales history, padded to equal length
+        histories = [drink._sales_history for drink in drinks]
+        length = max([len(history) for history in histories] or [0])
+        arrays = numpy.zeros((3, len(drinks), length))
+        for (row, history) in enumerate(histories):
+            start = length - len(history)
+            arrays[0, row, start:] = history.amounts
+            arrays[1, row, start:] = history.timestamps
+            arrays[2, row, start:] = history.price_factors
+        return calculate_demands(arrays[0], arrays[1], arrays[2], self._clock(), kernel)
     
     def _calculate_demand(self, drink):
         """
@@ -365,6 +760,9 @@ class StockExchange2(Thread):
         limited amount of history. Each sale is weighted for the amount of
         time passed since the sale. Also the sale price is taken into account.
         
+        This is the reference implementation of :meth:`_calculate_demand_values`
+        for a single drink.
+        
         Parameters
         ----------
         drink : :class:`quartjes.models.drink.Drink`
@@ -375,11 +773,13 @@ class StockExchange2(Thread):
         demand : float
             Total demand over a limited period weighed for time passed.
         """
-        current_time = time.time()
+        current_time = self._clock()
         demand = 0.0
+        demand_time_correction = get_demand_time_correction(self._demand_time_correction, self._max_sales_age)
         
-        sales_history = self._normalized_sales_history.get(drink)
-        if sales_history is None:
+        if drink in self._sales_rounds:
+            sales_history = self._sales_rounds.history(drink)
+        else:
             if debug_mode and not unit_test_mode:
                 print(drink)
                 assert False, "Not present in normalized history!"
@@ -390,119 +790,45 @@ class StockExchange2(Thread):
             if age < 0: 
                 age = 0
             
-            demand += self._demand_time_correction(sales_item.amount, age) * sales_item.price_factor
+            demand += demand_time_correction(sales_item.amount, age) * sales_item.price_factor
         
         return demand
     
+    @property
+    def _demand_time_correction(self):
+        """
+        Demand time correction of the engine, or the default for engines
+        without one.
+        """
+        return getattr(self._engine, "demand_time_correction", default_demand_time_correction)
+    
     @timed
-    def _normalize_sales(self, drinks):
+    def _normalize_sales(self, drinks, now=None):
         """
-        Group the sales together for each round. If a drink has less history than others, use the average sales
-        for each round it did not have price history yet.
-        
-        This method expects the round times for all drinks to be equal. That should always be the case in the
-        current implementation, but it is something to keep in mind in later additions that might influence round
-        times.
-        
-        An internal cache of the normalized history is kept. It is rebuild at the first run, and kept up to date
-        at the end of each round.
+        Close the current round of sales. Sales are grouped per round while
+        selling, see :class:`RoundBuckets`. Drinks that are new get their
+        sales history grouped here, drinks that are no longer present are
+        removed.
         
-        Mix sales should already be propagated to the components.
+        Mix sales are added to the components while selling.
         
         Parameters
         ----------
         drinks
             The drinks to normalize sales for.
+        now : float
+            End time of the round. Defaults to the current time.
         """
-        # Remove drinks that are no longer present
-        for drink in self._normalized_sales_history.keys():
-            if not drink in drinks:
-                del self._normalized_sales_history[drink]
-        
-        # Group sales per round for each drink
-        now = time.time()
-        for drink in drinks:
-            norm_sales = self._normalized_sales_history.get(drink, None)
-            if norm_sales is None:
-                # No normalized history yet, need to get full history
-                norm_sales = []
-                self._normalized_sales_history[drink] = norm_sales
-                need_full_history = True
-                start_of_round = now - self._round_time
-            else:
-                # Expect normalization also occurred during previous round
-                need_full_history = False
-                start_of_round = norm_sales[-1].timestamp
-            
-            # Go over the drink history
-            norm_sales_item = History(amount=0, timestamp=now, price=0, price_factor=0)
-            norm_sales.append(norm_sales_item)
-            for history_item in reversed(drink.sales_history):
-                if history_item.timestamp < start_of_round:
-                    if need_full_history:
-                        norm_sales_item = History(amount=0, timestamp=start_of_round, price=0, price_factor=0)
-                        norm_sales.insert(0, norm_sales_item)
-                        start_of_round -= self._round_time
-                    else:
-                        break
-                
-                norm_sales_item._amount += history_item._amount
-                norm_sales_item._price = history_item._price
-                norm_sales_item._price_factor = history_item._price_factor
-                        
-        
-        # Find whether we need to extend the history
-        max_length = int(max_sales_age / self._round_time)
-        min_length = max_length
-        for drink, history in self._normalized_sales_history.items():
-            if len(history) < min_length:
-                min_length = len(history)
-        
-        # Normalize all drinks to match the longest history (discard everything after max age)
-        # Expect the normalized history is kept in sync, so each round has an entry
-        if min_length < max_length:
-            history_to_extend = {}
-            for age in range(min_length + 1, max_length + 1):
-                average = 0.0
-                count = 0
-                timestamp = 0
-                for drink, history in self._normalized_sales_history.items():
-                    if len(history) >= age:
-                        average += history[-age].amount
-                        count += 1
-                        timestamp = history[-age].timestamp
-                    else:
-                        history_to_extend[drink] = history
-                
-                if count == 0:
-                    # End of history
-                    break
-                
-                average /= count
-                for drink, history in history_to_extend.items():
-                    history.insert(0, History(None, average, timestamp, drink.unit_price, 1.0))
-        
-        # Extend or trim to max size
-        current_length = len(self._normalized_sales_history.values()[0])
-        if current_length < max_length:
-            # Use timestamp of oldest item in first history
-            timestamp = self._normalized_sales_history.values()[0][0].timestamp
-            
-            for _ in range(age, max_length):
-                timestamp -= self._round_time
-                for drink, history in self._normalized_sales_history.items():
-                    history.insert(0, History(None, 1.0, timestamp, drink.unit_price, 1.0))
-                    
-        elif current_length > max_length:
-            for history in self._normalized_sales_history.values():
-                del history[:-max_length]
+        if now is None:
+            now = self._clock()
+        self._sales_rounds.close_round(now, [drink for drink in drinks if not isinstance(drink, Mix)])
         
         # Output for debug purposes
         if debug_mode:
-            for drink, history in self._normalized_sales_history.items():
-                print(drink.name)
-                for h in history:
-                    print(vars(h))
+            for drink in drinks:
+                if drink in self._sales_rounds:
+                    (amounts, _, _) = self._sales_rounds.arrays([drink])
+                    print("%s : %r" % (drink.name, amounts[0, -5:]))
 
         
     def _notify_next_round(self):
@@ -510,122 +836,3 @@ class StockExchange2(Thread):
         Fire the on_next_round event.
         """
         self.on_next_round()
-
-class time_mock(object):
-    """
-    Mock class for the time module.
-    Use this to quickly skip forward in time. It starts with the time at which it is instantiated and then increases
-    with one second every time do_tick is called.
-    """
-    
-    def __init__(self):
-        self._now = time.time()
-    
-    def do_tick(self):
-        self._now += 1.0
-    
-    def time(self):
-        return self._now
-
-def install_time_mock():
-    """
-    Replace the installed time module with a mock class
-    """
-    global time
-    time = time_mock()
-    
-    quartjes.models.drink.time = time
-
-class PriceAgnosticDrinkRandomizer(object):
-    def __init__(self, drinks):
-        self._drinks = drinks
-        
-        self._max_priority = 0
-        self._prioritized_drinks = {}
-        
-        self.update()
-    
-    def update(self):
-        new_drinks = {}
-        position = 0
-        for drink in self._drinks:
-            new_drinks[position] = drink
-            position += int(1000.0 / drink.price_factor)
-        
-        self._max_priority, self._prioritized_drinks = position, new_drinks
-
-    
-    def get_random_drink(self):
-        rand_pos = random.randint(0, self._max_priority)
-        pos = 0
-        for p in self._prioritized_drinks:
-            if p > pos and p <= rand_pos:
-                pos = p
-        
-        return self._prioritized_drinks[pos]
-
-def simulate(run_time, store_results=True):
-    '''
-    Simulate running the stock exchange. Uses a time mock to fast forward and
-    simulates a client doing several buys.
-    
-    Parameters
-    ----------
-    run_time : int
-        Time in seconds to run.
-    '''
-    global unit_test_mode
-    unit_test_mode = True
-    install_time_mock()
-    
-    exchange = StockExchange2()
-    exchange._db.reset()
-    drinks = exchange._db.get_drinks()
-    rng = random.Random()
-    randomizer = PriceAgnosticDrinkRandomizer(drinks)
-    
-    if store_results:
-        price_csv = open("stock_exchange2_prices.csv", "w")
-        demand_csv = open("stock_exchange2_demands.csv", "w")
-        
-        names = ["time"]
-        for drink in drinks:
-            names.append(drink.name)
-        print(";".join(names), file=price_csv)
-        print(";".join(names), file=demand_csv)
-    
-    start_time = time.time()
-    
-    try:
-        # run for 12 hours
-        runs = run_time / exchange.get_round_time()
-        for r in range(0, runs):
-            print("Run %d of %d" % (r + 1, runs))
-            for _ in range(0, exchange.get_round_time()):
-                if rng.randint(0, 5) < 2:
-                    exchange.sell(randomizer.get_random_drink(), rng.randint(1, 3) * (1 + drink.alc_perc / 10))
-                time.do_tick()
-            exchange._recalculate_prices()
-            randomizer.update()
-            
-            if store_results:
-                prices = [str(time.time() - start_time)]
-                demands = [str(time.time() - start_time)]
-                for drink in drinks:
-                    prices.append(str(drink.price_factor))
-                    demands.append(str(exchange._calculate_demand(drink)))
-                print(";".join(prices), file=price_csv)
-                print(";".join(demands), file=demand_csv)
-    finally:
-        if store_results:
-            price_csv.close()
-            demand_csv.close()
-
-if __name__ == "__main__":
-    # Do a self test
-    
-    simulate(12 * 60 * 60)
-    
-    
-    
-    
\ No newline at end of file
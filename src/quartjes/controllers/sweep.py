@@ -0,0 +1,210 @@
+"""
+Parallel parameter sweeps for tuning the pricing of the stock exchange.
+
+Every combination of parameters is simulated with a number of seeds, see
+:mod:`quartjes.controllers.simulation`. The simulations are spread over a
+pool of processes, one parameter set and seed per task. For each simulation
+the stability of the prices and the revenue are measured, see
+:func:`simulation_metrics`.
+
+Parameters of a sweep are given as a dictionary. Supported keys:
+
+* maximum_deviation, maximum_price_factor, minimum_price_factor,
+  demand_time_correction and max_sales_age, passed to
+  :class:`quartjes.controllers.stock_exchange2.StockExchange2Engine`. The
+  demand time correction is given by name, see :data:`demand_time_corrections`.
+* sales_rate and price_sensitivity, passed to
+  :class:`quartjes.controllers.simulation.Simulation`.
+
+Run a small sweep from the command line using::
+
+    python -m quartjes.controllers.sweep [hours] [seeds]
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import itertools
+import multiprocessing
+import sys
+
+import numpy
+
+import quartjes.controllers.stock_exchange2 as stock_exchange2
+from quartjes.controllers.simulation import Simulation
+
+demand_time_corrections = {"linear": stock_exchange2.linear_demand_time_correction,
+                           "sqrt": stock_exchange2.sqrt_demand_time_correction,
+                           "square": stock_exchange2.square_demand_time_correction}
+"""
+Demand time correction functions by name.
+"""
+
+engine_parameters = ("maximum_deviation", "maximum_price_factor", "minimum_price_factor",
+                     "demand_time_correction", "max_sales_age")
+"""
+Keys of the parameters passed to the pricing engine.
+"""
+
+simulation_parameters = ("sales_rate", "price_sensitivity")
+"""
+Keys of the parameters passed to the simulation.
+"""
+
+
+def parameter_grid(**values):
+    """
+    Create all combinations of the given parameter values.
+
+    Parameters
+    ----------
+    values
+        List of values for each parameter.
+
+    Returns
+    -------
+    parameter_sets : list of dict
+        One dictionary for each combination.
+    """
+    names = sorted(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values[name] for name in names])]
+
+
+def simulation_metrics(result, minimum_price_factor, maximum_price_factor):
+    """
+    Measure the stability of the prices and the revenue of a simulation.
+    Mixes are left out of the price metrics, their prices follow their
+    components.
+
+    Parameters
+    ----------
+    result : :class:`quartjes.controllers.simulation.SimulationResult`
+        Results of the simulation.
+    minimum_price_factor : float
+        Minimum price factor allowed by the engine.
+    maximum_price_factor : float
+        Maximum price factor allowed by the engine.
+
+    Returns
+    -------
+    metrics : dict
+        volatility
+            Standard deviation of the relative change in price factor per
+            round, averaged over all drinks.
+        pinned_min, pinned_max
+            Fraction of the rounds the drinks spent at the minimum or maximum
+            price factor.
+        revenue
+            Total quartjes earned.
+    """
+    factors = result.price_factors[:, ~result.mixes]
+    if len(factors) > 1:
+        volatility = float(numpy.diff(numpy.log(factors), axis=0).std(axis=0).mean())
+    else:
+        volatility = 0.0
+    return {"volatility": volatility,
+            "pinned_min": float(numpy.isclose(factors, minimum_price_factor).mean()),
+            "pinned_max": float(numpy.isclose(factors, maximum_price_factor).mean()),
+            "revenue": float(result.revenue.sum())}
+
+
+def run_simulation(parameters, seed, run_time):
+    """
+    Run one simulation of a sweep.
+
+    Parameters
+    ----------
+    parameters : dict
+        Parameters of the simulation, see the module documentation.
+    seed : int
+        Seed for the random generator.
+    run_time : float
+        Time in seconds to simulate.
+
+    Returns
+    -------
+    metrics : dict
+        Metrics of the simulation, see :func:`simulation_metrics`.
+    """
+    engine_kwargs = dict((key, value) for (key, value) in parameters.items() if key in engine_parameters)
+    if "demand_time_correction" in engine_kwargs:
+        engine_kwargs["demand_time_correction"] = demand_time_corrections[engine_kwargs["demand_time_correction"]]
+    engine = stock_exchange2.StockExchange2Engine(**engine_kwargs)
+    simulation_kwargs = dict((key, value) for (key, value) in parameters.items() if key in simulation_parameters)
+    result = Simulation(seed, engine=engine, **simulation_kwargs).run(run_time)
+    return simulation_metrics(result, engine.minimum_price_factor, engine.maximum_price_factor)
+
+
+def _run_task(task):
+    """
+    Run a simulation in a worker process.
+    """
+    (parameters, seed, run_time) = task
+    return run_simulation(parameters, seed, run_time)
+
+
+def run_sweep(parameter_sets, seeds=(0,), run_time=12 * 60 * 60, processes=None):
+    """
+    Simulate every parameter set with every seed, in parallel.
+
+    Parameters
+    ----------
+    parameter_sets : list of dict
+        Parameters to simulate, see :func:`parameter_grid`.
+    seeds : list of int
+        Seeds to simulate each parameter set with.
+    run_time : float
+        Time in seconds to simulate.
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs. With 1
+        process the simulations run in the current process.
+
+    Returns
+    -------
+    results : list of tuples
+        (parameters, seed, metrics) for each simulation.
+    """
+    tasks = [(parameters, seed, run_time) for parameters in parameter_sets for seed in seeds]
+    if processes == 1:
+        metrics = [_run_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            metrics = pool.map(_run_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [(parameters, seed, result) for ((parameters, seed, _), result) in zip(tasks, metrics)]
+
+
+def summarize(results):
+    """
+    Average the metrics over the seeds of each parameter set.
+
+    Parameters
+    ----------
+    results : list of tuples
+        Results of :func:`run_sweep`.
+
+    Returns
+    -------
+    summary : list of tuples
+        (parameters, metrics) for each parameter set, in the order of the sweep.
+    """
+    grouped = []
+    for (parameters, _, metrics) in results:
+        if not grouped or grouped[-1][0] != parameters:
+            grouped.append((parameters, []))
+        grouped[-1][1].append(metrics)
+    return [(parameters, dict((key, sum(m[key] for m in metrics) / len(metrics)) for key in metrics[0]))
+            for (parameters, metrics) in grouped]
+
+
+if __name__ == "__main__":
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seed_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    grid = parameter_grid(maximum_deviation=[1.5, 2, 3], demand_time_correction=["linear", "sqrt", "square"])
+    for (parameters, metrics) in summarize(run_sweep(grid, range(seed_count), hours * 60 * 60)):
+        print("%-60s volatility=%.4f pinned_min=%.3f pinned_max=%.3f revenue=%.0f" %
+              (", ".join("%s=%s" % item for item in sorted(parameters.items())), metrics["volatility"],
+               metrics["pinned_min"], metrics["pinned_max"], metrics["revenue"]))
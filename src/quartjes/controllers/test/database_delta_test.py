@@ -0,0 +1,220 @@
+"""
+Unit tests for the incremental updates published by the database.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from quartjes.controllers.database import Database
+from quartjes.models.drink import Drink, Mix
+from quartjes.models.delta import DrinksDelta, take_snapshot, diff_drink
+
+class TestDrinkDiff(unittest.TestCase):
+    """
+    Test detecting and applying changes to a single drink.
+    """
+
+    def test_no_change(self):
+        """
+        An unchanged drink should not result in a change.
+        """
+        drink = Drink("cola")
+        drink.add_sales_history(1, 1.0)
+        self.assertIsNone(diff_drink(take_snapshot(drink), drink))
+
+    def test_fields_and_history(self):
+        """
+        Changed fields and appended history should be detected and applied.
+        """
+        drink = Drink("cola")
+        drink.add_price_history(1.0, 0.7)
+        remote = copy.deepcopy(drink)
+        snapshot = take_snapshot(drink)
+
+        drink.price_factor = 1.3
+        drink.add_price_history(2.0, 0.9)
+        drink.add_sales_history(2, 2.0)
+
+        change = diff_drink(snapshot, drink)
+        self.assertEqual(change.fields, {"price_factor": 1.3})
+        self.assertEqual(len(change.price_history), 1)
+        self.assertEqual(len(change.sales_history), 1)
+        self.assertFalse(change.reset_price_history)
+
+        change.apply(remote)
+        self.assertEqual(remote, drink)
+
+        change.apply(remote)
+        self.assertEqual(remote, drink, "Applying a change twice should be harmless")
+
+    def test_identical_sales(self):
+        """
+        Sales equal to the previous sale should not be mistaken for it.
+        """
+        drink = Drink("cola")
+        drink.add_sales_history(2, 100.0)
+        remote = copy.deepcopy(drink)
+        snapshot = take_snapshot(drink)
+
+        drink.add_sales_history(2, 100.0)
+        change = diff_drink(snapshot, drink, ("sales_history",))
+        self.assertIsNotNone(change, "The second sale should be detected")
+        self.assertEqual(len(change.sales_history), 1)
+        self.assertFalse(change.reset_sales_history)
+
+        change.apply(remote)
+        self.assertEqual(len(remote.sales_history), 2)
+        self.assertEqual(remote, drink)
+
+        change.apply(remote)
+        self.assertEqual(len(remote.sales_history), 2, "Applying a change twice should be harmless")
+
+    def test_cleared_history(self):
+        """
+        Clearing the history should be detected.
+        """
+        drink = Drink("cola")
+        drink.add_price_history(1.0, 0.7)
+        remote = copy.deepcopy(drink)
+        snapshot = take_snapshot(drink)
+
+        drink.clear_price_history()
+        drink.add_price_history(2.0, 0.9)
+
+        change = diff_drink(snapshot, drink)
+        self.assertTrue(change.reset_price_history)
+        change.apply(remote)
+        self.assertEqual(remote, drink)
+
+    def test_mix_components(self):
+        """
+        Changing the components of a mix requires sending the complete mix.
+        """
+        cola = Drink("cola")
+        mix = Mix("baco", [cola, Drink("bacardi")])
+        snapshot = take_snapshot(mix)
+        mix.drinks = [cola, cola]
+        self.assertIs(diff_drink(snapshot, mix), False)
+
+
+class TestDatabaseDelta(unittest.TestCase):
+    """
+    Test the deltas published by the database.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.db = Database(os.path.join(cls.directory, "database"))
+        cls.db.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.deltas = []
+        self.db.on_drinks_delta += self._delta_listener
+
+    def tearDown(self):
+        self.db.on_drinks_delta -= self._delta_listener
+
+    def _delta_listener(self, delta):
+        self.deltas.append(delta)
+
+    def test_delta_events(self):
+        """
+        Deltas should keep a local copy in sync with the database.
+        """
+        (epoch, version) = self.db.get_version()
+        local = copy.deepcopy(self.db.get_changes_since(version, epoch).apply(self.db.get_drinks()))
+
+        drink = Drink("cola")
+        self.db.add(drink)
+        self.db._store()
+        drink.add_sales_history(3, 10.0)
+        drink.price_factor = 1.5
+        self.db.force_save()
+        self.db._store()
+        self.db.remove(drink)
+        other = Drink("sinas")
+        self.db.add(other)
+        self.db._store()
+
+        self.assertEqual(len(self.deltas), 3)
+        for delta in self.deltas:
+            self.assertTrue(delta.applies_to(version, epoch), "Deltas should be consecutive")
+            delta.apply(local)
+            version = delta.to_version
+
+        self.assertEqual(len(self.deltas[1].added), 0, "Only changes should be sent")
+        self.assertEqual(len(self.deltas[1].changes), 1)
+        self.assertEqual(self.deltas[2].removed, [drink.id])
+        self.assertEqual(local, self.db.get_drinks())
+        self.assertEqual(self.db.get_version(), (epoch, version))
+
+    def test_changes_since(self):
+        """
+        A client should be able to catch up from an older version.
+        """
+        (epoch, version) = self.db.get_version()
+        local = copy.deepcopy(self.db.get_drinks())
+
+        drink = Drink("cassis")
+        self.db.add(drink)
+        self.db._store()
+        self.db.remove(drink)
+        self.db.add(Drink("7up"))
+        self.db._store()
+
+        delta = self.db.get_changes_since(version, epoch)
+        self.assertFalse(delta.full)
+        self.assertEqual(delta.to_version, version + 2)
+        delta.apply(local)
+        self.assertEqual(local, self.db.get_drinks())
+
+        delta = self.db.get_changes_since(version, uuid.uuid4())
+        self.assertTrue(delta.full, "Other epoch should require full resync")
+        self.assertEqual(DrinksDelta().apply(delta.apply([])), self.db.get_drinks())
+
+    def test_mark_dirty(self):
+        """
+        Only the marked drinks and fields should be compared.
+        """
+        cola = Drink("cola")
+        sinas = Drink("sinas")
+        sinas.add_price_history(1.0, 0.7)
+        self.db.add(cola)
+        self.db.add(sinas)
+        self.db._store()
+
+        cola.add_sales_history(2, 10.0)
+        cola.price_factor = 1.4
+        sinas.add_sales_history(1, 10.0)
+        self.db.mark_dirty(cola, ("sales_history",))
+        self.db._store()
+
+        delta = self.deltas[-1]
+        self.assertEqual(len(delta.changes), 1, "Only the marked drink should be compared")
+        self.assertEqual(delta.changes[0].drink_id, cola.id)
+        self.assertEqual(len(delta.changes[0].sales_history), 1)
+        self.assertEqual(delta.changes[0].fields, {}, "Unmarked fields should not be compared")
+
+        self.db.clear_history(sinas)
+        self.db.remove(cola)
+        self.db._store()
+
+        delta = self.deltas[-1]
+        self.assertEqual(delta.removed, [cola.id])
+        self.assertEqual(len(delta.changes), 1)
+        self.assertTrue(delta.changes[0].reset_price_history)
+        self.assertEqual(delta.changes[0].sales_history, [], "Unmarked history should not be compared")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,11 @@ features active.
 import unittest
 from quartjes.controllers.database import Database
 from quartjes.models.drink import Drink, Mix
+import os
 import random
+import shutil
+import tempfile
+import threading
 
 class TestDatabase(unittest.TestCase):
 
@@ -14,14 +18,15 @@ class TestDatabase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         print("Running offline")
-        cls.db = Database()
+        cls.directory = tempfile.mkdtemp()
+        cls.db = Database(os.path.join(cls.directory, "database"))
         cls.db.clear()
         cls.random = random.Random()
 
 
     @classmethod
     def tearDownClass(cls):
-        cls.db.reset()
+        shutil.rmtree(cls.directory)
 
     def test_add_drink(self):
         """
@@ -210,6 +215,41 @@ class TestDatabase(unittest.TestCase):
         self.assertIn(drink, self.db, "New drink should be added")
         self.assertEqual(self.db.count(), count + 1, "A drink should be added.")
 
+    def test_concurrent_add_remove(self):
+        """
+        Test adding and removing drinks from multiple threads while reading.
+        """
+        count = self.db.count()
+        drinks = [[self._create_random_drink() for _ in range(200)] for _ in range(4)]
+        
+        def add_remove(drinks):
+            for drink in drinks:
+                self.db.add(drink)
+            for drink in drinks[::2]:
+                self.db.remove(drink)
+        
+        threads = [threading.Thread(target=add_remove, args=(d,)) for d in drinks]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for drink in self.db.get_drinks():
+                self.assertIsNotNone(drink)
+        
+        self.assertEqual(self.db.count(), count + 400, "Half of the drinks should remain")
+        for d in drinks:
+            self.assertNotIn(d[0], self.db.get_drinks(), "Removed drink should be gone")
+            self.assertIn(d[1], self.db.get_drinks(), "Added drink should remain")
+    
+    def test_drink_lock(self):
+        """
+        Test that copies of a drink share the same lock.
+        """
+        drink = self._create_random_drink()
+        self.assertIs(self.db.drink_lock(drink), self.db.drink_lock(drink.id))
+        with self.db.lock_all_drinks():
+            with self.db.drink_lock(drink):
+                self.db.add(drink)
+        self.assertIn(drink, self.db.get_drinks())
     
     def _create_random_drink(self):
         drink = Drink()
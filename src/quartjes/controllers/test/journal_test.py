@@ -0,0 +1,123 @@
+"""
+Unit tests for the journal and the way the database uses it to persist changes.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import os
+import shutil
+import tempfile
+import unittest
+from quartjes.controllers import database
+from quartjes.controllers.database import Database
+from quartjes.controllers.journal import Journal
+from quartjes.models.drink import Drink
+
+class TestJournal(unittest.TestCase):
+    """
+    Test appending and replaying records.
+    """
+
+    def setUp(self):
+        (fd, self.file_name) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_replay(self):
+        """
+        Records should be replayed in order, also after reopening.
+        """
+        journal = Journal(self.file_name, sync=False)
+        journal.append({"a": 1})
+        journal.append([1, 2, 3])
+        journal.close()
+
+        journal = Journal(self.file_name, sync=False)
+        self.assertEqual(journal.replay(), [{"a": 1}, [1, 2, 3]])
+        journal.append("more")
+        self.assertEqual(journal.replay(), [{"a": 1}, [1, 2, 3], "more"])
+
+        journal.clear()
+        self.assertEqual(journal.replay(), [])
+        self.assertEqual(journal.size, 0)
+
+    def test_damaged_record(self):
+        """
+        A partially written record should be removed.
+        """
+        journal = Journal(self.file_name, sync=False)
+        journal.append("first")
+        size = journal.size
+        journal.append("second")
+        journal.close()
+
+        with open(self.file_name, "r+b") as f:
+            f.truncate(os.path.getsize(self.file_name) - 1)
+
+        journal = Journal(self.file_name, sync=False)
+        self.assertEqual(journal.replay(), ["first"])
+        self.assertEqual(journal.size, size, "Damaged record should be removed")
+        journal.append("third")
+        self.assertEqual(journal.replay(), ["first", "third"])
+
+
+class TestDatabaseJournal(unittest.TestCase):
+    """
+    Test that changes stored by the database survive a restart.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, "database")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_restart(self):
+        """
+        A new database should see the changes written to the journal.
+        """
+        db = Database(self.db_file)
+        db.clear()
+        drink = Drink("cola")
+        db.add(drink)
+        db._store()
+        drink.add_sales_history(2, 10.0)
+        drink.price_factor = 1.2
+        db.force_save()
+        db._store()
+        self.assertGreater(db._journal.size, 0, "Changes should be in the journal")
+
+        restarted = Database(self.db_file)
+        self.assertEqual(restarted.get_drinks(), db.get_drinks())
+        self.assertEqual(restarted._journal.size, 0, "Replayed journal should be compacted")
+
+    def test_compact(self):
+        """
+        A full journal should be replaced by a new copy of the database.
+        """
+        db = Database(self.db_file)
+        db.clear()
+        drink = Drink("cola")
+        db.add(drink)
+        db._store()
+
+        old_size = database.journal_compact_size
+        database.journal_compact_size = 1
+        try:
+            drink.price_factor = 1.2
+            db.mark_dirty(drink, ("price_factor",))
+            db._store()
+        finally:
+            database.journal_compact_size = old_size
+        self.assertEqual(db._journal.size, 0, "Journal should be emptied")
+
+        restarted = Database(self.db_file)
+        self.assertEqual(restarted.get_drinks(), db.get_drinks())
+        self.assertEqual(restarted.get(drink.id).price_factor, 1.2)
+
+if __name__ == "__main__":
+    unittest.main()
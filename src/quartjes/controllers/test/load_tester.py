@@ -0,0 +1,347 @@
+"""
+Load generator for the Quartjes server.
+
+Starts a number of simulated cash registers and display clients, each with
+its own connection to the server. The registers sell drinks at a rate given
+by a sale rate profile, the displays listen for updates of the drinks like
+the real displays do. Afterwards a report is printed with the latency of the
+sales, the throughput, and the delay between the first and the last display
+receiving the same update.
+
+Run against a running server using::
+
+    python -m quartjes.controllers.test.load_tester --registers 20 --displays 50
+
+Use --local to start a server in the same process.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import argparse
+import math
+import random
+import time
+from collections import defaultdict
+from threading import Thread, Event, Lock
+
+import numpy
+
+from quartjes.connector.client import ClientConnector
+from quartjes.util.sampling import WeightedSampler
+
+
+def constant_profile(rate, duration):
+    """
+    Sell at the same rate all the time.
+    """
+    return lambda elapsed: rate
+
+
+def ramp_profile(rate, duration):
+    """
+    Start without sales, increasing linearly to the rate at the end.
+    """
+    return lambda elapsed: rate * min(elapsed / duration, 1.0)
+
+
+def wave_profile(rate, duration):
+    """
+    Sales varying between 0 and twice the rate, with a period of a minute.
+    """
+    return lambda elapsed: rate * (1 - math.cos(2 * math.pi * elapsed / 60.0))
+
+
+def burst_profile(rate, duration):
+    """
+    Every minute a burst of 10 seconds at five times the rate, like when a
+    round of drinks is ordered after a song ends.
+    """
+    return lambda elapsed: rate * 5 if elapsed % 60.0 < 10.0 else rate * 0.2
+
+
+sale_rate_profiles = {"constant": constant_profile,
+                      "ramp": ramp_profile,
+                      "wave": wave_profile,
+                      "burst": burst_profile}
+"""
+Sale rate profiles by name. Each profile accepts the mean rate in sales per
+second and the duration of the test, and returns a function giving the rate
+for the number of seconds elapsed.
+"""
+
+
+class CallRecorder(object):
+    """
+    Thread safe collection of call latencies.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def add(self, latency, ok=True):
+        """
+        Record a finished call.
+        """
+        with self._lock:
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.errors += 1
+
+
+class EventRecorder(object):
+    """
+    Thread safe collection of event arrival times per event.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.arrivals = defaultdict(list)
+
+    def add(self, key, arrival):
+        """
+        Record the arrival of an event at one of the displays.
+        """
+        with self._lock:
+            self.arrivals[key].append(arrival)
+
+
+class CashRegister(Thread):
+    """
+    Simulated cash register selling drinks.
+
+    Parameters
+    ----------
+    connector : :class:`quartjes.connector.client.ClientConnector`
+        Started connector to use.
+    profile : callable object
+        Sale rate for the number of seconds elapsed.
+    recorder : :class:`CallRecorder`
+        Where to record the latency of the sales.
+    seed : int
+        Seed for the random generator.
+    """
+
+    def __init__(self, connector, profile, recorder, seed):
+        super(CashRegister, self).__init__(name="CashRegister%d" % seed)
+        self.daemon = True
+        self._connector = connector
+        self._profile = profile
+        self._recorder = recorder
+        self._rng = random.Random(seed)
+        self._sampler = WeightedSampler([])
+        self._stop_event = Event()
+
+    def update_drinks(self, drinks):
+        """
+        Cheap drinks are sold more often.
+        """
+        self._sampler.update(drinks, [1.0 / drink.price_factor for drink in drinks])
+
+    def run(self):
+        self.update_drinks(self._connector.database.get_drinks())
+        self._connector.database.on_drinks_updated += self.update_drinks
+
+        start_time = time.time()
+        while not self._stop_event.is_set():
+            rate = self._profile(time.time() - start_time)
+            if rate <= 0:
+                self._stop_event.wait(0.1)
+                continue
+            if self._stop_event.wait(self._rng.expovariate(rate)):
+                return
+
+            call_time = time.time()
+            try:
+                self._connector.stock_exchange.sell(self._sampler.sample(self._rng), self._rng.randint(1, 6))
+            except Exception:
+                self._recorder.add(time.time() - call_time, ok=False)
+            else:
+                self._recorder.add(time.time() - call_time)
+
+    def stop(self):
+        """
+        Stop selling.
+        """
+        self._stop_event.set()
+
+
+class Display(object):
+    """
+    Simulated display receiving all changes to the drinks.
+
+    Parameters
+    ----------
+    connector : :class:`quartjes.connector.client.ClientConnector`
+        Started connector to use.
+    recorder : :class:`EventRecorder`
+        Where to record the arrival of the changes.
+    """
+
+    def __init__(self, connector, recorder):
+        self._recorder = recorder
+        connector.database.on_drinks_delta += self.on_drinks_delta
+
+    def on_drinks_delta(self, delta):
+        self._recorder.add(delta.to_version, time.time())
+
+
+class LoadTestReport(object):
+    """
+    Results of a load test.
+
+    Parameters
+    ----------
+    duration : float
+        Length of the test in seconds.
+    calls : :class:`CallRecorder`
+        Latencies of the sales.
+    events : :class:`EventRecorder`
+        Arrival of changes at the displays.
+    displays : int
+        Number of displays.
+    """
+
+    percentiles = (50, 90, 99, 100)
+    """
+    Percentiles to report.
+    """
+
+    def __init__(self, duration, calls, events, displays):
+        self.duration = duration
+        self.calls = len(calls.latencies)
+        self.errors = calls.errors
+        self.throughput = self.calls / duration
+        self.latency = self._percentiles(calls.latencies)
+
+        delays = []
+        for arrivals in events.arrivals.values():
+            first = min(arrivals)
+            delays.extend(arrival - first for arrival in arrivals)
+        self.events = len(events.arrivals)
+        self.missed_events = self.events * displays - len(delays)
+        self.fan_out_delay = self._percentiles(delays)
+
+    def _percentiles(self, values):
+        if not values:
+            return dict((p, float("nan")) for p in self.percentiles)
+        return dict(zip(self.percentiles, numpy.percentile(values, self.percentiles)))
+
+    def _format_percentiles(self, values):
+        return ", ".join("p%d=%.1fms" % (p, values[p] * 1000) for p in self.percentiles)
+
+    def __str__(self):
+        return "\n".join(["Sales: %d in %.0fs (%.1f/s), %d errors" % (self.calls, self.duration,
+                                                                     self.throughput, self.errors),
+                          "Sale latency: %s" % self._format_percentiles(self.latency),
+                          "Updates: %d, %d deliveries missed" % (self.events, self.missed_events),
+                          "Fan-out delay: %s" % self._format_percentiles(self.fan_out_delay)])
+
+
+def run_load_test(host, port, registers=10, displays=10, duration=60, profile="constant", rate=1.0,
+                  codecs=None):
+    """
+    Run a load test against a server.
+
+    Parameters
+    ----------
+    host : string
+        Host the server runs on.
+    port : int
+        Port the server listens on.
+    registers : int
+        Number of cash registers.
+    displays : int
+        Number of displays.
+    duration : float
+        Length of the test in seconds.
+    profile : string
+        Name of the sale rate profile, see :data:`sale_rate_profiles`.
+    rate : float
+        Mean sales per second of each register.
+    codecs : list of string
+        Message codecs for the connections to use.
+
+    Returns
+    -------
+    report : :class:`LoadTestReport`
+        The measured results.
+    """
+    calls = CallRecorder()
+    events = EventRecorder()
+    connectors = []
+
+    def connect():
+        connector = ClientConnector(host, port, codecs=codecs)
+        connector.start()
+        connectors.append(connector)
+        return connector
+
+    try:
+        display_list = [Display(connect(), events) for _ in range(displays)]
+        profile_function = sale_rate_profiles[profile](rate, duration)
+        register_list = [CashRegister(connect(), profile_function, calls, seed) for seed in range(registers)]
+
+        start_time = time.time()
+        for register in register_list:
+            register.start()
+        time.sleep(duration)
+        for register in register_list:
+            register.stop()
+        for register in register_list:
+            register.join()
+        test_time = time.time() - start_time
+
+        # Wait for the last updates to arrive
+        time.sleep(2)
+        return LoadTestReport(test_time, calls, events, len(display_list))
+    finally:
+        for connector in connectors:
+            connector.stop()
+
+
+def _start_local_server(port):
+    """
+    Start a server with an in-memory database in this process. Returns the
+    server and the stock exchange, stop both when done.
+    """
+    from quartjes.connector.server import ServerConnector
+    from quartjes.controllers.database import Database
+    from quartjes.controllers.stock_exchange2 import StockExchange2
+
+    database = Database(db_file=None)
+    exchange = StockExchange2(database=database)
+    server = ServerConnector(port)
+    server.register_service(database, "database")
+    server.register_service(exchange, "stock_exchange")
+    server.start()
+    return server, exchange
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate load on a Quartjes server.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--registers", type=int, default=10, help="Number of cash registers")
+    parser.add_argument("--displays", type=int, default=10, help="Number of displays")
+    parser.add_argument("--duration", type=float, default=60, help="Length of the test in seconds")
+    parser.add_argument("--profile", choices=sorted(sale_rate_profiles), default="constant")
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean sales per second per register")
+    parser.add_argument("--codec", action="append", dest="codecs", help="Message codec to use")
+    parser.add_argument("--local", action="store_true", help="Start a server in this process")
+    args = parser.parse_args()
+
+    (server, exchange) = (None, None)
+    if args.local:
+        (server, exchange) = _start_local_server(args.port)
+        time.sleep(0.5)
+    try:
+        print(run_load_test(args.host, args.port, args.registers, args.displays, args.duration,
+                            args.profile, args.rate, args.codecs))
+    finally:
+        if server:
+            exchange.stop()
+            server.stop()
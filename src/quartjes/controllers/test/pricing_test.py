@@ -0,0 +1,74 @@
+"""
+Unit tests for the pricing engines.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import unittest
+import numpy
+from quartjes.controllers.pricing import create_pricing_engine, pricing_engines_by_name
+from quartjes.controllers.pricing_benchmark import create_synthetic_snapshot
+from quartjes.controllers.stock_exchange import StockExchangeEngine
+from quartjes.controllers.stock_exchange2 import StockExchange2Engine
+
+
+class PricingEngineTest(unittest.TestCase):
+    """
+    Test the engines of both stock exchanges on synthetic sales.
+    """
+
+    def setUp(self):
+        self.snapshot = create_synthetic_snapshot(50, rounds=10)
+        self.components = [drink_id for (drink_id, mix) in zip(self.snapshot.drink_ids, self.snapshot.mixes)
+                           if not mix]
+
+    def test_registry(self):
+        """
+        Both engines should be available by name.
+        """
+        self.assertIs(pricing_engines_by_name["stock_exchange"], StockExchangeEngine)
+        engine = create_pricing_engine("stock_exchange2", maximum_price_factor=2.0)
+        self.assertIsInstance(engine, StockExchange2Engine)
+        self.assertEqual(engine.maximum_price_factor, 2.0)
+        self.assertRaises(KeyError, create_pricing_engine, "unknown")
+
+    def test_no_sales(self):
+        """
+        Without sales the engines should not change any price.
+        """
+        self.snapshot.amounts[:] = 0.0
+        for name in ("stock_exchange", "stock_exchange2"):
+            self.assertEqual(create_pricing_engine(name).calculate(self.snapshot), {})
+
+    def test_limits(self):
+        """
+        Only components should get a price factor, within the limits of the engine.
+        """
+        for engine in (StockExchangeEngine(), StockExchange2Engine()):
+            factors = engine.calculate(self.snapshot)
+            self.assertEqual(sorted(factors), sorted(self.components))
+            for factor in factors.values():
+                self.assertGreaterEqual(factor, 0.3 - 1e-9)
+                self.assertLessEqual(factor, 3.0 + 1e-9)
+
+    def test_popular_drink(self):
+        """
+        The drink sold most should get the lowest price factor in version 2,
+        equal sales should result in a price factor of 1.
+        """
+        engine = StockExchange2Engine()
+        self.snapshot.amounts[:] = 1.0
+        self.snapshot.sale_price_factors[:] = 1.0
+        factors = engine.calculate(self.snapshot)
+        for factor in factors.values():
+            self.assertAlmostEqual(factor, 1.0)
+
+        rows = numpy.flatnonzero(~self.snapshot.mixes)
+        self.snapshot.amounts[rows] = numpy.arange(1.0, len(rows) + 1)[:, None]
+        factors = engine.calculate(self.snapshot)
+        popular = self.snapshot.drink_ids[rows[-1]]
+        self.assertEqual(min(factors, key=factors.get), popular)
+
+if __name__ == "__main__":
+    unittest.main()
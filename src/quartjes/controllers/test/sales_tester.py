@@ -1,6 +1,7 @@
 import random
 import time
 from quartjes.connector.client import ClientConnector
+from quartjes.util.sampling import WeightedSampler
 
 debug_memory = False
 
@@ -21,23 +22,13 @@ if __name__ == "__main__":
     database = con.database
     exchange = con.stock_exchange
 
-    current_drinks = {}
-    max_position = 0
+    # Cheap drinks are sold more often
+    sampler = WeightedSampler([])
     
     mem_counter = 0
 
     def update_drinks(drinks):
-        global current_drinks
-        global max_position
-        
-        new_drinks = {}
-        position = 0
-        for drink in drinks:
-            #print(drink)
-            new_drinks[position] = drink
-            position += int(1000.0 / drink.price_factor)
-        
-        current_drinks, max_position = new_drinks, position
+        sampler.update(drinks, [1.0 / drink.price_factor for drink in drinks])
         
         # Dump memory map at this point
         if debug_memory:
@@ -52,16 +43,10 @@ if __name__ == "__main__":
     tmp += update_drinks
 
     while True:
-        rand_pos = random.randint(0, max_position)
-        pos = 0
-        for p in current_drinks.keys():
-            if p > pos and p <= rand_pos:
-                pos = p
-
         a = random.randint(1, 6)
 
         try:
-            exchange.sell(drink=current_drinks[pos], amount=a)
+            exchange.sell(drink=sampler.sample(), amount=a)
         except:
             pass
         time.sleep(1.0)
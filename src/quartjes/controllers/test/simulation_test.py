@@ -0,0 +1,76 @@
+"""
+Unit tests for the simulation of the stock exchange.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import os
+import tempfile
+import unittest
+import numpy
+from quartjes.controllers.simulation import Simulation, SimulationResult, default_start_time
+
+
+class SimulationTest(unittest.TestCase):
+    """
+    Test running short simulations.
+    """
+
+    def test_deterministic(self):
+        """
+        The same seed should result in the same night of trading.
+        """
+        first = Simulation(seed=3).run(30 * 60)
+        second = Simulation(seed=3).run(30 * 60)
+        other = Simulation(seed=4).run(30 * 60)
+
+        self.assertEqual(len(first.times), 90)
+        self.assertTrue(numpy.array_equal(first.price_factors, second.price_factors))
+        self.assertTrue(numpy.array_equal(first.sales, second.sales))
+        self.assertFalse(numpy.array_equal(first.sales, other.sales))
+        self.assertGreater(first.revenue.sum(), 0)
+        self.assertTrue(numpy.isnan(first.demands[:, first.mixes]).all(), "Mixes have no demand")
+
+    def test_clock(self):
+        """
+        The stock exchange should only see simulated time.
+        """
+        simulation = Simulation(seed=1)
+        simulation.run(10 * 60)
+        self.assertEqual(simulation.clock(), default_start_time + 10 * 60)
+        for drink in simulation.database.get_drinks():
+            for item in drink.price_history:
+                self.assertGreater(item.timestamp, default_start_time)
+                self.assertLessEqual(item.timestamp, simulation.clock())
+
+    def test_no_monitor_left(self):
+        """
+        A finished simulation should not leave a database monitor running.
+        """
+        simulation = Simulation(seed=1)
+        simulation.run(60)
+        monitor = simulation.database._monitor
+        monitor.join(5)
+        self.assertFalse(monitor.is_alive())
+        self.assertIsNone(monitor.db, "The monitor should release the database")
+
+    def test_save(self):
+        """
+        Saved results should load again.
+        """
+        result = Simulation(seed=2).run(5 * 60)
+        (fd, file_name) = tempfile.mkstemp(suffix=".npz")
+        os.close(fd)
+        try:
+            result.save(file_name)
+            loaded = SimulationResult.load(file_name)
+        finally:
+            os.remove(file_name)
+
+        self.assertEqual(loaded.names, result.names)
+        for name in SimulationResult.columns[1:]:
+            numpy.testing.assert_array_equal(getattr(loaded, name), getattr(result, name), name)
+
+if __name__ == "__main__":
+    unittest.main()
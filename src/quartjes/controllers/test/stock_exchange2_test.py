@@ -8,8 +8,8 @@ import random
 import time
 
 import quartjes
-from quartjes.controllers.stock_exchange2 import StockExchange2, linear_demand_time_correction, max_sales_age, sqrt_demand_time_correction
-from quartjes.controllers.stock_exchange2 import square_demand_time_correction
+from quartjes.controllers.stock_exchange2 import StockExchange2, linear_demand_time_correction, default_max_sales_age, sqrt_demand_time_correction
+from quartjes.controllers.stock_exchange2 import square_demand_time_correction, RoundBuckets, StockExchange2Engine
 from quartjes.models.drink import Mix
 
 class StockExchange2Test(unittest.TestCase):
@@ -31,7 +31,8 @@ class StockExchange2Test(unittest.TestCase):
 
     def setUp(self):
         self.exchange._db.reset()
-        pass
+        self.rounds = int(default_max_sales_age / self.exchange.get_round_time())
+        self.exchange._sales_rounds = RoundBuckets(self.rounds, self.exchange.get_round_time())
 
 
     def tearDown(self):
@@ -64,9 +65,9 @@ class StockExchange2Test(unittest.TestCase):
         drink = self.get_random_drink()
         self.assertEqual(len(drink.sales_history), 0, "Expecting no sales history yet")
 
-        recent = time.time() - 0.1 * max_sales_age
-        old = time.time() - 0.5 * max_sales_age
-        very_old = time.time() - 0.9 * max_sales_age
+        recent = time.time() - 0.1 * default_max_sales_age
+        old = time.time() - 0.5 * default_max_sales_age
+        very_old = time.time() - 0.9 * default_max_sales_age
         amount = 10
         
         functions = (square_demand_time_correction, linear_demand_time_correction, sqrt_demand_time_correction)
@@ -77,7 +78,7 @@ class StockExchange2Test(unittest.TestCase):
         # For each function test that the older the sale, the less the demand
         for correction_function in functions:
             
-            self.exchange._demand_time_correction = correction_function
+            self.exchange._engine.demand_time_correction = correction_function
     
             drink.add_sales_history(amount, recent)
             recent_demand.append(self.exchange._calculate_demand(drink))
@@ -105,6 +106,54 @@ class StockExchange2Test(unittest.TestCase):
         print("Old_demand : %r" % old_demand)
         print("Very_old_demand : %r" % very_old_demand)
 
+    def test_02b_vectorized_demand_calculation(self):
+        """
+        Test the vectorized demand calculation gives the same results as the reference.
+        """
+        # Both calculations read the clock, use a fixed time so they agree
+        now = time.time()
+        self.exchange._clock = lambda: now
+        self.exchange._sales_rounds = RoundBuckets(self.rounds, self.exchange.get_round_time(), now)
+        try:
+            drinks = [drink for drink in self.exchange._db.get_drinks() if not isinstance(drink, Mix)]
+            for drink in drinks[1:]:
+                for _ in range(self.random.randint(1, 20)):
+                    drink.add_sales_history(self.random.randint(1, 5), now - self.random.random() * 1.2 * default_max_sales_age,
+                                            1.0, self.random.random() + 0.5)
+        
+            functions = (square_demand_time_correction, linear_demand_time_correction, sqrt_demand_time_correction,
+                         lambda value, age: value / (1.0 + age))
+            for correction_function in functions:
+                self.exchange._engine.demand_time_correction = correction_function
+            
+                demands = self.exchange._calculate_demand_values(drinks)
+                self.assertEqual(demands[0], 0.0, "Drink without sales should have no demand")
+                for (drink, demand) in zip(drinks, demands):
+                    self.assertAlmostEqual(demand, self.exchange._calculate_demand(drink), 3)
+            
+                self.exchange._normalize_sales(drinks)
+                demands = self.exchange._calculate_demand_values(drinks)
+                for (drink, demand) in zip(drinks, demands):
+                    self.assertAlmostEqual(demand, self.exchange._calculate_demand(drink), 3)
+                self.exchange._sales_rounds = RoundBuckets(self.rounds, self.exchange.get_round_time(), now)
+        finally:
+            self.exchange._clock = time.time
+            self.exchange._engine.demand_time_correction = linear_demand_time_correction
+
+    def test_02c_max_sales_age(self):
+        """
+        Test that the maximum age of sales is taken from the engine.
+        """
+        engine = StockExchange2Engine(max_sales_age=600)
+        exchange = StockExchange2(engine=engine, database=self.exchange._db, start_thread=False)
+        self.assertEqual(exchange._sales_rounds.rounds, 600 / exchange.get_round_time())
+        
+        drink = self.get_random_drink()
+        drink.add_sales_history(10, time.time() - 900, 1.0, 1.0)
+        self.assertEqual(exchange._calculate_demand(drink), 0.0, "Sales older than the maximum age are ignored")
+        self.assertEqual(exchange._calculate_demand_values([drink])[0], 0.0)
+        self.assertGreater(self.exchange._calculate_demand(drink), 0.0)
+
     def test_03a_normalize_sales_basic(self):
         """
         Test the normalization of sales.
@@ -114,10 +163,13 @@ class StockExchange2Test(unittest.TestCase):
         
         # Build random sales history
         now = int(time.time())
-        min_time = int(now - 10 * self.exchange.get_round_time())
+        round_time = self.exchange.get_round_time()
+        min_time = int(now - 10 * round_time)
         price = 10.0
         price_factor = 1.2
-        drinks = self.exchange._db.get_drinks()
+        drinks = [drink for drink in self.exchange._db.get_drinks() if not isinstance(drink, Mix)]
+        for drink in drinks:
+            drink.add_sales_history(1, float(min_time), price, price_factor)
         for _ in range(100):
             rnd_time = float(self.random.randint(min_time, now))
             rnd_amount = self.random.randint(1, 5)
@@ -126,39 +178,61 @@ class StockExchange2Test(unittest.TestCase):
         
         # Force normalization
         self.exchange._normalize_sales(drinks)
-        result = self.exchange._normalized_sales_history
+        (amounts, timestamps, price_factors) = self.exchange._sales_rounds.arrays(drinks)
         
         # All drinks should be present
         for d in drinks:
-            self.assertIn(d, result, "Drink missing from normalized history")
+            self.assertIn(d, self.exchange._sales_rounds, "Drink missing from normalized history")
+        self.assertEqual(amounts.shape, (len(drinks), self.rounds), "All history should have the same length")
         
         # Validate data
-        history_length = None
-        for drink, sales_history in result.items():
-            previous_timestamp = None
-            for history_item in sales_history:
-                # If sales are present, price and price factor must match
-                if history_item.amount > 0:
-                    self.assertTrue(history_item.price == price or history_item.price == drink.unit_price, 
-                                    "Price must match either drink price or sales price")
-                    self.assertTrue(history_item.price_factor == price_factor or history_item.price_factor == 1.0, 
+        for (drink, drink_amounts, drink_timestamps, drink_price_factors) in zip(drinks, amounts, timestamps, 
+                                                                                   price_factors):
+            # All sales must be present in the rounds covering them
+            self.assertAlmostEqual(drink_amounts[-12:].sum(), sum(item.amount for item in drink.sales_history),
+                                   msg="All sales must be present")
+            
+            # If sales are present, price factor must match
+            for (amount, factor) in zip(drink_amounts, drink_price_factors):
+                if amount > 0:
+                    self.assertTrue(factor == price_factor or factor == 1.0, 
                                     "Price factor must match either default price factor or sales price factor")
-                
-                # Interval between items must equal round time
-                if not previous_timestamp is None:
-                    self.assertAlmostEqual(history_item.timestamp - previous_timestamp, 
-                                           self.exchange.get_round_time(), 
-                                           1, 
-                                           "Interval between items must match round time")
-                previous_timestamp = history_item.timestamp
+            
+            # Interval between items must equal round time
+            for (previous, current) in zip(drink_timestamps, drink_timestamps[1:]):
+                self.assertAlmostEqual(current - previous, round_time, 1, 
+                                       "Interval between items must match round time")
                 
             # Last item must be for current time
-            self.assertEqual(int(sales_history[-1].timestamp), now, "Last item must be for current time")
-            
-            # All history should have the same length
-            if not history_length is None:
-                self.assertEqual(len(sales_history), history_length, "All history should have same length")
-            history_length = len(sales_history)
+            self.assertEqual(int(drink_timestamps[-1]), now, "Last item must be for current time")
+
+    def test_03b_normalize_sales_incremental(self):
+        """
+        Test that sales added while selling match grouping the sales history afterwards.
+        """
+        drinks = self.exchange._db.get_drinks()
+        self.exchange._normalize_sales(drinks)
+        
+        for _ in range(3):
+            for _ in range(20):
+                self.exchange.sell(self.random.choice(drinks), self.random.randint(1, 5))
+            self.exchange._normalize_sales(drinks)
+        
+        for drink in drinks:
+            if isinstance(drink, Mix):
+                drink.update_components_sale()
+        
+        components = [drink for drink in drinks if not isinstance(drink, Mix)]
+        rounds = RoundBuckets(self.rounds, self.exchange.get_round_time(), time.time())
+        rounds.close_round(time.time(), components)
+        (amounts, _, _) = self.exchange._sales_rounds.arrays(components)
+        (expected, _, _) = rounds.arrays(components)
+        self.assertAlmostEqual(amounts[:, -4:].sum(), expected[:, -2:].sum(), 
+                               msg="Incremental sales should match the sales history")
+        
+        self.exchange._db.remove(components[0])
+        self.exchange._normalize_sales(self.exchange._db.get_drinks())
+        self.assertNotIn(components[0], self.exchange._sales_rounds, "Removed drinks should be dropped")
 
     def get_random_drink(self):
         drinks = self.exchange._db.get_drinks()
@@ -0,0 +1,44 @@
+"""
+Unit tests for the parameter sweeps.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import unittest
+import quartjes.controllers.stock_exchange2 as stock_exchange2
+from quartjes.controllers.sweep import parameter_grid, run_sweep, summarize
+
+
+class SweepTest(unittest.TestCase):
+    """
+    Test running short sweeps.
+    """
+
+    def test_parameter_grid(self):
+        """
+        All combinations should be created.
+        """
+        grid = parameter_grid(maximum_deviation=[1, 2], demand_time_correction=["linear", "sqrt", "square"])
+        self.assertEqual(len(grid), 6)
+        self.assertIn({"maximum_deviation": 2, "demand_time_correction": "sqrt"}, grid)
+
+    def test_parallel(self):
+        """
+        Running in worker processes should give the same results as running in
+        this process, and leave the global settings alone.
+        """
+        grid = parameter_grid(max_sales_age=[600], maximum_price_factor=[1.5, 3.0])
+        local = run_sweep(grid, seeds=[0, 1], run_time=20 * 60, processes=1)
+        parallel = run_sweep(grid, seeds=[0, 1], run_time=20 * 60, processes=2)
+        self.assertEqual(local, parallel)
+        self.assertEqual(stock_exchange2.default_max_sales_age, 30 * 60)
+
+        summary = summarize(local)
+        self.assertEqual([parameters for (parameters, _) in summary], grid)
+        for (_, metrics) in summary:
+            self.assertGreater(metrics["revenue"], 0)
+            self.assertGreaterEqual(metrics["volatility"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
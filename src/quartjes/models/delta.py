@@ -0,0 +1,322 @@
+"""
+Incremental updates of the drinks in the database.
+
+Instead of sending the complete list of drinks to every client each time
+something changes, the database publishes :class:`DrinksDelta` objects
+describing only what changed since the previous version. Clients apply the
+deltas to their local copy of the drinks using :meth:`DrinksDelta.apply`.
+
+Each published delta increases the version of the database by one. A client
+that misses deltas, for example after a reconnect, can ask the database for
+all changes since the last version it has seen.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+from quartjes.util.classtools import QuartjesBaseClass
+from quartjes.models.drink import Mix
+
+DRINK_FIELDS = ("name", "alc_perc", "color", "unit_price", "unit_amount", "price_factor")
+"""
+Names of the simple properties of a drink that are compared to detect changes.
+"""
+
+MIX_FIELDS = DRINK_FIELDS + ("discount", "last_component_sales_update")
+"""
+Names of the simple properties of a mix that are compared to detect changes.
+"""
+
+
+class DrinkChange(QuartjesBaseClass):
+    """
+    Changes to a single drink.
+
+    Parameters
+    ----------
+    drink_id : UUID
+        Id of the changed drink.
+    fields : dict
+        New values of the changed properties by property name.
+    price_history : list of tuples
+        Entries appended to the price history.
+    sales_history : list of tuples
+        Entries appended to the sales history.
+    reset_price_history : boolean
+        The price history was cleared before appending the entries.
+    reset_sales_history : boolean
+        The sales history was cleared before appending the entries.
+    price_history_index : int
+        Running index of the first entry in `price_history`, see
+        :attr:`quartjes.models.drink.HistoryBuffer.count`.
+    sales_history_index : int
+        Running index of the first entry in `sales_history`.
+    """
+
+    def __init__(self, drink_id=None, fields=None, price_history=None, sales_history=None,
+                 reset_price_history=False, reset_sales_history=False, price_history_index=0,
+                 sales_history_index=0):
+        super(DrinkChange, self).__init__()
+
+        self.drink_id = drink_id
+        self.fields = fields or {}
+        self.price_history = price_history or []
+        self.sales_history = sales_history or []
+        self.reset_price_history = reset_price_history
+        self.reset_sales_history = reset_sales_history
+        self.price_history_index = price_history_index
+        self.sales_history_index = sales_history_index
+
+    def apply(self, drink):
+        """
+        Apply the changes to a local copy of the drink. History entries the
+        drink already has, because it was fetched just before the delta was
+        published, are skipped based on their running index.
+
+        Parameters
+        ----------
+        drink : :class:`quartjes.models.drink.Drink`
+            The drink to update.
+        """
+        for (name, value) in self.fields.items():
+            setattr(drink, name, value)
+
+        _apply_history(drink._price_history, self.price_history_index, self.price_history,
+                       self.reset_price_history)
+        _apply_history(drink._sales_history, self.sales_history_index, self.sales_history,
+                       self.reset_sales_history)
+
+    def __repr__(self):
+        return "DrinkChange<%s>" % self.drink_id
+
+
+class DrinksDelta(QuartjesBaseClass):
+    """
+    Changes to the drinks in the database between two versions.
+
+    Parameters
+    ----------
+    from_version : int
+        Version the changes apply to.
+    to_version : int
+        Version of the database after applying the changes.
+    epoch : UUID
+        Identifies the lifetime of the database. Versions of different epochs
+        cannot be compared.
+    added : list of :class:`quartjes.models.drink.Drink`
+        Drinks that are new, or that should replace the local copy completely.
+    removed : list of UUID
+        Ids of the drinks that were removed.
+    changes : list of :class:`DrinkChange`
+        Changes to existing drinks.
+    full : boolean
+        The delta contains the complete list of drinks in `added`. Any local
+        copy should be replaced.
+    """
+
+    def __init__(self, from_version=0, to_version=0, epoch=None, added=None, removed=None, changes=None,
+                 full=False):
+        super(DrinksDelta, self).__init__()
+
+        self.from_version = from_version
+        self.to_version = to_version
+        self.epoch = epoch
+        self.added = added or []
+        self.removed = removed or []
+        self.changes = changes or []
+        self.full = full
+
+    @property
+    def empty(self):
+        """
+        True if the delta does not contain any changes.
+        """
+        return not (self.full or self.added or self.removed or self.changes)
+
+    def applies_to(self, version, epoch):
+        """
+        Check whether the delta can be applied to a local copy.
+
+        Parameters
+        ----------
+        version : int
+            Version of the local copy.
+        epoch : UUID
+            Epoch of the local copy.
+
+        Returns
+        -------
+        applies : boolean
+            True if the delta can be applied. If False, the local copy needs
+            to be synchronized using
+            :meth:`quartjes.controllers.database.Database.get_changes_since`.
+        """
+        if self.full:
+            return True
+        return epoch == self.epoch and version == self.from_version
+
+    def apply(self, drinks):
+        """
+        Apply the changes to a local list of drinks. The list is modified in place.
+
+        Parameters
+        ----------
+        drinks : list of :class:`quartjes.models.drink.Drink`
+            Local copy of the drinks.
+
+        Returns
+        -------
+        drinks : list of :class:`quartjes.models.drink.Drink`
+            The same list, for convenience.
+        """
+        if self.full:
+            drinks[:] = self.added
+            return drinks
+
+        if self.removed:
+            removed = set(self.removed)
+            drinks[:] = [drink for drink in drinks if not drink.id in removed]
+
+        positions = dict((drink.id, i) for (i, drink) in enumerate(drinks))
+        for drink in self.added:
+            if drink.id in positions:
+                drinks[positions[drink.id]] = drink
+            else:
+                positions[drink.id] = len(drinks)
+                drinks.append(drink)
+
+        for drink in self.added:
+            if isinstance(drink, Mix):
+                drink.drinks = [_find_local(drinks, positions, component) for component in drink.drinks]
+
+        for change in self.changes:
+            position = positions.get(change.drink_id)
+            if position is not None:
+                change.apply(drinks[position])
+
+        return drinks
+
+    def __repr__(self):
+        return "DrinksDelta<%d-%d>" % (self.from_version, self.to_version)
+
+
+def take_snapshot(drink):
+    """
+    Record the state of a drink to compare against later.
+
+    Parameters
+    ----------
+    drink : :class:`quartjes.models.drink.Drink`
+        The drink to record.
+
+    Returns
+    -------
+    snapshot
+        Opaque object to pass to :func:`diff_drink`.
+    """
+    if isinstance(drink, Mix):
+        fields = MIX_FIELDS
+        components = tuple(component.id for component in drink.drinks)
+    else:
+        fields = DRINK_FIELDS
+        components = None
+
+    return _DrinkSnapshot(dict((name, getattr(drink, name)) for name in fields), components,
+                          drink._price_history.count, drink._sales_history.count)
+
+
+def diff_drink(snapshot, drink, fields=None):
+    """
+    Determine the changes to a drink since a snapshot was taken.
+
+    Parameters
+    ----------
+    snapshot
+        Snapshot created by :func:`take_snapshot`.
+    drink : :class:`quartjes.models.drink.Drink`
+        Current state of the drink.
+    fields : set of strings
+        Only compare these properties. Can contain the names in
+        :data:`MIX_FIELDS`, "price_history", "sales_history" and "drinks" for
+        the components of a mix. If None, everything is compared.
+
+    Returns
+    -------
+    change : :class:`DrinkChange`
+        The changes. None if the drink did not change. False if the changes
+        cannot be described and the complete drink needs to be sent.
+    """
+    if isinstance(drink, Mix):
+        if ((fields is None or "drinks" in fields) and
+                snapshot.components != tuple(component.id for component in drink.drinks)):
+            return False
+        names = MIX_FIELDS
+    elif snapshot.components is not None:
+        return False
+    else:
+        names = DRINK_FIELDS
+
+    if fields is not None:
+        names = [name for name in names if name in fields]
+
+    change = DrinkChange(drink.id)
+    for name in names:
+        value = getattr(drink, name)
+        if snapshot.fields.get(name) != value:
+            change.fields[name] = value
+
+    if fields is None or "price_history" in fields:
+        (change.price_history_index, change.price_history, change.reset_price_history) = \
+            _new_entries(snapshot.price_count, drink._price_history)
+    if fields is None or "sales_history" in fields:
+        (change.sales_history_index, change.sales_history, change.reset_sales_history) = \
+            _new_entries(snapshot.sales_count, drink._sales_history)
+
+    if not (change.fields or change.price_history or change.sales_history or
+            change.reset_price_history or change.reset_sales_history):
+        return None
+    return change
+
+
+class _DrinkSnapshot(object):
+    """
+    Recorded state of a drink.
+    """
+
+    __slots__ = ("fields", "components", "price_count", "sales_count")
+
+    def __init__(self, fields, components, price_count, sales_count):
+        self.fields = fields
+        self.components = components
+        self.price_count = price_count
+        self.sales_count = sales_count
+
+
+def _new_entries(count, history):
+    """
+    Find the entries appended to a history buffer since its count was the
+    given value. Returns a tuple of the running index of the first new entry,
+    the new entries and a flag indicating entries were dropped or removed,
+    so the history needs to be reset.
+    """
+    (first_index, entries) = history.entries_since(count)
+    return (first_index, entries, first_index > count)
+
+
+def _apply_history(history, first_index, entries, reset):
+    """
+    Apply new history entries from a :class:`DrinkChange` to a history buffer.
+    """
+    if reset:
+        history.clear(first_index)
+    history.add_since(first_index, entries)
+
+
+def _find_local(drinks, positions, drink):
+    """
+    Get the local copy of a drink if it exists.
+    """
+    position = positions.get(drink.id)
+    if position is None:
+        return drink
+    return drinks[position]
@@ -11,6 +11,7 @@ that requires the database to be reset.
 
 from quartjes.util.classtools import QuartjesBaseClass
 from numpy import array
+import numpy
 import time
 
 def to_quartjes(price):
@@ -59,8 +60,8 @@ class Drink(QuartjesBaseClass):
         self._unit_price = unit_price
         self._unit_amount = unit_amount
         self._price_factor = price_factor        
-        self._price_history = []
-        self._sales_history = []
+        self._price_history = HistoryBuffer(self.MAX_PRICE_HISTORY)
+        self._sales_history = HistoryBuffer(self.MAX_SALES_HISTORY)
     
     @property
     def name(self):
@@ -197,13 +198,13 @@ class Drink(QuartjesBaseClass):
         """
         Remove all historic prices of this drink.
         """
-        self._price_history = []
+        self._price_history.clear()
         
     def clear_sales_history(self):
         """
         Remove all sales history.
         """
-        self._sales_history = []
+        self._sales_history.clear()
     
     def add_price_history(self, timestamp=None, price=None):
         """
@@ -222,8 +223,6 @@ class Drink(QuartjesBaseClass):
             price = self.current_price
         
         self._price_history.append(History(timestamp=timestamp, price=price).data)
-        if len(self._price_history) > self.MAX_PRICE_HISTORY:
-            self._price_history = self._price_history[-self.MAX_PRICE_HISTORY:]
 
     def add_sales_history(self, amount, timestamp=None, price=None, price_factor=None):
         """
@@ -246,8 +245,32 @@ class Drink(QuartjesBaseClass):
             price_factor = self.price_factor
         
         self._sales_history.append(History(None, amount, timestamp, price, price_factor).data)
-        if len(self._sales_history) > self.MAX_SALES_HISTORY:
-            self._sales_history = self._sales_history[-self.MAX_SALES_HISTORY:]
+
+    def extend_price_history(self, entries):
+        """
+        Append raw entries to the price history, for example as received in
+        a :class:`quartjes.models.delta.DrinkChange`.
+
+        Parameters
+        ----------
+        entries : list of tuples
+            Entries in the format of :attr:`History.data`.
+        """
+        if entries:
+            self._price_history.extend(entries)
+
+    def extend_sales_history(self, entries):
+        """
+        Append raw entries to the sales history, for example as received in
+        a :class:`quartjes.models.delta.DrinkChange`.
+
+        Parameters
+        ----------
+        entries : list of tuples
+            Entries in the format of :attr:`History.data`.
+        """
+        if entries:
+            self._sales_history.extend(entries)
 
     def price_per_liter(self):
         return self.unit_price / (float(self.unit_amount) / 1000)
@@ -258,6 +281,25 @@ class Drink(QuartjesBaseClass):
     def sellprice_quartjes(self):
         assert False, "Please do not call this function anymore"
 
+    def __getstate__(self):
+        """
+        State used for pickling and serializing. The histories are stored as
+        lists of tuples, the format used before :class:`HistoryBuffer` existed,
+        together with the running index of their first entry.
+        """
+        state = vars(self).copy()
+        (state["_price_history_index"], state["_price_history"]) = self._price_history.entries_since(0)
+        (state["_sales_history_index"], state["_sales_history"]) = self._sales_history.entries_since(0)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        price_index = state.pop("_price_history_index", 0)
+        sales_index = state.pop("_sales_history_index", 0)
+        vars(self).update(state)
+        self._price_history = HistoryBuffer(self.MAX_PRICE_HISTORY, state.get("_price_history"), price_index)
+        self._sales_history = HistoryBuffer(self.MAX_SALES_HISTORY, state.get("_sales_history"), sales_index)
+
     def __eq__(self, other):
         if other == None:
             return False
@@ -344,12 +386,13 @@ class Mix(Drink):
         """
         new_last_update_time = 0
         parts = len(self._drinks)
-        for history_item in (History(data=data) for data in self._sales_history):
-            if history_item.timestamp > self._last_component_sales_update:
-                for component in self._drinks:
-                    component.add_sales_history(history_item.amount / parts, history_item.timestamp, history_item.price / parts, history_item.price_factor)
-                if history_item.timestamp > new_last_update_time:
-                    new_last_update_time = history_item.timestamp
+        history = self._sales_history
+        new_sales = numpy.flatnonzero(history.timestamps > self._last_component_sales_update)
+        for history_item in (History(data=history[index]) for index in new_sales):
+            for component in self._drinks:
+                component.add_sales_history(history_item.amount / parts, history_item.timestamp, history_item.price / parts, history_item.price_factor)
+            if history_item.timestamp > new_last_update_time:
+                new_last_update_time = history_item.timestamp
         
         if new_last_update_time > self._last_component_sales_update:
             self._last_component_sales_update = new_last_update_time
@@ -429,6 +472,283 @@ class History(object):
         """
         return (self._amount, self._timestamp, self._price, self._price_factor)
 
+
+class HistoryBuffer(object):
+    """
+    Fixed size store for history entries, keeping only the latest entries.
+    
+    Entries are stored in NumPy arrays, one row per field of :attr:`History.data`
+    (amount, timestamp, price and price factor). Appending is O(1) amortized and
+    the stored entries always form a contiguous block, so :meth:`window` and
+    the column properties return views without copying. Missing values (None)
+    are stored as NaN.
+    
+    Indexing and iterating return :attr:`History.data` tuples, so the buffer
+    can be used like the list of tuples it replaces. Slicing returns a new list.
+    Amounts that are whole numbers are returned as int.
+    
+    Every entry also gets a running index, counting all entries ever added.
+    Use :attr:`count` and :meth:`entries_since` to find the entries added
+    after a certain moment, also if some of them are equal.
+    
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of entries to keep.
+    entries : iterable of tuples
+        Initial entries in the format of :attr:`History.data`.
+    first_index : int
+        Running index of the first of the initial entries.
+    """
+    
+    _initial_size = 16
+    # Number of entries to allocate space for at first. Grows up to twice the capacity.
+    
+    def __init__(self, capacity, entries=None, first_index=0):
+        self._capacity = capacity
+        # The arrays, the range of stored entries and the running index of
+        # the entry after the range, replaced as a whole. Entries inside the
+        # range are never overwritten; when the arrays are full new ones are
+        # allocated. Readers take the tuple once, so they keep a consistent
+        # copy while entries are being added.
+        self._state = (numpy.empty((4, min(self._initial_size, 2 * capacity))), 0, 0, first_index)
+        if entries:
+            self.extend(entries)
+    
+    @property
+    def capacity(self):
+        """
+        Maximum number of entries kept.
+        """
+        return self._capacity
+    
+    @property
+    def count(self):
+        """
+        Running index the next entry will get. Equals the number of entries
+        ever added, unless the buffer was cleared or started at another index.
+        """
+        return self._state[3]
+    
+    @property
+    def amounts(self):
+        """
+        Read only view of the amounts, oldest first.
+        """
+        return self._view(0)
+    
+    @property
+    def timestamps(self):
+        """
+        Read only view of the timestamps, oldest first.
+        """
+        return self._view(1)
+    
+    @property
+    def prices(self):
+        """
+        Read only view of the prices, oldest first.
+        """
+        return self._view(2)
+    
+    @property
+    def price_factors(self):
+        """
+        Read only view of the price factors, oldest first.
+        """
+        return self._view(3)
+    
+    def window(self, count=None):
+        """
+        Get a view of the latest entries.
+        
+        Parameters
+        ----------
+        count : int
+            Number of entries to include. All entries if None.
+        
+        Returns
+        -------
+        window : numpy array
+            Read only array of shape (4, n) with the amounts, timestamps,
+            prices and price factors of the entries, oldest first. Entries
+            added later do not change it.
+        """
+        (data, start, end, _) = self._state
+        if count is not None:
+            start = max(start, end - count)
+        view = data[:, start:end]
+        view.flags.writeable = False
+        return view
+    
+    def append(self, entry):
+        """
+        Add an entry, dropping the oldest entry if the buffer is full.
+        
+        Parameters
+        ----------
+        entry : tuple
+            Entry in the format of :attr:`History.data`.
+        """
+        (data, start, end, index) = self._state
+        if end == data.shape[1]:
+            (data, start, end) = self._make_room(data, start, end)
+        data[:, end] = [numpy.nan if value is None else value for value in entry]
+        end += 1
+        self._state = (data, max(start, end - self._capacity), end, index + 1)
+    
+    def extend(self, entries):
+        """
+        Add multiple entries at once.
+        
+        Parameters
+        ----------
+        entries : iterable of tuples
+            Entries in the format of :attr:`History.data`.
+        """
+        rows = numpy.array(list(entries), dtype=float).reshape(-1, 4)
+        added = len(rows)
+        rows = rows[-self._capacity:]
+        count = len(rows)
+        if not count:
+            return
+        (data, start, end, index) = self._state
+        start = max(start, end + count - self._capacity)
+        if end + count > data.shape[1]:
+            (data, start, end) = self._make_room(data, start, end, count)
+        data[:, end:end + count] = rows.T
+        self._state = (data, start, end + count, index + added)
+    
+    def add_since(self, first_index, entries):
+        """
+        Add entries copied from another buffer, skipping the entries that are
+        already present. Entries are matched by running index, not by value.
+        If entries are missing between the last entry and the new entries,
+        the buffer is cleared first.
+        
+        Parameters
+        ----------
+        first_index : int
+            Running index of the first entry in the other buffer.
+        entries : list of tuples
+            Entries in the format of :attr:`History.data`.
+        """
+        index = self.count
+        if first_index > index:
+            self.clear(first_index)
+        elif index > first_index:
+            entries = entries[index - first_index:]
+        self.extend(entries)
+    
+    def entries_since(self, index):
+        """
+        Get the entries added since :attr:`count` had the given value.
+        
+        Parameters
+        ----------
+        index : int
+            Running index of the first entry to get.
+        
+        Returns
+        -------
+        first_index : int
+            Running index of the first entry returned. Larger than `index` if
+            entries were dropped or the buffer was cleared in the meantime.
+        entries : list of tuples
+            The entries.
+        """
+        (data, start, end, count) = self._state
+        first_index = count - (end - start)
+        if index > first_index:
+            start += min(index, count) - first_index
+            first_index = min(index, count)
+        return (first_index, [self._entry(data, column) for column in xrange(start, end)])
+    
+    def clear(self, first_index=None):
+        """
+        Remove all entries.
+        
+        Parameters
+        ----------
+        first_index : int
+            Running index for the next entry. By default one index is skipped,
+            so :meth:`entries_since` can tell the entries were removed.
+        """
+        (data, start, end, index) = self._state
+        if first_index is None:
+            first_index = index + 1
+        self._state = (data, end, end, first_index)
+    
+    def to_list(self):
+        """
+        Get all entries as a list of tuples.
+        """
+        return self[:]
+    
+    def _view(self, row):
+        (data, start, end, _) = self._state
+        view = data[row, start:end]
+        view.flags.writeable = False
+        return view
+    
+    def _make_room(self, data, start, end, extra=1):
+        """
+        Copy the entries to the start of new arrays, growing them if the
+        maximum size is not reached yet, to fit the given number of entries.
+        The old arrays are left untouched for readers still using them.
+        """
+        count = end - start
+        size = data.shape[1]
+        if size < 2 * self._capacity:
+            size = min(max(2 * size, count + extra), 2 * self._capacity)
+        new_data = numpy.empty((4, size))
+        new_data[:, :count] = data[:, start:end]
+        return (new_data, 0, count)
+    
+    @staticmethod
+    def _entry(data, column):
+        (amount, timestamp, price, price_factor) = data[:, column].tolist()
+        if amount != amount:
+            amount = None
+        elif amount.is_integer():
+            amount = int(amount)
+        if price != price:
+            price = None
+        if price_factor != price_factor:
+            price_factor = None
+        return (amount, timestamp, price, price_factor)
+    
+    def __len__(self):
+        (data, start, end, _) = self._state
+        return end - start
+    
+    def __iter__(self):
+        (data, start, end, _) = self._state
+        for column in xrange(start, end):
+            yield self._entry(data, column)
+    
+    def __getitem__(self, index):
+        (data, start, end, _) = self._state
+        length = end - start
+        if isinstance(index, slice):
+            return [self._entry(data, start + i) for i in xrange(*index.indices(length))]
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("History index out of range")
+        return self._entry(data, start + index)
+    
+    def __eq__(self, other):
+        if isinstance(other, HistoryBuffer):
+            other = other.to_list()
+        return self.to_list() == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return "HistoryBuffer(%d, %r)" % (self._capacity, self.to_list())
+
 if __name__ == "__main__":
     d1 = Drink('cola',color = (0,0,0),alc_perc = 0,unit_price = 0.70, unit_amount = 200)
     d2 = Drink('bacardi',color = (255,255,255),alc_perc = 40,unit_price = 2, unit_amount = 50)
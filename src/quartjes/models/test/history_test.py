@@ -0,0 +1,138 @@
+"""
+Unit tests for the history buffer of drinks.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import copy
+import cPickle as pickle
+import unittest
+import quartjes.connector.serializer as serializer
+import quartjes.connector.binary_serializer as binary_serializer
+from quartjes.models.drink import Drink, HistoryBuffer
+
+class TestHistoryBuffer(unittest.TestCase):
+    """
+    Test the ring buffer behavior and the list compatibility.
+    """
+
+    def test_capacity(self):
+        """
+        Only the latest entries should be kept.
+        """
+        history = HistoryBuffer(5)
+        for i in range(40):
+            history.append((i, float(i), 0.5 * i, None))
+        self.assertEqual(len(history), 5)
+        self.assertEqual(history[0], (35, 35.0, 17.5, None))
+        self.assertEqual(history[-1], (39, 39.0, 19.5, None))
+        self.assertEqual(history[-2:], [(38, 38.0, 19.0, None), (39, 39.0, 19.5, None)])
+        self.assertEqual(list(history.amounts), [35, 36, 37, 38, 39])
+        self.assertRaises(IndexError, history.__getitem__, 5)
+
+    def test_extend(self):
+        """
+        Extending should keep the latest entries, like appending one by one.
+        """
+        entries = [(i, float(i), 0.5 * i, None) for i in range(12)]
+        history = HistoryBuffer(5)
+        history.append((100, 100.0, None, None))
+        history.extend(entries[:3])
+        self.assertEqual(history.to_list(), [(100, 100.0, None, None)] + entries[:3])
+        history.extend(entries[3:])
+        self.assertEqual(history.to_list(), entries[-5:])
+        history.extend([])
+        history.append((12, 12.0, 6.0, None))
+        self.assertEqual(history[-2:], [entries[-1], (12, 12.0, 6.0, None)])
+
+    def test_window(self):
+        """
+        Windows should be read only views of the latest entries.
+        """
+        history = HistoryBuffer(10, [(1, 1.0, 2.0, 1.0), (2, 2.0, 3.0, 1.5), (3, 3.0, 4.0, 2.0)])
+        window = history.window(2)
+        self.assertEqual(window.shape, (4, 2))
+        self.assertEqual(list(window[1]), [2.0, 3.0])
+        self.assertRaises(ValueError, window.__setitem__, (0, 0), 5)
+
+        history.clear()
+        self.assertEqual(len(history), 0)
+        self.assertEqual(history.to_list(), [])
+
+    def test_stable_window(self):
+        """
+        Windows taken earlier should not change when entries are added.
+        """
+        history = HistoryBuffer(5)
+        for i in range(8):
+            history.append((i, float(i), 0.5 * i, 1.0))
+        window = history.window()
+        expected = window.copy()
+        for i in range(8, 40):
+            history.append((i, float(i), 0.5 * i, 1.0))
+        history.clear()
+        history.extend([(i, float(i), 0.5 * i, 1.0) for i in range(3)])
+        self.assertEqual(window.tolist(), expected.tolist())
+        self.assertEqual(history.to_list(), [(i, float(i), 0.5 * i, 1.0) for i in range(3)])
+
+    def test_running_index(self):
+        """
+        Entries should be found by running index, also after dropping or clearing.
+        """
+        history = HistoryBuffer(3)
+        for i in range(4):
+            history.append((1, 1.0, None, None))
+        self.assertEqual(history.count, 4)
+        self.assertEqual(history.entries_since(3), (3, [(1, 1.0, None, None)]))
+        self.assertEqual(history.entries_since(0)[0], 1, "Dropped entries should be skipped")
+        self.assertEqual(history.entries_since(4), (4, []))
+
+        history.clear()
+        self.assertEqual(history.entries_since(4), (5, []), "Clearing should skip an index")
+
+        copied = HistoryBuffer(3, [(1, 1.0, None, None)], 1)
+        copied.add_since(1, [(1, 1.0, None, None), (2, 2.0, None, None)])
+        self.assertEqual(copied.to_list(), [(1, 1.0, None, None), (2, 2.0, None, None)])
+        self.assertEqual(copied.count, 3)
+
+    def test_drink_history(self):
+        """
+        Drinks should limit their history and keep the History API.
+        """
+        drink = Drink("cola")
+        for i in range(Drink.MAX_PRICE_HISTORY + 10):
+            drink.add_price_history(i + 1.0, 0.7)
+        drink.add_sales_history(2, 10.0, 0.7, 1.1)
+        self.assertEqual(len(drink.price_history), Drink.MAX_PRICE_HISTORY)
+        self.assertIsNone(drink.price_history[0].amount)
+        self.assertEqual(drink.sales_history[0].amount, 2)
+        self.assertEqual(drink.sales_history[0].price_factor, 1.1)
+
+    def test_serializing(self):
+        """
+        Drinks with history should survive pickling, copying and both serializers.
+        """
+        drink = Drink("cola")
+        drink.add_price_history(1.0, 0.7)
+        drink.add_sales_history(2, 10.0, 0.7, 1.1)
+
+        self.assertEqual(pickle.loads(pickle.dumps(drink, pickle.HIGHEST_PROTOCOL)), drink)
+        self.assertEqual(copy.deepcopy(drink), drink)
+        self.assertEqual(serializer.deserialize(serializer.serialize(drink)), drink)
+        self.assertEqual(binary_serializer.deserialize(binary_serializer.serialize(drink)), drink)
+
+        node = serializer.serialize(drink)
+        self.assertEqual(node.find("_sales_history").get("type"), "list",
+                         "History should be sent as a list of tuples")
+
+        for i in range(10):
+            drink.add_sales_history(i, 11.0 + i, 0.7, None)
+        node = serializer.serialize(drink, pack_arrays=True)
+        self.assertEqual(node.find("_sales_history").get("type"), "packed")
+        self.assertEqual(serializer.deserialize(node)._sales_history, drink._sales_history)
+        self.assertEqual(binary_serializer.deserialize(binary_serializer.serialize(drink))._sales_history.count,
+                         drink._sales_history.count, "The running index should be kept")
+
+if __name__ == "__main__":
+    unittest.main()
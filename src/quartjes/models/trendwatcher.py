@@ -13,8 +13,7 @@ Limitations
 @author Rob
 """
 
-from quartjes.controllers.database import default_database
-from quartjes.controllers.stock_exchange2 import simulate
+from quartjes.controllers.simulation import simulate
 
 
 def calculate_price_difference(drinks):
@@ -61,9 +60,8 @@ def order_by_relative_price_change(drinks, time_window):
     
 
 if __name__ == '__main__':
-    simulate(60*60)
-    #default_database()._dump_drinks()
-    test_data = order_by_relative_price_change(default_database().get_drinks(), 10)
+    (simulation, _) = simulate(60*60)
+    test_data = order_by_relative_price_change(simulation.database.get_drinks(), 10)
     
     import pprint
     pprint.pprint(test_data)
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""
+Weighted random sampling.
+
+Used by the simulators and load generators to pick drinks, where popular or
+cheap drinks should be picked more often.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import bisect
+import random
+
+import numpy
+
+
+class WeightedSampler(object):
+    """
+    Pick items at random with a chance proportional to their weight.
+
+    A cumulative sum of the weights is kept, so picking an item is a binary
+    search taking O(log n) time. Rebuilding the sampler after the weights
+    change takes O(n) time, see :meth:`update`. Sampling is safe while another
+    thread updates the sampler; it uses either the old or the new items.
+
+    Parameters
+    ----------
+    items : list
+        Items to pick from.
+    weights : list of float
+        Weight of each item. Must not be negative. Defaults to equal weights.
+    """
+
+    def __init__(self, items, weights=None):
+        # Items and cumulative weights, as array and as list, replaced as a
+        # whole so readers always see matching values
+        self._state = ([], numpy.zeros(0), [])
+        self.update(items, weights)
+
+    def update(self, items, weights=None):
+        """
+        Replace the items and their weights.
+
+        Parameters
+        ----------
+        items : list
+            Items to pick from.
+        weights : list of float
+            Weight of each item. Defaults to equal weights.
+
+        Raises
+        ------
+        ValueError
+            The number of weights does not match the number of items, or a
+            weight is negative.
+        """
+        items = list(items)
+        if weights is None:
+            weights = numpy.ones(len(items))
+        else:
+            weights = numpy.asarray(weights, dtype=float)
+        if len(weights) != len(items):
+            raise ValueError("Expected %d weights, got %d" % (len(items), len(weights)))
+        if (weights < 0).any():
+            raise ValueError("Weights must not be negative")
+
+        cumulative = numpy.cumsum(weights)
+        self._state = (items, cumulative, cumulative.tolist())
+
+    @property
+    def total_weight(self):
+        """
+        Sum of all weights.
+        """
+        return self._total_weight(self._state[2])
+
+    def __len__(self):
+        return len(self._state[0])
+
+    def sample(self, rng=random):
+        """
+        Pick one item.
+
+        Parameters
+        ----------
+        rng : random.Random
+            Random generator to use. Defaults to the random module.
+
+        Returns
+        -------
+        item
+            The picked item.
+
+        Raises
+        ------
+        IndexError
+            There are no items with a positive weight.
+        """
+        (items, _, cumulative_list) = self._state
+        total_weight = self._total_weight(cumulative_list)
+        if not total_weight > 0:
+            raise IndexError("No items to sample from")
+        index = bisect.bisect_right(cumulative_list, rng.random() * total_weight)
+        return items[min(index, len(items) - 1)]
+
+    def sample_indices(self, count, rng=numpy.random):
+        """
+        Pick many items at once, returning their indices.
+
+        Parameters
+        ----------
+        count : int
+            Number of items to pick.
+        rng : numpy.random.RandomState
+            Random generator to use. Defaults to the global NumPy generator.
+
+        Returns
+        -------
+        indices : numpy array
+            Index of each picked item.
+
+        Raises
+        ------
+        IndexError
+            There are no items with a positive weight.
+        """
+        (items, cumulative, cumulative_list) = self._state
+        total_weight = self._total_weight(cumulative_list)
+        if not total_weight > 0:
+            raise IndexError("No items to sample from")
+        indices = cumulative.searchsorted(rng.random_sample(count) * total_weight, side="right")
+        return numpy.minimum(indices, len(items) - 1)
+
+    @staticmethod
+    def _total_weight(cumulative_list):
+        """
+        Sum of the weights given their cumulative sum.
+        """
+        return cumulative_list[-1] if cumulative_list else 0.0
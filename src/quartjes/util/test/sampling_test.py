@@ -0,0 +1,76 @@
+"""
+Unit tests for the weighted sampler.
+"""
+
+__author__ = "Rob van der Most"
+__docformat__ = "restructuredtext en"
+
+import random
+import threading
+import unittest
+import numpy
+from quartjes.util.sampling import WeightedSampler
+
+
+class WeightedSamplerTest(unittest.TestCase):
+    """
+    Test picking items with and without weights.
+    """
+
+    def test_distribution(self):
+        """
+        Items should be picked proportional to their weight, never when the
+        weight is zero.
+        """
+        sampler = WeightedSampler(["a", "b", "c", "d"], [1, 0, 3, 0])
+        rng = random.Random(1)
+        counts = dict((item, 0) for item in "abcd")
+        for _ in range(4000):
+            counts[sampler.sample(rng)] += 1
+        self.assertEqual(counts["b"] + counts["d"], 0)
+        self.assertAlmostEqual(counts["c"] / float(counts["a"]), 3.0, delta=0.3)
+
+        indices = sampler.sample_indices(4000, numpy.random.RandomState(1))
+        counts = numpy.bincount(indices, minlength=4)
+        self.assertEqual(counts[1] + counts[3], 0)
+        self.assertAlmostEqual(counts[2] / float(counts[0]), 3.0, delta=0.3)
+
+    def test_update(self):
+        """
+        Updating should replace items and weights.
+        """
+        sampler = WeightedSampler(["a", "b"])
+        self.assertEqual(sampler.total_weight, 2.0)
+        sampler.update(["c"], [0.5])
+        self.assertEqual(len(sampler), 1)
+        self.assertEqual(sampler.sample(), "c")
+
+        sampler.update([])
+        self.assertRaises(IndexError, sampler.sample)
+        self.assertRaises(ValueError, sampler.update, ["a"], [1, 2])
+        self.assertRaises(ValueError, sampler.update, ["a"], [-1])
+
+    def test_concurrent_update(self):
+        """
+        Sampling while another thread updates should use either the old or
+        the new items, never a mix of both.
+        """
+        sampler = WeightedSampler(["z"])
+        stop = threading.Event()
+
+        def updater():
+            while not stop.is_set():
+                sampler.update(["a", "b", "c"], [0, 0, 1])
+                sampler.update(["z"])
+
+        thread = threading.Thread(target=updater)
+        thread.start()
+        try:
+            picked = set(sampler.sample() for _ in range(20000))
+        finally:
+            stop.set()
+            thread.join()
+        self.assertLessEqual(picked, set(["c", "z"]))
+
+if __name__ == "__main__":
+    unittest.main()